@@ -1,12 +1,71 @@
+import mmap
+import os
 import os.path
 import pickle
+import struct
+import threading
+import zlib
+from array import array
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    # Windows: writers are only kept apart within one process there, see locked()
+    fcntl = None
+
+# lock file -> how many MyDB.locked() blocks this thread is inside for it, shared
+# by every MyDB on the same file so that two of them can't deadlock one thread
+held = threading.local()
+# lock file -> the threading.Lock that stands in for flock without fcntl
+threadLocks = {}
+threadLocksLock = threading.Lock()
+
+def threadLock(path):
+    with threadLocksLock:
+        return threadLocks.setdefault(path, threading.Lock())
 
 class MyDB:
 
     def __init__(self, filename):
         self.fname = filename
-        if not os.path.isfile(self.fname):
-            self.saveStrings([])
+        self.local = threading.local()
+        with self.locked():
+            if not os.path.isfile(self.fname):
+                self.saveStrings([])
+
+# Writers take an exclusive flock on a file next to the DB (the DB itself is
+# replaced on every save, so a lock on it would not outlive the save). That
+# serializes writers in other processes and, since every holder opens the lock
+# file afresh, in other threads of this one. A thread already holding it, through
+# this MyDB or any other on the same file, just goes on, so saveString can call
+# saveStrings. Without fcntl only threads of this process are kept apart.
+    @contextmanager
+    def locked(self):
+        path = os.path.abspath(self.fname + ".lock")
+        depths = held.__dict__.setdefault("depths", {})
+        if depths.get(path):
+            depths[path] += 1
+            try:
+                yield
+            finally:
+                depths[path] -= 1
+            return
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            else:
+                threadLock(path).acquire()
+            depths[path] = 1
+            try:
+                yield
+            finally:
+                del depths[path]
+                if fcntl is None:
+                    threadLock(path).release()
+        finally:
+            # closing the file drops the flock
+            os.close(fd)
 
 # Read the currnt contents of the db
     def loadStrings(self):
@@ -14,13 +73,344 @@ class MyDB:
             arr = pickle.load(f)
         return arr
 
-# Overwirte the DB with this list
+# Overwrite the DB with this list. The pickle goes to a temp file that then
+# replaces the DB in one rename, so a reader sees the old list or the new one,
+# never half of one.
     def saveStrings(self, arr):
-        with open(self.fname, 'wb') as f:
-            pickle.dump(arr, f)
+        tmp = self.fname + ".tmp"
+        with self.locked():
+            with open(tmp, 'wb') as f:
+                pickle.dump(arr, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.fname)
 
-# Append one string to the DB
+# Append one string to the DB; inside batch() it waits for the batch to end
     def saveString(self, s):
-        arr = self.loadStrings()
-        arr.append(s)
-        self.saveStrings(arr)
+        pending = getattr(self.local, "batch", None)
+        if pending is not None:
+            pending.append(s)
+            return
+        with self.locked():
+            arr = self.loadStrings()
+            arr.append(s)
+            self.saveStrings(arr)
+
+# Append all these strings with a single write
+    def saveMany(self, strings):
+        with self.locked():
+            arr = self.loadStrings()
+            arr.extend(strings)
+            self.saveStrings(arr)
+
+# Holds the lock and collects every saveString made in this thread until the
+# block ends, then appends them all with one saveMany. Nothing is saved if the
+# block raises.
+#   with db.batch():
+#       for line in lines:
+#           db.saveString(line)
+    @contextmanager
+    def batch(self):
+        with self.locked():
+            outer = getattr(self.local, "batch", None)
+            if outer is not None:
+                yield self
+                return
+            self.local.batch = []
+            try:
+                yield self
+                pending = self.local.batch
+            finally:
+                self.local.batch = None
+            if pending:
+                self.saveMany(pending)
+
+# Random access and iteration. A pickle has to be loaded whole to answer any of
+# these; MyLogDB answers them from an offset index without loading the list.
+    def __len__(self):
+        return len(self.loadStrings())
+
+    def get(self, i):
+        return self.loadStrings()[i]
+
+    def __getitem__(self, i):
+        return self.loadStrings()[i]
+
+    def iterStrings(self):
+        return iter(self.loadStrings())
+
+# The log format is an 8 byte magic followed by records of
+#   kind (1 byte) | payload length (4 bytes) | crc32 of kind + payload (4 bytes) | payload
+# An APPEND record holds one utf-8 string. A RESET record holds a count n and
+# throws away everything before it; it is always followed by the n APPEND
+# records of the new list, and is ignored if fewer than n made it to disk.
+LOG_MAGIC = b"MYDBLOG1"
+RECORD_HEADER = struct.Struct("<BII")
+RESET_PAYLOAD = struct.Struct("<Q")
+APPEND = 1
+RESET = 2
+
+def recordCrc(kind, payload):
+    return zlib.crc32(payload, zlib.crc32(bytes([kind])))
+
+def encodeRecord(kind, payload):
+    return RECORD_HEADER.pack(kind, len(payload), recordCrc(kind, payload)) + payload
+
+def encodeString(s):
+    return encodeRecord(APPEND, s.encode('utf-8'))
+
+def recordIsIntact(buf, pos):
+    kind, length, crc = RECORD_HEADER.unpack_from(buf, pos)
+    start = pos + RECORD_HEADER.size
+    return recordCrc(kind, buf[start:start + length]) == crc
+
+# Walk the records up to `size` bytes, stopping at the first torn or corrupt
+# one. Every checksum is read, but no string is decoded. Returns the offsets of
+# the live list's records (relative to where that list starts), where it
+# starts, and where the intact records end.
+def scanLog(buf, size):
+    offsets, liveStart, pos = array('Q'), len(LOG_MAGIC), len(LOG_MAGIC)
+    # state to fall back to while a RESET is still waiting for its records
+    before = None
+    pending = 0
+    while pos + RECORD_HEADER.size <= size:
+        kind, length, _ = RECORD_HEADER.unpack_from(buf, pos)
+        start = pos + RECORD_HEADER.size
+        end = start + length
+        if kind not in (APPEND, RESET) or end > size or not recordIsIntact(buf, pos):
+            break
+        if kind == RESET:
+            before = (offsets, liveStart, pos)
+            pending = RESET_PAYLOAD.unpack_from(buf, start)[0]
+            offsets, liveStart = array('Q'), end
+        else:
+            offsets.append(pos - liveStart)
+            pending = max(pending - 1, 0)
+        if not pending:
+            before = None
+        pos = end
+    if before is not None:
+        return before
+    return offsets, liveStart, pos
+
+# Same interface as MyDB, stored as an append-only log so that saveString
+# writes one small record instead of rewriting the whole file
+class MyLogDB(MyDB):
+
+    def __init__(self, filename, compactRatio=1.0, compactMinBytes=64 * 1024):
+        self.fname = filename
+        self.local = threading.local()
+        self.map = None
+        self.file = None
+        # saveStrings leaves the old list behind as dead bytes; compact once they
+        # exceed both compactMinBytes and compactRatio times the live bytes
+        self.compactRatio = compactRatio
+        self.compactMinBytes = compactMinBytes
+        # recovery can cut the file, which must never happen under another writer
+        with self.locked():
+            # an empty file is an empty log; there is no pickle in it to migrate
+            if not os.path.isfile(self.fname) or os.path.getsize(self.fname) == 0:
+                self.writeLog([])
+            elif not self.isLog():
+                self.migrate()
+            self.recover()
+
+    def isLog(self):
+        with open(self.fname, 'rb') as f:
+            return f.read(len(LOG_MAGIC)) == LOG_MAGIC
+
+# One-time conversion of a file written by the pickle based MyDB
+    def migrate(self):
+        with open(self.fname, 'rb') as f:
+            arr = pickle.load(f)
+        self.writeLog(encodeString(s) for s in arr)
+
+# Replace the file with a fresh log made of these encoded records (temp file + rename, so it is all or nothing)
+    def writeLog(self, records):
+        tmp = self.fname + ".tmp"
+        with open(tmp, 'wb') as f:
+            f.write(LOG_MAGIC)
+            for record in records:
+                f.write(record)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.fname)
+
+# Walk the records and cut the file at the first torn or corrupt one. Appends
+# are not fsynced, so after a crash any record may be damaged, not just the
+# last. Builds self.offsets (where each live record starts, relative to
+# self.liveStart) without decoding a single string.
+    def recover(self):
+        with open(self.fname, 'r+b') as f:
+            size = os.fstat(f.fileno()).st_size
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                offsets, liveStart, pos = scanLog(m, size)
+            if pos < size:
+                f.truncate(pos)
+        self.closeFile()
+        # reads go through this descriptor, since compact() may put another file under the name
+        self.file = open(self.fname, 'rb')
+        self.inode = os.fstat(self.file.fileno()).st_ino
+        self.offsets = offsets
+        self.liveStart = liveStart
+        self.end = pos
+
+# Called by writers with the lock held: another process may have appended or
+# compacted since we last looked, and our next record must go after theirs.
+# Readers keep the list as it was when this DB last wrote or caught up: they
+# read the file that was indexed then, even once a compaction has replaced it.
+    def catchUp(self):
+        try:
+            stat = os.stat(self.fname)
+        except FileNotFoundError:
+            stat = None
+        if stat is None or stat.st_ino != self.inode or stat.st_size != self.end:
+            self.recover()
+
+# Pick up what other processes have written
+    def refresh(self):
+        with self.locked():
+            self.catchUp()
+
+    def closeMap(self):
+        if self.map is not None:
+            self.map.close()
+        self.map = None
+
+    def closeFile(self):
+        self.closeMap()
+        if self.file is not None:
+            self.file.close()
+        self.file = None
+
+# Release the memory map and the file; the DB can still be used and will open them again
+    def close(self):
+        self.closeFile()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# A read-only map covering everything written so far, remapped when the file has grown
+    def mapped(self):
+        if self.map is None or len(self.map) < self.end:
+            f = self.indexedFile()
+            self.closeMap()
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.map
+
+# The file the offsets index. After close() it is opened by name again, and if
+# that is another file by now, it is indexed from scratch.
+    def indexedFile(self):
+        if self.file is None:
+            f = open(self.fname, 'rb')
+            if os.fstat(f.fileno()).st_ino == self.inode:
+                self.file = f
+            else:
+                f.close()
+                self.refresh()
+        return self.file
+
+    def __len__(self):
+        return len(self.offsets)
+
+# Decode only the i-th record
+    def get(self, i):
+        # first, since mapping again after close() can mean indexing again
+        m = self.mapped()
+        pos = self.liveStart + self.offsets[i]
+        _, length, _ = RECORD_HEADER.unpack_from(m, pos)
+        start = pos + RECORD_HEADER.size
+        return m[start:start + length].decode('utf-8')
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.get(j) for j in range(*i.indices(len(self.offsets)))]
+        return self.get(i)
+
+# One string at a time straight from the map, so a full scan needs no extra memory
+    def iterStrings(self):
+        for i in range(len(self.offsets)):
+            yield self.get(i)
+
+# Read the current contents of the db
+    def loadStrings(self):
+        data = self.mapped()[self.liveStart:self.end]
+        arr = []
+        pos = 0
+        while pos < len(data):
+            _, length, _ = RECORD_HEADER.unpack_from(data, pos)
+            start = pos + RECORD_HEADER.size
+            arr.append(data[start:start + length].decode('utf-8'))
+            pos = start + length
+        return arr
+
+# Overwrite the DB with this list, appended behind a RESET record
+    def saveStrings(self, arr):
+        encoded = [encodeString(s) for s in arr]
+        reset = encodeRecord(RESET, RESET_PAYLOAD.pack(len(arr)))
+        with self.locked():
+            self.catchUp()
+            with open(self.fname, 'ab') as f:
+                f.write(reset + b"".join(encoded))
+            self.offsets = array('Q')
+            offset = 0
+            for record in encoded:
+                self.offsets.append(offset)
+                offset += len(record)
+            self.liveStart = self.end + len(reset)
+            self.end = self.liveStart + offset
+            self.maybeCompact()
+
+# Append one string to the DB: one record, no matter how big the DB is
+    def saveString(self, s):
+        pending = getattr(self.local, "batch", None)
+        if pending is not None:
+            pending.append(s)
+            return
+        self.saveMany([s])
+
+# Append all these strings as records in a single write
+    def saveMany(self, strings):
+        encoded = [encodeString(s) for s in strings]
+        with self.locked():
+            self.catchUp()
+            with open(self.fname, 'ab') as f:
+                f.write(b"".join(encoded))
+            for record in encoded:
+                self.offsets.append(self.end - self.liveStart)
+                self.end += len(record)
+
+    def deadBytes(self):
+        return self.liveStart - len(LOG_MAGIC)
+
+    def maybeCompact(self):
+        dead = self.deadBytes()
+        if dead > self.compactMinBytes and dead > self.compactRatio * (self.end - self.liveStart):
+            self.compact()
+
+# Drop everything before the current list, copying its records over as they are
+    def compact(self):
+        with self.locked():
+            self.catchUp()
+            # offsets are relative to liveStart, so the index survives the move untouched
+            self.writeLog(self.readLive())
+            self.closeFile()
+            self.file = open(self.fname, 'rb')
+            self.inode = os.fstat(self.file.fileno()).st_ino
+            self.end = len(LOG_MAGIC) + self.end - self.liveStart
+            self.liveStart = len(LOG_MAGIC)
+
+# The raw bytes of the current list's records, a chunk at a time
+    def readLive(self, chunkSize=1024 * 1024):
+        with open(self.fname, 'rb') as f:
+            f.seek(self.liveStart)
+            remaining = self.end - self.liveStart
+            while remaining > 0:
+                chunk = f.read(min(chunkSize, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
@@ -0,0 +1,173 @@
+import json
+import os
+import sys
+import threading
+from squirrel_metrics import metrics
+
+# Admission control: how much work the server takes on before it turns requests
+# away with a quick 503 and a Retry-After, instead of letting them queue until
+# every client, health checks included, has timed out.
+#
+#   maxQueue     requests waiting for a worker thread (with the threads engine,
+#                connections, since a connection keeps its thread between
+#                requests); one more is refused. 0 for no limit.
+#   routeLimits  {"GET /squirrels": 2, "/squirrels/_bulk": 1, ...}: how many
+#                requests for a route (see squirrel_server.routeLabel) run at
+#                once, optionally only for one method. A request over any of
+#                its limits is refused straight away, so a pile of listings
+#                can't take every thread the point lookups need.
+#   retryAfter   seconds to tell refused clients to wait
+#
+# All of them can change while serving: set() takes new values, and a file
+# passed to configure() is re-read whenever it changes.
+
+ROUTES = ("/squirrels", "/squirrels/{id}", "/squirrels/_bulk", "/squirrels/changes", "/metrics", "other")
+
+class Admission:
+
+    def __init__(self, maxQueue=0, routeLimits=None, retryAfter=1):
+        self.lock = threading.Lock()
+        self.queued = 0
+        # limit key -> requests running under it
+        self.running = {}
+        self.configPath = None
+        self.configMtime = None
+        self.defaults = {}
+        self.set(maxQueue, routeLimits, retryAfter)
+
+    # the values to go back to for anything a watched file leaves out
+    def configure(self, maxQueue=0, routeLimits=None, retryAfter=1, configPath=None):
+        self.defaults = {"maxQueue": maxQueue, "routeLimits": routeLimits, "retryAfter": retryAfter}
+        self.set(maxQueue, routeLimits, retryAfter)
+        self.configPath = configPath
+        self.configMtime = None
+        self.reloadIfChanged()
+
+    def set(self, maxQueue=0, routeLimits=None, retryAfter=1):
+        # a limit of 0 is no limit, like everywhere else
+        limits = {key: limit for key, limit in checkRouteLimits(routeLimits or {}).items() if limit}
+        with self.lock:
+            self.maxQueue = maxQueue
+            # replaced whole, so admit() can read it without the lock
+            self.routeLimits = limits
+            self.retryAfter = retryAfter
+
+    # Called from the serve loop. A file that can't be read or parsed leaves the
+    # limits as they are, and is tried again once it changes.
+    def reloadIfChanged(self):
+        if self.configPath is None:
+            return
+        try:
+            mtime = os.stat(self.configPath).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime == self.configMtime:
+            return
+        self.configMtime = mtime
+        settings = dict(self.defaults)
+        if mtime is not None:
+            try:
+                with open(self.configPath) as f:
+                    settings.update(parseConfig(f.read()))
+            except (OSError, ValueError) as e:
+                print(f"squirrel_server: ignoring {self.configPath}: {e}", file=sys.stderr, flush=True)
+                return
+        self.set(**settings)
+
+    # a place in the queue for a request about to wait for a worker, or False to refuse it
+    def enqueue(self):
+        with self.lock:
+            if self.maxQueue and self.queued >= self.maxQueue:
+                refused = True
+            else:
+                refused = False
+                self.queued += 1
+        if refused:
+            metrics.inc("squirrel_http_requests_shed_total", (("route", "-"), ("reason", "queue")))
+            return False
+        metrics.inc("squirrel_http_requests_queued")
+        return True
+
+    # the request has its worker
+    def dequeue(self):
+        with self.lock:
+            self.queued -= 1
+        metrics.dec("squirrel_http_requests_queued")
+
+    # the limit keys the request now counts against, to hand to release(), or None to refuse it
+    def admit(self, method, route):
+        limits = self.routeLimits
+        if not limits:
+            return ()
+        keys = tuple(key for key in (route, f"{method} {route}") if key in limits)
+        if not keys:
+            return ()
+        with self.lock:
+            full = any(self.running.get(key, 0) >= limits[key] for key in keys)
+            if not full:
+                for key in keys:
+                    self.running[key] = self.running.get(key, 0) + 1
+        if full:
+            metrics.inc("squirrel_http_requests_shed_total", (("route", route), ("reason", "route_limit")))
+            return None
+        return keys
+
+    def release(self, keys):
+        if keys:
+            with self.lock:
+                for key in keys:
+                    self.running[key] -= 1
+
+# The whole response for a request refused before anything read it. It closes
+# the connection, since the rest of whatever the client sent is never read.
+def refusal(retryAfter):
+    body = b"503 Service Unavailable"
+    return (b"HTTP/1.1 503 Service Unavailable\r\n"
+            b"Retry-After: %d\r\n"
+            b"Content-Type: text/plain\r\n"
+            b"Content-Length: %d\r\n"
+            b"Connection: close\r\n\r\n" % (retryAfter, len(body))) + body
+
+# {"GET /squirrels": 2} after checking every key names a known route, or ValueError
+def checkRouteLimits(limits):
+    checked = {}
+    for key, limit in limits.items():
+        method, _, route = key.rpartition(" ")
+        if route not in ROUTES or (method and not method.isalpha()):
+            raise ValueError(f"unknown route {key!r}, expected [METHOD ]one of {', '.join(ROUTES)}")
+        if not isinstance(limit, int) or limit < 0:
+            raise ValueError(f"limit for {key!r} must be a whole number, 0 for none")
+        checked[f"{method.upper()} {route}" if method else route] = limit
+    return checked
+
+# ["GET /squirrels=2", "/squirrels/_bulk=1"] from the command line -> {"GET /squirrels": 2, ...}
+def parseRouteLimits(items):
+    limits = {}
+    for item in items:
+        key, _, limit = item.rpartition("=")
+        if not key or not limit.strip().isdigit():
+            raise ValueError(f"expected ROUTE=LIMIT, got {item!r}")
+        limits[key.strip()] = int(limit)
+    return checkRouteLimits(limits)
+
+# {"max_queue": 64, "route_limits": {...}, "retry_after": 2} -> set() keywords
+def parseConfig(text):
+    config = json.loads(text)
+    if not isinstance(config, dict):
+        raise ValueError("expected a JSON object")
+    settings = {}
+    for name, keyword in (("max_queue", "maxQueue"), ("retry_after", "retryAfter")):
+        if name in config:
+            if not isinstance(config[name], int) or config[name] < 0:
+                raise ValueError(f"{name} must be a whole number")
+            settings[keyword] = config[name]
+    if "route_limits" in config:
+        if not isinstance(config["route_limits"], dict):
+            raise ValueError("route_limits must be an object")
+        settings["routeLimits"] = checkRouteLimits(config["route_limits"])
+    unknown = set(config) - {"max_queue", "route_limits", "retry_after"}
+    if unknown:
+        raise ValueError(f"unknown setting {sorted(unknown)[0]!r}")
+    return settings
+
+admission = Admission()
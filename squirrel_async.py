@@ -0,0 +1,244 @@
+import asyncio
+import io
+from http import HTTPStatus
+import select
+import socket
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+import squirrel_admission
+from squirrel_admission import admission
+from squirrel_server import RecyclingServer
+
+# The asyncio engine (--engine asyncio). Connections live on one event loop, so
+# an idle keep-alive client or a slow reader costs a coroutine, not a thread.
+#
+# The loop reads a whole request (head and Content-Length body), then runs the
+# very same SquirrelServerHandler on a small executor against those bytes. Only
+# the handler's database and JSON work ever runs on a thread; its response is
+# handed back to the loop to write. Both engines run the same route code, so
+# they answer with the same statuses, headers and bodies.
+
+# a request head bigger than this is answered 414 or 431 and the connection closed
+MAX_HEAD_BYTES = 64 * 1024
+# a handler thread hands its output to the loop once this much has built up,
+# and waits for the client to take it before writing more
+WRITE_HIGH_WATER = 64 * 1024
+# how often the loop checks for a retire requested by a signal, like serve_forever's poll interval
+POLL_INTERVAL = 0.5
+
+# the handler's wfile: collects what it writes on its thread and passes it to the loop
+class LoopWriter:
+
+    def __init__(self, loop, writer):
+        self.loop = loop
+        self.writer = writer
+        self.buffer = []
+        self.size = 0
+
+    def write(self, data):
+        self.buffer.append(bytes(data))
+        self.size += len(data)
+        if self.size >= WRITE_HIGH_WATER:
+            asyncio.run_coroutine_threadsafe(self.send(self.take()), self.loop).result()
+        return len(data)
+
+    def flush(self):
+        if self.buffer:
+            self.loop.call_soon_threadsafe(self.writer.write, self.take())
+
+    def take(self):
+        data = b"".join(self.buffer)
+        self.buffer = []
+        self.size = 0
+        return data
+
+    async def send(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+# Same constructor and lifecycle as ThreadPoolHTTPServer: it binds (or takes
+# `sock`) when built, serve_forever() blocks, shutdown() from another thread
+# stops it, and server_close() releases the socket and the executor.
+class AsyncHTTPServer(RecyclingServer):
+
+    def __init__(self, address, handlerClass, workers=8, backlog=64, idleTimeout=15, sock=None, maxRequests=0):
+        self.RequestHandlerClass = handlerClass
+        self.idleTimeout = idleTimeout
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="squirrel-async")
+        self.initRecycling(maxRequests)
+        self.socket = sock if sock is not None else socket.create_server(address, backlog=backlog)
+        self.server_address = self.socket.getsockname()
+        # task -> True while it is serving a request, False while it waits for one
+        self.connections = {}
+        self.loop = None
+        self.stopRequested = None
+        self.shutdownRequested = False
+        self.stateLock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def serve_forever(self):
+        self.stopped.clear()
+        try:
+            asyncio.run(self.serve())
+        finally:
+            self.stopped.set()
+
+    async def serve(self):
+        with self.stateLock:
+            self.loop = asyncio.get_running_loop()
+            self.stopRequested = asyncio.Event()
+            if self.shutdownRequested:
+                self.stopRequested.set()
+        try:
+            # closing the server closes the socket it was given; a copy leaves ours
+            # listening for drain() and server_close()
+            server = await asyncio.start_server(self.handleConnection, sock=self.socket.dup(), limit=MAX_HEAD_BYTES)
+            while not self.stopRequested.is_set():
+                self.retireIfRequested()
+                admission.reloadIfChanged()
+                try:
+                    await asyncio.wait_for(self.stopRequested.wait(), POLL_INTERVAL)
+                except TimeoutError:
+                    pass
+            server.close()
+            if self.drainOnStop:
+                await self.drain()
+            # idle connections are waiting for a request that isn't coming; busy ones get to finish
+            for task, busy in list(self.connections.items()):
+                if not busy:
+                    task.cancel()
+            await asyncio.gather(*self.connections, return_exceptions=True)
+        finally:
+            with self.stateLock:
+                self.loop = None
+                self.shutdownRequested = False
+
+    # Connections queued on the socket since the loop stopped accepting; each
+    # gets its first request answered (see handleConnection).
+    async def drain(self):
+        while select.select([self.socket], [], [], 0)[0]:
+            try:
+                request, _ = self.socket.accept()
+            except BlockingIOError:
+                break
+            reader, writer = await asyncio.open_connection(sock=request, limit=MAX_HEAD_BYTES)
+            asyncio.create_task(self.handleConnection(reader, writer))
+        # let each one start and add itself to self.connections
+        await asyncio.sleep(0)
+
+    # like socketserver's: blocks until serve_forever() has returned
+    def shutdown(self):
+        with self.stateLock:
+            self.shutdownRequested = True
+            if self.loop is not None:
+                self.loop.call_soon_threadsafe(self.stopRequested.set)
+        self.stopped.wait()
+
+    def server_close(self):
+        self.socket.close()
+        self.executor.shutdown(wait=True)
+
+    async def handleConnection(self, reader, writer):
+        task = asyncio.current_task()
+        # one drained while the server stops is not idle: its request is on the way
+        drained = self.stopRequested.is_set()
+        self.connections[task] = drained
+        # headers and body go out in separate writes; without this, Nagle holds the
+        # body back until the client's delayed ACK arrives
+        writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        clientAddress = writer.get_extra_info("peername")
+        try:
+            while drained or not self.stopRequested.is_set():
+                drained = False
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.idleTimeout)
+                except asyncio.LimitOverrunError:
+                    # readuntil leaves what it read buffered, so the answer can tell which part was too long
+                    head = await reader.read(MAX_HEAD_BYTES + 1)
+                    await self.loop.run_in_executor(self.executor, self.rejectHead, head, writer, clientAddress)
+                    await writer.drain()
+                    break
+                self.connections[task] = True
+                head, length, expectsContinue = readHead(head)
+                if expectsContinue:
+                    writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+                body = await asyncio.wait_for(reader.readexactly(length), self.idleTimeout) if length else b""
+                # the whole request has been read, so this 503 leaves nothing unread behind
+                if not admission.enqueue():
+                    writer.write(squirrel_admission.refusal(admission.retryAfter))
+                    await writer.drain()
+                    break
+                keepAlive = await self.loop.run_in_executor(
+                    self.executor, self.runHandler, head + body, writer, clientAddress)
+                await writer.drain()
+                self.connections[task] = False
+                if not keepAlive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, TimeoutError):
+            pass
+        finally:
+            del self.connections[task]
+            writer.close()
+
+    # Runs on the executor: one request through the handler, whose rfile holds
+    # exactly that request. The handler is built without __init__, which would
+    # set up a socket and loop over every request on the connection; here the
+    # loop above does that. Returns whether to keep the connection open.
+    def runHandler(self, data, writer, clientAddress):
+        admission.dequeue()
+        handler = self.newHandler(data, writer, clientAddress)
+        try:
+            handler.handle_one_request()
+        except Exception:
+            # what socketserver's handle_error does for the threaded engine
+            traceback.print_exc()
+            handler.close_connection = True
+        finally:
+            handler.wfile.flush()
+        return not handler.close_connection
+
+    # Runs on the executor: the error the threads engine sends for a head it
+    # won't read, 414 when the request line alone is too long and 431 when the
+    # headers are. Nothing in the head is parsed, just as there.
+    def rejectHead(self, head, writer, clientAddress):
+        handler = self.newHandler(head, writer, clientAddress)
+        handler.requestline = ""
+        handler.request_version = ""
+        handler.command = ""
+        try:
+            if b"\n" not in head:
+                handler.send_error(HTTPStatus.REQUEST_URI_TOO_LONG)
+            else:
+                handler.send_error(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE, "Headers too large")
+        finally:
+            handler.wfile.flush()
+
+    def newHandler(self, data, writer, clientAddress):
+        handler = self.RequestHandlerClass.__new__(self.RequestHandlerClass)
+        handler.request = None
+        handler.client_address = clientAddress
+        handler.server = self
+        handler.rfile = io.BytesIO(data)
+        handler.wfile = LoopWriter(self.loop, writer)
+        handler.close_connection = True
+        return handler
+
+# (head, Content-Length, whether the client waits for 100 Continue) from a
+# request head. The loop answers the Expect itself, so the handler gets the head
+# without it; a malformed length is left for the handler to reject.
+def readHead(head):
+    length = 0
+    expectsContinue = False
+    lines = head.split(b"\r\n")
+    kept = lines[:1]
+    for line in lines[1:]:
+        name, _, value = line.partition(b":")
+        name = name.strip().lower()
+        if name == b"content-length" and value.strip().isdigit():
+            length = int(value)
+        elif name == b"expect" and value.strip().lower() == b"100-continue":
+            expectsContinue = True
+            continue
+        kept.append(line)
+    return b"\r\n".join(kept), length, expectsContinue
@@ -0,0 +1,275 @@
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Load generator for squirrel_server. For every table size it seeds a temporary
+# database, starts the server on it in a child process, and drives it with a
+# mixed workload at each concurrency level. The report is JSON on stdout (or
+# --output) so two runs can be diffed.
+#
+#   python squirrel_bench.py --rows 1000,100000 --concurrency 1,8,32 --duration 10
+#   python squirrel_bench.py --trace trace.jsonl --concurrency 16
+#
+# A trace has one request per line: {"method": "GET", "path": "/squirrels/4"}
+# with an optional form-encoded "body" for POST and PUT.
+
+ENDPOINTS = ("list", "retrieve", "create", "update", "delete")
+DEFAULT_MIX = {"list": 5, "retrieve": 75, "create": 8, "update": 8, "delete": 4}
+SIZES = ("small", "medium", "large")
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "squirrel_server.py")
+
+def seedDatabase(path, rows, batch=10000):
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE squirrels (id INTEGER PRIMARY KEY, name TEXT, size TEXT)")
+    for start in range(0, rows, batch):
+        data = ((f"squirrel-{i}", SIZES[i % 3]) for i in range(start, min(start + batch, rows)))
+        connection.executemany("INSERT INTO squirrels (name, size) VALUES (?, ?)", data)
+    connection.commit()
+    connection.close()
+
+# which endpoint a request exercises, for grouping its latency
+def classify(method, path):
+    parts = path.split("?")[0].strip("/").split("/")
+    hasId = len(parts) > 1 and parts[1] != ""
+    if method == "GET":
+        return "retrieve" if hasId else "list"
+    if method == "POST":
+        return "create"
+    if method == "PUT":
+        return "update"
+    if method == "DELETE":
+        return "delete"
+    return method.lower()
+
+def loadTrace(path):
+    requests = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                request = json.loads(line)
+                requests.append({"method": request["method"].upper(), "path": request["path"],
+                                 "body": request.get("body")})
+    return requests
+
+# "list=5,retrieve=75" -> {"list": 5, "retrieve": 75}
+def parseMix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name not in ENDPOINTS:
+            raise ValueError(f"unknown endpoint {name!r}, expected one of {', '.join(ENDPOINTS)}")
+        mix[name] = float(weight)
+    return mix
+
+# endless random requests against ids 1..rows, weighted by mix
+def syntheticRequests(rows, mix, seed=None):
+    rng = random.Random(seed)
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    highest = max(rows, 1)
+    while True:
+        endpoint = rng.choices(names, weights)[0]
+        squirrelId = rng.randint(1, highest)
+        body = f"name=bench-{rng.randint(0, 1 << 30)}&size={rng.choice(SIZES)}"
+        if endpoint == "list":
+            # a full listing of a million rows would measure nothing but the list, so read a page
+            yield {"method": "GET", "path": f"/squirrels?limit=100&after_id={rng.randint(0, highest)}", "body": None}
+        elif endpoint == "retrieve":
+            yield {"method": "GET", "path": f"/squirrels/{squirrelId}", "body": None}
+        elif endpoint == "create":
+            yield {"method": "POST", "path": "/squirrels", "body": body}
+        elif endpoint == "update":
+            yield {"method": "PUT", "path": f"/squirrels/{squirrelId}", "body": body}
+        else:
+            yield {"method": "DELETE", "path": f"/squirrels/{squirrelId}", "body": None}
+
+# nearest-rank percentile of an already sorted list
+def percentile(values, p):
+    if not values:
+        return None
+    rank = max(int(-(-p * len(values) // 100)), 1)
+    return values[rank - 1]
+
+def freePort():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+# squirrel_server.py in a child process, so client threads and server don't share a GIL
+class ServerProcess:
+
+    # errorLog: a file to take the server's stderr, which is otherwise discarded
+    def __init__(self, dbPath, serverArgs=(), startTimeout=15.0, errorLog=None):
+        self.dbPath = dbPath
+        self.port = freePort()
+        self.serverArgs = list(serverArgs)
+        self.startTimeout = startTimeout
+        self.errorLog = errorLog
+        self.process = None
+
+    def __enter__(self):
+        command = [sys.executable, SERVER_SCRIPT, "--port", str(self.port), "--db", self.dbPath] + self.serverArgs
+        self.process = subprocess.Popen(command, stdout=subprocess.DEVNULL,
+                                        stderr=self.errorLog or subprocess.DEVNULL)
+        deadline = time.monotonic() + self.startTimeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"squirrel_server exited with status {self.process.returncode}")
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=0.2).close()
+                return self
+            except OSError:
+                time.sleep(0.05)
+        self.__exit__()
+        raise RuntimeError(f"squirrel_server did not start within {self.startTimeout}s")
+
+    def __exit__(self, *exc):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+# Sends requests from `source` on `concurrency` keep-alive connections until the
+# source runs dry, `duration` seconds pass, or `maxRequests` have been sent.
+# Returns {endpoint: [(seconds, status), ...]} and the wall time taken.
+def runLoad(port, source, concurrency, duration, maxRequests=None):
+    samples = {}
+    lock = threading.Lock()
+    sent = [0]
+    deadline = time.monotonic() + duration
+
+    def nextRequest():
+        with lock:
+            if time.monotonic() >= deadline or (maxRequests is not None and sent[0] >= maxRequests):
+                return None
+            sent[0] += 1
+            return next(source, None)
+
+    def worker():
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        local = []
+        while True:
+            request = nextRequest()
+            if request is None:
+                break
+            headers = {"Content-Type": "application/x-www-form-urlencoded"} if request["body"] else {}
+            began = time.perf_counter()
+            try:
+                conn.request(request["method"], request["path"], body=request["body"], headers=headers)
+                response = conn.getresponse()
+                response.read()
+                status = response.status
+            except (OSError, http.client.HTTPException):
+                status = 0
+                conn.close()
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+            local.append((classify(request["method"], request["path"]), time.perf_counter() - began, status))
+        conn.close()
+        with lock:
+            for endpoint, seconds, status in local:
+                samples.setdefault(endpoint, []).append((seconds, status))
+
+    began = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, time.perf_counter() - began
+
+# requests per second and latency percentiles (milliseconds) for one group of samples
+def summarize(samples, elapsed):
+    latencies = sorted(seconds * 1000 for seconds, _ in samples)
+    statuses = {}
+    for _, status in samples:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        "requests": len(samples),
+        # 404s are expected once random ids have been deleted; only 5xx and dropped connections count
+        "errors": sum(1 for _, status in samples if status == 0 or status >= 500),
+        "rps": round(len(samples) / elapsed, 2) if elapsed else None,
+        "p50_ms": roundOrNone(percentile(latencies, 50)),
+        "p95_ms": roundOrNone(percentile(latencies, 95)),
+        "p99_ms": roundOrNone(percentile(latencies, 99)),
+        "max_ms": roundOrNone(latencies[-1] if latencies else None),
+        "statuses": statuses,
+    }
+
+def roundOrNone(value):
+    return None if value is None else round(value, 3)
+
+def benchmark(sizes, concurrencyLevels, duration, mix=None, trace=None, serverArgs=(), maxRequests=None, seed=None):
+    runs = []
+    for rows in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            dbPath = os.path.join(tmp, "bench.db")
+            seedDatabase(dbPath, rows)
+            with ServerProcess(dbPath, serverArgs) as server:
+                for concurrency in concurrencyLevels:
+                    source = iter(trace) if trace is not None else syntheticRequests(rows, mix or DEFAULT_MIX, seed)
+                    samples, elapsed = runLoad(server.port, source, concurrency, duration, maxRequests)
+                    everything = [sample for group in samples.values() for sample in group]
+                    runs.append({
+                        "rows": rows,
+                        "concurrency": concurrency,
+                        "elapsed_s": round(elapsed, 3),
+                        "total": summarize(everything, elapsed),
+                        "endpoints": {endpoint: summarize(samples[endpoint], elapsed) for endpoint in sorted(samples)},
+                    })
+    return {
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "config": {"sizes": list(sizes), "concurrency": list(concurrencyLevels), "duration_s": duration,
+                   "mix": None if trace is not None else (mix or DEFAULT_MIX), "trace": trace is not None,
+                   "server_args": list(serverArgs)},
+        "runs": runs,
+    }
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark squirrel_server under mixed load.")
+    parser.add_argument("--rows", default="1000", help="comma separated table sizes to seed, e.g. 1000,100000,1000000")
+    parser.add_argument("--concurrency", default="1,8,32", help="comma separated numbers of client connections")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per concurrency level")
+    parser.add_argument("--requests", type=int, default=None, help="stop a level after this many requests")
+    parser.add_argument("--mix", default=None, help="endpoint weights, e.g. list=5,retrieve=75,create=8,update=8,delete=4")
+    parser.add_argument("--trace", default=None, help="replay this JSON-lines trace instead of random requests")
+    parser.add_argument("--seed", type=int, default=None, help="seed for the random workload")
+    parser.add_argument("--server-arg", action="append", default=[], dest="server_args",
+                        help="extra flag passed to squirrel_server.py (repeatable), e.g. --server-arg=--workers=16")
+    parser.add_argument("--output", default=None, help="write the JSON report here instead of stdout")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parseArgs(argv)
+    report = benchmark(
+        [int(n) for n in args.rows.split(",")],
+        [int(n) for n in args.concurrency.split(",")],
+        args.duration,
+        mix=parseMix(args.mix) if args.mix else None,
+        trace=loadTrace(args.trace) if args.trace else None,
+        serverArgs=args.server_args,
+        maxRequests=args.requests,
+        seed=args.seed,
+    )
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    main()
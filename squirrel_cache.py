@@ -0,0 +1,130 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from squirrel_db import replicaId
+
+DEFAULT_MAX_ENTRIES = 1024
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+# a strong validator: two bodies share an ETag only if they are byte-for-byte equal
+def makeEtag(body):
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+# If-None-Match uses the weak comparison, so W/"x" matches "x"
+def etagMatches(ifNoneMatch, etag):
+    if not ifNoneMatch:
+        return False
+    for candidate in ifNoneMatch.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+class CacheEntry:
+
+    __slots__ = ("body", "etag", "headers")
+
+    # etag: one derived from another representation's, instead of hashing this body
+    def __init__(self, body, headers=None, etag=None):
+        self.body = body
+        self.etag = etag or makeEtag(body)
+        self.headers = headers or {}
+
+# Rendered GET responses keyed by resource, evicted least recently used first
+# once either limit is passed. Keys are ("list",), ("page", limit, afterId) and
+# ("item", id), with the media type appended for anything but JSON and "gzip"
+# appended to the compressed copy of a body; writes drop exactly the keys they
+# could have changed.
+#
+# Under the pre-forked server every worker has its own cache. `shared` is then a
+# multiprocessing.Value counting writes in all of them: a worker that sees it
+# move past the count it last knew drops everything, since it can't tell which
+# keys another process changed.
+class ResponseCache:
+
+    def __init__(self, maxEntries=DEFAULT_MAX_ENTRIES, maxBytes=DEFAULT_MAX_BYTES, shared=None):
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.entries = OrderedDict()
+        self.size = 0
+        # bumped by every invalidation, so a read that started before a write
+        # cannot store what it read after the write has landed
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.shared = shared
+        self.sharedSeen = shared.value if shared is not None else 0
+
+    def get(self, key):
+        with self.lock:
+            self.syncShared()
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    # generation is the value read before the response was rendered
+    def put(self, key, entry, generation):
+        if len(entry.body) > self.maxBytes:
+            return
+        with self.lock:
+            self.syncShared()
+            if generation != self.generation:
+                return
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old.body)
+            self.entries[key] = entry
+            self.size += len(entry.body)
+            while len(self.entries) > self.maxEntries or self.size > self.maxBytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted.body)
+
+    # a create changes every listing but no single squirrel
+    def invalidateLists(self):
+        self.invalidateItems([])
+
+    # an update or delete changes those squirrels and every listing
+    def invalidateItems(self, squirrelIds):
+        with self.lock:
+            self.generation += 1
+            ids = {itemKey(squirrelId) for squirrelId in squirrelIds}
+            # an item has an entry per encoding: ("item", id) and ("item", id, encoding)
+            for key in [key for key in self.entries if key[0] != "item" or key[1] in ids]:
+                self.size -= len(self.entries.pop(key).body)
+            if self.shared is not None:
+                with self.shared.get_lock():
+                    self.syncShared()
+                    self.shared.value += 1
+                    self.sharedSeen = self.shared.value
+
+    def clear(self):
+        with self.lock:
+            self.dropAll()
+
+    # called with self.lock held
+    def syncShared(self):
+        if self.shared is not None and self.shared.value != self.sharedSeen:
+            self.sharedSeen = self.shared.value
+            self.dropAll()
+
+    def dropAll(self):
+        self.generation += 1
+        self.entries.clear()
+        self.size = 0
+
+# "/squirrels/7", "/squirrels/07", "/squirrels/7.0" and an int 7 all name the
+# same squirrel, since sqlite reads them all as 7 (see squirrel_db.replicaId)
+def itemKey(squirrelId):
+    return replicaId(squirrelId)
+
+cache = None
+
+def configureCache(maxEntries=DEFAULT_MAX_ENTRIES, maxBytes=DEFAULT_MAX_BYTES, shared=None):
+    global cache
+    cache = ResponseCache(maxEntries, maxBytes, shared) if maxEntries > 0 and maxBytes > 0 else None
+    return cache
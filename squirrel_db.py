@@ -1,4 +1,20 @@
+import json
+import math
+import queue
+import re
 import sqlite3
+import threading
+import time
+import traceback
+from bisect import bisect_right, insort
+from itertools import groupby
+from squirrel_metrics import metrics
+
+DEFAULT_DB_PATH = "squirrel_db.db"
+DEFAULT_POOL_SIZE = 5
+
+# how many ids go into one "WHERE id IN (...)", well under sqlite's variable limit
+ID_CHUNK_SIZE = 500
 
 # build the data into dictionaries instead of plain tuples
 def dict_factory(cursor, row):
@@ -7,36 +23,1244 @@ def dict_factory(cursor, row):
         d[col[0]] = row[idx]
     return d
 
-class SquirrelDB:
+# dict_factory that works out the column names once per statement instead of
+# once per row. All rows of a statement share one description tuple, so the
+# names are only rebuilt when that tuple changes. Give each connection its own.
+class DictRowFactory:
+
+    __slots__ = ("description", "names")
 
     def __init__(self):
-        self.connection = sqlite3.connect("squirrel_db.db")
-        self.connection.row_factory = dict_factory
+        self.description = None
+        self.names = ()
+
+    def __call__(self, cursor, row):
+        description = cursor.description
+        if description is not self.description:
+            self.description = description
+            self.names = tuple(col[0] for col in description)
+        return dict(zip(self.names, row))
+
+# Times every statement into squirrel_sql_duration_seconds, labelled by its
+# first word (SELECT, INSERT, ...) so the label set stays small. sqlite does
+# most of a query's work as its rows are stepped through, so the fetches count
+# too: a statement is observed once, when the next one starts, its rows run
+# out or the cursor goes away.
+class TimedCursor(sqlite3.Cursor):
+
+    verb = None
+    spent = 0.0
+
+    def execute(self, sql, parameters=()):
+        self.finishTiming()
+        self.verb = statementVerb(sql)
+        try:
+            return self.timed(super().execute, sql, parameters)
+        finally:
+            # nothing to fetch, so nothing more to time
+            if self.description is None:
+                self.finishTiming()
+
+    def executemany(self, sql, parameters):
+        self.finishTiming()
+        self.verb = statementVerb(sql)
+        try:
+            return self.timed(super().executemany, sql, parameters)
+        finally:
+            self.finishTiming()
+
+    def fetchone(self):
+        row = self.timed(super().fetchone)
+        if row is None:
+            self.finishTiming()
+        return row
+
+    def fetchmany(self, size=None):
+        return self.timed(super().fetchmany, self.arraysize if size is None else size)
+
+    def fetchall(self):
+        try:
+            return self.timed(super().fetchall)
+        finally:
+            self.finishTiming()
+
+    def __next__(self):
+        try:
+            return self.timed(super().__next__)
+        except StopIteration:
+            self.finishTiming()
+            raise
+
+    def close(self):
+        self.finishTiming()
+        super().close()
+
+    def __del__(self):
+        self.finishTiming()
+
+    def timed(self, call, *args):
+        started = time.perf_counter()
+        try:
+            return call(*args)
+        finally:
+            self.spent += time.perf_counter() - started
+
+    def finishTiming(self):
+        if self.verb is not None:
+            metrics.observe("squirrel_sql_duration_seconds", (("statement", self.verb),), self.spent)
+            self.verb = None
+            self.spent = 0.0
+
+def statementVerb(sql):
+    return sql.lstrip().split(None, 1)[0].upper() if sql.strip() else "EMPTY"
+
+# A connection whose cursors are TimedCursors, including the ones its own
+# execute shortcuts make (sqlite3's versions would skip the cursor override)
+class TimedConnection(sqlite3.Connection):
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, parameters):
+        return self.cursor().executemany(sql, parameters)
+
+# A compact squirrel for callers that want attributes rather than a dict
+class SquirrelRow:
+
+    __slots__ = ("id", "name", "size")
+
+    def __init__(self, id, name, size):
+        self.id = id
+        self.name = name
+        self.size = size
+
+    def __eq__(self, other):
+        return isinstance(other, SquirrelRow) and (self.id, self.name, self.size) == (other.id, other.name, other.size)
+
+    def __repr__(self):
+        return f"SquirrelRow(id={self.id!r}, name={self.name!r}, size={self.size!r})"
+
+    def asDict(self):
+        return {"id": self.id, "name": self.name, "size": self.size}
+
+# lets sqlite build the JSON text itself, so no Python dict is made per row
+SQUIRREL_JSON = "json_object('id', id, 'name', name, 'size', size)"
+# the same, for queries that join squirrels_fts, which has a name column too
+SQUIRREL_JSON_QUALIFIED = "json_object('id', squirrels.id, 'name', squirrels.name, 'size', squirrels.size)"
+
+# Builds a findSquirrels query: the rows matching every filter given, after
+# `afterId`, in id order. A text search drives the query from squirrels_fts,
+# which hands back rowids in order, so a page stops as soon as it is full. The
+# other filters are narrower than size, so a + keeps sqlite off the size index
+# when one of them is there.
+def findQuery(columns, size=None, namePrefix=None, text=None, limit=None, afterId=0):
+    where = []
+    data = []
+    if text is not None:
+        source = "squirrels_fts JOIN squirrels ON squirrels.id = squirrels_fts.rowid"
+        idColumn = "squirrels_fts.rowid"
+        where.append("squirrels_fts MATCH ?")
+        data.append(ftsQuery(text))
+    else:
+        source = "squirrels"
+        idColumn = "squirrels.id"
+    if namePrefix is not None:
+        nameColumn = "+squirrels.name" if text is not None else "squirrels.name"
+        where.append(f"{nameColumn} >= ?")
+        data.append(namePrefix)
+        end = prefixEnd(namePrefix)
+        if end is not None:
+            where.append(f"{nameColumn} < ?")
+            data.append(end)
+    if size is not None:
+        where.append("+squirrels.size = ?" if text is not None or namePrefix is not None else "squirrels.size = ?")
+        data.append(size)
+    where.append(f"{idColumn} > ?")
+    data.append(afterId)
+    sql = f"SELECT {columns} FROM {source} WHERE {' AND '.join(where)} ORDER BY {idColumn}"
+    if limit is not None:
+        sql += " LIMIT ?"
+        data.append(limit)
+    return sql, data
+
+# every word must appear; each is quoted so nothing in it is read as FTS5 syntax
+def ftsQuery(text):
+    return " ".join('"' + word.replace('"', '""') + '"' for word in text.split())
+
+# the first string after every string starting with `prefix`, or None if there is none
+def prefixEnd(prefix):
+    while prefix and prefix[-1] == chr(0x10FFFF):
+        prefix = prefix[:-1]
+    if not prefix:
+        return None
+    following = ord(prefix[-1]) + 1
+    # a lone surrogate can't be encoded for sqlite, and no string sorts between them anyway
+    if 0xD800 <= following <= 0xDFFF:
+        following = 0xE000
+    return prefix[:-1] + chr(following)
+
+# A fixed number of sqlite connections shared by every thread. Connections are
+# created lazily up to `size`; after that callers wait for one to be returned.
+class ConnectionPool:
+
+    def __init__(self, path=DEFAULT_DB_PATH, size=DEFAULT_POOL_SIZE, timeout=10.0, checkAfter=30.0):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        # connections idle for longer than this are pinged before being handed out
+        self.checkAfter = checkAfter
+        self.idle = queue.LifoQueue()
+        self.created = 0
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def connect(self):
+        # a pooled connection moves between threads, but only one uses it at a time
+        connection = sqlite3.connect(self.path, check_same_thread=False, factory=TimedConnection)
+        connection.row_factory = DictRowFactory()
+        return connection
+
+    def acquire(self, timeout=None):
+        if self.closed:
+            raise sqlite3.ProgrammingError("Cannot acquire from a closed connection pool.")
+        try:
+            connection, lastUsed = self.idle.get_nowait()
+        except queue.Empty:
+            connection = self.grow()
+            if connection is not None:
+                return connection
+            try:
+                connection, lastUsed = self.idle.get(timeout=self.timeout if timeout is None else timeout)
+            except queue.Empty:
+                raise TimeoutError(f"no database connection free after {self.timeout}s") from None
+        if time.monotonic() - lastUsed > self.checkAfter and not self.isHealthy(connection):
+            self.discard(connection)
+            return self.grow() or self.acquire(timeout)
+        return connection
+
+    # open a new connection if we are still under the cap, otherwise None
+    def grow(self):
+        with self.lock:
+            if self.created >= self.size:
+                return None
+            self.created += 1
+        try:
+            return self.connect()
+        except Exception:
+            with self.lock:
+                self.created -= 1
+            raise
+
+    def release(self, connection):
+        if self.closed:
+            connection.close()
+            return
+        try:
+            # never hand the next caller someone else's half-finished transaction
+            if connection.in_transaction:
+                connection.rollback()
+        except sqlite3.Error:
+            self.discard(connection)
+            return
+        self.idle.put((connection, time.monotonic()))
+
+    def discard(self, connection):
+        try:
+            connection.close()
+        except sqlite3.Error:
+            pass
+        with self.lock:
+            self.created -= 1
+
+    def isHealthy(self, connection):
+        try:
+            connection.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    # ping every idle connection now and drop the ones that fail; returns how many are healthy
+    def healthCheck(self):
+        checked = []
+        while True:
+            try:
+                checked.append(self.idle.get_nowait()[0])
+            except queue.Empty:
+                break
+        healthy = 0
+        for connection in checked:
+            if self.isHealthy(connection):
+                healthy += 1
+                self.idle.put((connection, time.monotonic()))
+            else:
+                self.discard(connection)
+        return healthy
+
+    # close idle connections now; borrowed ones are closed when they come back
+    def close(self):
+        self.closed = True
+        while True:
+            try:
+                connection, _ = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            connection.close()
+
+# synchronous= setting for each durability level. In WAL mode "full" syncs the
+# log on every commit; "normal" only syncs at checkpoints, so a power cut can
+# lose the last few commits (never corrupt the file); "off" leaves it to the OS.
+DURABILITY_LEVELS = {"full": "FULL", "normal": "NORMAL", "off": "OFF"}
+
+class WriteJob:
+
+    __slots__ = ("sql", "data", "rows", "error", "done")
+
+    def __init__(self, sql, data):
+        self.sql = sql
+        self.data = data
+        self.rows = None
+        self.error = None
+        self.done = threading.Event()
+
+# One writer thread with its own WAL connection. Writes that queue up while a
+# commit is in flight (plus whatever arrives within maxDelay) are committed
+# together, so N concurrent writers share one fsync instead of queueing for N.
+# submit() only returns once the batch holding its statement has committed.
+class GroupCommitter:
+
+    def __init__(self, path=DEFAULT_DB_PATH, maxDelay=0.0, maxBatch=64, durability="full"):
+        self.maxDelay = maxDelay
+        self.maxBatch = maxBatch
+        # autocommit mode: BEGIN and COMMIT below are the only transaction control
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, factory=TimedConnection)
+        self.connection.row_factory = DictRowFactory()
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(f"PRAGMA synchronous={DURABILITY_LEVELS[durability]}")
+        self.jobs = queue.Queue()
+        self.closed = False
+        # held while checking closed and queueing, so nothing is queued behind close()'s sentinel
+        self.closeLock = threading.Lock()
+        self.commits = 0
+        self.thread = threading.Thread(target=self.run, name="squirrel-group-commit", daemon=True)
+        self.thread.start()
+
+    # runs one statement in the next group commit and returns the rows it produced
+    def submit(self, sql, data):
+        job = WriteJob(sql, data)
+        with self.closeLock:
+            if self.closed:
+                raise sqlite3.ProgrammingError("Cannot write through a closed group committer.")
+            self.jobs.put(job)
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.rows
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            job = self.jobs.get()
+            if job is None:
+                break
+            batch = [job]
+            deadline = time.monotonic() + self.maxDelay
+            while len(batch) < self.maxBatch:
+                try:
+                    if self.maxDelay:
+                        job = self.jobs.get(timeout=max(deadline - time.monotonic(), 0))
+                    else:
+                        job = self.jobs.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    stopping = True
+                    break
+                batch.append(job)
+            self.commitBatch(batch)
+        self.connection.close()
+
+    def commitBatch(self, batch):
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            for job in batch:
+                # a savepoint per statement, so one bad write fails alone
+                cursor.execute("SAVEPOINT job")
+                try:
+                    cursor.execute(job.sql, job.data)
+                    job.rows = cursor.fetchall()
+                    cursor.execute("RELEASE job")
+                except sqlite3.Error as e:
+                    cursor.execute("ROLLBACK TO job")
+                    cursor.execute("RELEASE job")
+                    job.error = e
+            cursor.execute("COMMIT")
+            self.commits += 1
+        except sqlite3.Error as e:
+            if self.connection.in_transaction:
+                self.connection.execute("ROLLBACK")
+            for job in batch:
+                job.rows = None
+                job.error = job.error or e
+        finally:
+            cursor.close()
+            for job in batch:
+                job.done.set()
+
+    # lets queued writes finish, then stops the writer thread
+    def close(self):
+        with self.closeLock:
+            if self.closed:
+                return
+            self.closed = True
+            self.jobs.put(None)
+        self.thread.join()
+
+# seconds since the epoch by sqlite's clock, so every writer's log rows agree
+LOG_NOW = "CAST(strftime('%s', 'now') AS INTEGER)"
+
+# What findSquirrels searches with, created by ensureSchema on databases that
+# lack them. squirrels_fts indexes the names without a copy of them (content=)
+# and the triggers keep it in step with every write, bulk ones included.
+SCHEMA = [
+    # size=? ORDER BY id walks this in order, so a page stops after `limit` rows
+    "CREATE INDEX IF NOT EXISTS squirrels_size ON squirrels (size, id)",
+    # a name prefix is a range on this
+    "CREATE INDEX IF NOT EXISTS squirrels_name ON squirrels (name)",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS squirrels_fts USING fts5(name, content='squirrels', content_rowid='id')",
+    """CREATE TRIGGER IF NOT EXISTS squirrels_fts_insert AFTER INSERT ON squirrels BEGIN
+        INSERT INTO squirrels_fts (rowid, name) VALUES (new.id, new.name);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS squirrels_fts_delete AFTER DELETE ON squirrels BEGIN
+        INSERT INTO squirrels_fts (squirrels_fts, rowid, name) VALUES ('delete', old.id, old.name);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS squirrels_fts_update AFTER UPDATE ON squirrels BEGIN
+        INSERT INTO squirrels_fts (squirrels_fts, rowid, name) VALUES ('delete', old.id, old.name);
+        INSERT INTO squirrels_fts (rowid, name) VALUES (new.id, new.name);
+    END""",
+    # one more for every row written, by anyone; see SquirrelReplica
+    "CREATE TABLE IF NOT EXISTS squirrels_changes (changes INTEGER NOT NULL)",
+    "INSERT INTO squirrels_changes (changes) SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM squirrels_changes)",
+    """CREATE TRIGGER IF NOT EXISTS squirrels_changes_insert AFTER INSERT ON squirrels BEGIN
+        UPDATE squirrels_changes SET changes = changes + 1;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS squirrels_changes_update AFTER UPDATE ON squirrels BEGIN
+        UPDATE squirrels_changes SET changes = changes + 1;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS squirrels_changes_delete AFTER DELETE ON squirrels BEGIN
+        UPDATE squirrels_changes SET changes = changes + 1;
+    END""",
+    # The change log behind GET /squirrels/changes, compacted as it is written:
+    # each squirrel only has its latest insert or update, or a tombstone once
+    # deleted, so reading it from seq 0 gives the whole table. AUTOINCREMENT
+    # never hands a seq out twice, even after the newest rows are pruned.
+    f"""CREATE TABLE IF NOT EXISTS squirrels_log (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        id INTEGER NOT NULL,
+        op TEXT NOT NULL,
+        name TEXT,
+        size TEXT,
+        at INTEGER NOT NULL DEFAULT ({LOG_NOW}))""",
+    "CREATE INDEX IF NOT EXISTS squirrels_log_id ON squirrels_log (id)",
+    "CREATE INDEX IF NOT EXISTS squirrels_log_tombstones ON squirrels_log (at) WHERE op = 'delete'",
+    # the newest seq ChangeLogPruner has dropped; see SquirrelDB.getChangeBounds
+    "CREATE TABLE IF NOT EXISTS squirrels_log_horizon (seq INTEGER NOT NULL)",
+    "INSERT INTO squirrels_log_horizon (seq) SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM squirrels_log_horizon)",
+    """CREATE TRIGGER IF NOT EXISTS squirrels_log_insert AFTER INSERT ON squirrels BEGIN
+        DELETE FROM squirrels_log WHERE id = new.id;
+        INSERT INTO squirrels_log (id, op, name, size) VALUES (new.id, 'insert', new.name, new.size);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS squirrels_log_update AFTER UPDATE ON squirrels BEGIN
+        DELETE FROM squirrels_log WHERE id IN (old.id, new.id);
+        INSERT INTO squirrels_log (id, op) SELECT old.id, 'delete' WHERE old.id != new.id;
+        INSERT INTO squirrels_log (id, op, name, size) VALUES (new.id, 'update', new.name, new.size);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS squirrels_log_delete AFTER DELETE ON squirrels BEGIN
+        DELETE FROM squirrels_log WHERE id = old.id;
+        INSERT INTO squirrels_log (id, op) VALUES (old.id, 'delete');
+    END""",
+]
+
+# Adds the indexes, search table, change log and triggers to a database that
+# has only the squirrels table, indexing and logging the rows already there.
+# Safe to run on every start, and from several processes at once: the first
+# one does the work.
+def ensureSchema(path=DEFAULT_DB_PATH):
+    connection = sqlite3.connect(path, isolation_level=None)
+    try:
+        connection.execute("BEGIN IMMEDIATE")
+        exists = connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'squirrels_fts'").fetchone()
+        logExists = connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'squirrels_log'").fetchone()
+        for statement in SCHEMA:
+            connection.execute(statement)
+        if not exists:
+            connection.execute("INSERT INTO squirrels_fts (squirrels_fts) VALUES ('rebuild')")
+        if not logExists:
+            connection.execute("INSERT INTO squirrels_log (id, op, name, size) "
+                               "SELECT id, 'insert', name, size FROM squirrels ORDER BY id")
+        connection.execute("COMMIT")
+    finally:
+        connection.close()
+
+# text sqlite reads as a number when comparing it with the INTEGER PRIMARY KEY
+NUMERIC_ID = re.compile(r"[ \t\n\v\f\r]*[+-]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][+-]?[0-9]+)?[ \t\n\v\f\r]*")
+
+# The whole squirrels table in memory, for --replica: ids in a sorted list and
+# {id: (name, size, JSON text)}, so every read SquirrelDB answers from here is a
+# bisect or a dict lookup, with the JSON rendered once per write, not per read.
+#
+# SquirrelDB applies its own writes once they commit. Anyone else's (another
+# process, or a script on the file) is caught by comparing squirrels_changes,
+# which triggers bump for every row written, with the count of rows this replica
+# has applied. A thread does that every checkInterval seconds and reloads when
+# they differ, then calls onReload. A reload reads the table without holding the
+# lock, so reads and our own writes carry on meanwhile.
+class SquirrelReplica:
+
+    def __init__(self, path=DEFAULT_DB_PATH, checkInterval=1.0):
+        self.path = path
+        self.checkInterval = checkInterval
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        # guards everything below; writes in flight are counted so a check never
+        # mistakes a committed but not yet applied write for someone else's
+        self.lock = threading.Condition()
+        self.pending = 0
+        self.ids = []
+        self.rows = {}
+        self.changes = 0
+        self.reloads = 0
+        # while a load reads: (upserts, deletes, changes) of each write it must apply on top
+        self.replay = None
+        self.onReload = None
+        # one load at a time on self.connection
+        self.loadLock = threading.Lock()
+        self.closed = threading.Event()
+        self.load()
+        self.thread = None
+        if checkInterval:
+            self.thread = threading.Thread(target=self.run, name="squirrel-replica", daemon=True)
+            self.thread.start()
+
+    # Reads the table again, holding the lock only to start. The read transaction
+    # takes its snapshot while none of our writes are in flight, and nothing
+    # after that is in it, so every write that finishes while the rows are read
+    # is replayed on top of them. With onlyIfChanged, reads nothing (returning
+    # False) when the file has seen no more writes than the replica has applied.
+    # None if our writes kept it from starting for `timeout` seconds.
+    def load(self, onlyIfChanged=False, timeout=None):
+        with self.loadLock:
+            with self.lock:
+                if not self.lock.wait_for(lambda: self.pending == 0, timeout):
+                    return None
+                self.connection.execute("BEGIN")
+                try:
+                    changes = self.connection.execute("SELECT changes FROM squirrels_changes").fetchone()[0]
+                except BaseException:
+                    self.connection.execute("COMMIT")
+                    raise
+                if onlyIfChanged and changes == self.changes:
+                    self.connection.execute("COMMIT")
+                    return False
+                self.replay = []
+            ids = []
+            rows = {}
+            try:
+                for squirrelId, name, size in self.connection.execute("SELECT id, name, size FROM squirrels ORDER BY id"):
+                    ids.append(squirrelId)
+                    rows[squirrelId] = (name, size, squirrelJson(squirrelId, name, size))
+            finally:
+                self.connection.execute("COMMIT")
+                with self.lock:
+                    replay, self.replay = self.replay, None
+            with self.lock:
+                for upserts, deletes, written in replay:
+                    applyWrite(ids, rows, upserts, deletes)
+                    changes += written
+                self.ids = ids
+                self.rows = rows
+                self.changes = changes
+            return True
+
+    def run(self):
+        while not self.closed.wait(self.checkInterval):
+            try:
+                self.check()
+            except Exception:
+                traceback.print_exc()
+
+    # True when the replica matches the file; otherwise it reloads and returns False.
+    # Gives up (returning None) if our own writes keep it from looking for `timeout` seconds.
+    def check(self, timeout=1.0):
+        loaded = self.load(onlyIfChanged=True, timeout=timeout)
+        if loaded is None:
+            return None
+        if not loaded:
+            return True
+        self.reloaded()
+        return False
+
+    # same as check(), but always reads the table again
+    def reload(self):
+        self.load()
+        self.reloaded()
+
+    def reloaded(self):
+        with self.lock:
+            self.reloads += 1
+        if self.onReload is not None:
+            self.onReload()
+
+    def close(self):
+        self.closed.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.connection.close()
+
+    # WRITES
+    # SquirrelDB calls beginWrite before a write and then either endWrite with
+    # what it changed, once that has committed, or abortWrite.
+
+    def beginWrite(self):
+        with self.lock:
+            self.pending += 1
+
+    # upserts: (id, name, size) rows now in the table; deletes: ids gone from it;
+    # changes: rows written, as squirrels_changes counts them
+    def endWrite(self, upserts=(), deletes=(), changes=0):
+        with self.lock:
+            applyWrite(self.ids, self.rows, upserts, deletes)
+            if self.replay is not None:
+                self.replay.append((upserts, deletes, changes))
+            self.changes += changes
+            self.pending -= 1
+            self.lock.notify_all()
+
+    def abortWrite(self):
+        with self.lock:
+            self.pending -= 1
+            self.lock.notify_all()
+
+    # READS
+    # The same results, and the same JSON text, as SquirrelDB's queries.
+
+    def getSquirrel(self, squirrelId):
+        squirrelId = replicaId(squirrelId)
+        row = self.rows.get(squirrelId)
+        return {"id": squirrelId, "name": row[0], "size": row[1]} if row else None
+
+    def getSquirrelJson(self, squirrelId):
+        row = self.rows.get(replicaId(squirrelId))
+        return row[2] if row else None
+
+    # (id, name, size, JSON text) for up to `limit` rows after afterId
+    def slice(self, afterId=0, limit=None):
+        with self.lock:
+            start = bisect_right(self.ids, afterId)
+            ids = self.ids[start:] if limit is None else self.ids[start:start + limit]
+            return [(squirrelId,) + self.rows[squirrelId] for squirrelId in ids]
+
+    def getSquirrelsPage(self, limit, afterId=0):
+        return [{"id": row[0], "name": row[1], "size": row[2]} for row in self.slice(afterId, limit)]
+
+    def getSquirrels(self):
+        return self.getSquirrelsPage(None)
+
+    def getSquirrelRows(self):
+        return [SquirrelRow(*row[:3]) for row in self.slice()]
+
+    def getSquirrelsJson(self):
+        return "[" + ",".join(row[3] for row in self.slice()) + "]"
+
+    # chunk by chunk, each one a fresh slice after the last id of the one before
+    def iterChunks(self, chunkSize, render):
+        afterId = 0
+        while True:
+            rows = self.slice(afterId, chunkSize)
+            if not rows:
+                break
+            yield [render(row) for row in rows]
+            afterId = rows[-1][0]
+
+    def iterSquirrels(self, chunkSize=500):
+        return self.iterChunks(chunkSize, lambda row: {"id": row[0], "name": row[1], "size": row[2]})
+
+    def iterSquirrelsJson(self, chunkSize=500):
+        return self.iterChunks(chunkSize, lambda row: row[3])
+
+# a write's upserts and deletes on a replica's sorted ids and {id: row}
+def applyWrite(ids, rows, upserts, deletes):
+    for squirrelId, name, size in upserts:
+        if squirrelId not in rows:
+            # new ids are nearly always the highest yet
+            if not ids or squirrelId > ids[-1]:
+                ids.append(squirrelId)
+            else:
+                insort(ids, squirrelId)
+        rows[squirrelId] = (name, size, squirrelJson(squirrelId, name, size))
+    for squirrelId in deletes:
+        if rows.pop(squirrelId, None) is not None:
+            del ids[bisect_right(ids, squirrelId) - 1]
+
+# byte for byte what SQUIRREL_JSON makes sqlite return
+def squirrelJson(squirrelId, name, size):
+    return json.dumps({"id": squirrelId, "name": name, "size": size}, ensure_ascii=False, separators=(",", ":"))
+
+# The key an id has in the replica; text that sqlite would not read as an
+# integer matches nothing. Like sqlite, "1.0" and "1e1" are integers because
+# nothing is lost turning them into one, and "1.5" isn't.
+def replicaId(squirrelId):
+    if not isinstance(squirrelId, str) or not NUMERIC_ID.fullmatch(squirrelId):
+        return squirrelId
+    try:
+        return int(squirrelId)
+    except ValueError:
+        number = float(squirrelId)
+    if math.isfinite(number) and int(number) == number:
+        return int(number)
+    return squirrelId
+
+# Wakes long polls on the change log (see squirrel_server's GET
+# /squirrels/changes) when this process commits a write. Writes from other
+# processes wake nobody, so pollers also look again now and then.
+class ChangeSignal:
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.generation = 0
+
+    def notify(self):
+        with self.condition:
+            self.generation += 1
+            self.condition.notify_all()
+
+    # read generation before looking at the log, then wait on it, and a commit in between still wakes you
+    def wait(self, generation, timeout):
+        with self.condition:
+            self.condition.wait_for(lambda: self.generation != generation, timeout)
+            return self.generation
+
+changeSignal = ChangeSignal()
+
+# Drops tombstones older than `retention` seconds from the change log every
+# `interval` seconds, on a connection of its own. Inserts and updates need no
+# pruning: the log only ever holds one row per squirrel that still exists.
+# Without `background` there is no thread, and a caller with a loop of its own
+# (the prefork master) calls pruneIfDue from it instead.
+class ChangeLogPruner:
+
+    def __init__(self, path=DEFAULT_DB_PATH, retention=7 * 24 * 3600, interval=60.0, background=True):
+        self.retention = retention
+        self.interval = interval
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.due = time.monotonic() + interval
+        self.closed = threading.Event()
+        self.thread = None
+        if background:
+            self.thread = threading.Thread(target=self.run, name="squirrel-log-pruner", daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while not self.closed.wait(self.interval):
+            self.tryPrune()
+
+    def pruneIfDue(self):
+        if time.monotonic() >= self.due:
+            self.tryPrune()
+
+    def tryPrune(self):
+        self.due = time.monotonic() + self.interval
+        try:
+            self.prune()
+        except sqlite3.Error:
+            traceback.print_exc()
+
+    # Returns how many tombstones went. The horizon moves up to the newest of
+    # them: a client that last saw an older seq may have missed one of them.
+    def prune(self):
+        cutoff = f"{LOG_NOW} - ?"
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            newest = self.connection.execute(
+                f"SELECT MAX(seq) FROM squirrels_log WHERE op = 'delete' AND at < {cutoff}", [self.retention]).fetchone()[0]
+            pruned = 0
+            if newest is not None:
+                pruned = self.connection.execute(
+                    f"DELETE FROM squirrels_log WHERE op = 'delete' AND at < {cutoff}", [self.retention]).rowcount
+                self.connection.execute("UPDATE squirrels_log_horizon SET seq = MAX(seq, ?)", [newest])
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+        return pruned
+
+    def close(self):
+        self.closed.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.connection.close()
+
+pool = None
+poolLock = threading.Lock()
+committer = None
+replica = None
+pruner = None
+
+def configurePool(path=DEFAULT_DB_PATH, size=DEFAULT_POOL_SIZE, **kwargs):
+    global pool
+    with poolLock:
+        if pool is not None:
+            pool.close()
+        pool = ConnectionPool(path, size, **kwargs)
+        return pool
+
+def getPool():
+    global pool
+    with poolLock:
+        if pool is None:
+            pool = ConnectionPool()
+        return pool
+
+def closePool():
+    global pool
+    with poolLock:
+        if pool is not None:
+            pool.close()
+            pool = None
+
+# route single-row writes through a GroupCommitter on the same database file
+def configureGroupCommit(path=DEFAULT_DB_PATH, **kwargs):
+    global committer
+    with poolLock:
+        if committer is not None:
+            committer.close()
+        committer = GroupCommitter(path, **kwargs)
+        return committer
+
+def closeGroupCommit():
+    global committer
+    with poolLock:
+        if committer is not None:
+            committer.close()
+            committer = None
+
+# serve SquirrelDB's plain reads from a SquirrelReplica of the same database file
+def configureReplica(path=DEFAULT_DB_PATH, **kwargs):
+    global replica
+    with poolLock:
+        if replica is not None:
+            replica.close()
+        replica = SquirrelReplica(path, **kwargs)
+        return replica
+
+def closeReplica():
+    global replica
+    with poolLock:
+        if replica is not None:
+            replica.close()
+            replica = None
+
+# prune the change log's tombstones of the same database file in the background
+def configureChangeLog(path=DEFAULT_DB_PATH, **kwargs):
+    global pruner
+    with poolLock:
+        if pruner is not None:
+            pruner.close()
+        pruner = ChangeLogPruner(path, **kwargs)
+        return pruner
+
+def closeChangeLog():
+    global pruner
+    with poolLock:
+        if pruner is not None:
+            pruner.close()
+            pruner = None
+
+class SquirrelDB:
+
+    connection = None
+
+    # borrows a connection for as long as this object is open; use it as a
+    # context manager (or call close()) to give the connection back
+    def __init__(self, pool=None):
+        self.pool = pool or getPool()
+        self.connection = self.pool.acquire()
         self.cursor = self.connection.cursor()
+        # what this connection's open transaction has changed, for the replica once it commits
+        self.replicaWrite = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.connection is not None:
+            # the pool rolls back whatever is left uncommitted
+            self.abortReplicaWrite()
+            self.cursor.close()
+            self.pool.release(self.connection)
+            self.connection = None
+
+    # With a replica configured (see configureReplica) the plain reads below never
+    # reach sqlite; findSquirrels and the bulk writes' lookups still do.
 
     def getSquirrels(self):
+        if replica is not None:
+            return replica.getSquirrels()
         self.cursor.execute("SELECT * FROM squirrels ORDER BY id")
         return self.cursor.fetchall()
 
+    # keyset pagination: the rows after `afterId`, so deep pages cost the same as the first
+    def getSquirrelsPage(self, limit, afterId=0):
+        if replica is not None:
+            return replica.getSquirrelsPage(limit, afterId)
+        data = [afterId, limit]
+        self.cursor.execute("SELECT * FROM squirrels WHERE id > ? ORDER BY id LIMIT ?", data)
+        return self.cursor.fetchall()
+
+    # yields lists of at most chunkSize rows without ever holding the whole table;
+    # filters are those of findSquirrels
+    def iterSquirrels(self, chunkSize=500, **filters):
+        if filters:
+            yield from self.iterFound(self.findSquirrels, lambda row: row["id"], chunkSize, filters)
+            return
+        if replica is not None:
+            yield from replica.iterSquirrels(chunkSize)
+            return
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute("SELECT * FROM squirrels ORDER BY id")
+            while True:
+                rows = cursor.fetchmany(chunkSize)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+
+    # SEARCH
+    # Filters are size (exact), namePrefix (case-sensitive) and text (words in
+    # the name, any case); pass any of them, plus limit and afterId to page.
+
+    def findSquirrels(self, size=None, namePrefix=None, text=None, limit=None, afterId=0):
+        sql, data = findQuery("squirrels.*", size, namePrefix, text, limit, afterId)
+        self.cursor.execute(sql, data)
+        return self.cursor.fetchall()
+
+    # like findSquirrels, but each row is a JSON object string
+    def findSquirrelsJson(self, size=None, namePrefix=None, text=None, limit=None, afterId=0):
+        sql, data = findQuery(SQUIRREL_JSON_QUALIFIED, size, namePrefix, text, limit, afterId)
+        cursor = self.rawCursor()
+        try:
+            cursor.execute(sql, data)
+            return [row[0] for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+
+    # what iterSquirrels and iterSquirrelsJson do with filters: a query per
+    # chunk, each picking up after the last id of the one before
+    def iterFound(self, find, lastId, chunkSize, filters):
+        afterId = 0
+        while True:
+            rows = find(limit=chunkSize, afterId=afterId, **filters)
+            if not rows:
+                break
+            yield rows
+            afterId = lastId(rows[-1])
+
     def getSquirrel(self, squirrelId):
+        if replica is not None:
+            return replica.getSquirrel(squirrelId)
         data = [squirrelId]
         self.cursor.execute("SELECT * FROM squirrels WHERE id = ?", data)
         return self.cursor.fetchone()
 
+    # ROW PIPELINE
+    # Faster ways to read the same rows when a dict per row is not needed.
+
+    # a cursor that returns whatever sqlite hands back, with no row factory at all
+    def rawCursor(self, rowFactory=None):
+        cursor = self.connection.cursor()
+        cursor.row_factory = rowFactory
+        return cursor
+
+    def getSquirrelRows(self):
+        if replica is not None:
+            return replica.getSquirrelRows()
+        cursor = self.rawCursor(lambda _, row: SquirrelRow(*row))
+        try:
+            cursor.execute("SELECT id, name, size FROM squirrels ORDER BY id")
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+
+    # The whole list as one JSON array string, each object rendered by sqlite.
+    # The array is joined here: json_group_array need not keep a subquery's
+    # order, and its own ORDER BY needs sqlite 3.44.
+    def getSquirrelsJson(self):
+        if replica is not None:
+            return replica.getSquirrelsJson()
+        cursor = self.rawCursor()
+        try:
+            cursor.execute(f"SELECT {SQUIRREL_JSON} FROM squirrels ORDER BY id")
+            return "[" + ",".join(row[0] for row in cursor.fetchall()) + "]"
+        finally:
+            cursor.close()
+
+    # one squirrel as a JSON object string, or None
+    def getSquirrelJson(self, squirrelId):
+        if replica is not None:
+            return replica.getSquirrelJson(squirrelId)
+        data = [squirrelId]
+        cursor = self.rawCursor()
+        try:
+            cursor.execute(f"SELECT {SQUIRREL_JSON} FROM squirrels WHERE id = ?", data)
+            row = cursor.fetchone()
+            return row[0] if row else None
+        finally:
+            cursor.close()
+
+    # like iterSquirrels, but each chunk is a list of JSON object strings
+    def iterSquirrelsJson(self, chunkSize=500, **filters):
+        if filters:
+            yield from self.iterFound(self.findSquirrelsJson, lambda row: json.loads(row)["id"], chunkSize, filters)
+            return
+        if replica is not None:
+            yield from replica.iterSquirrelsJson(chunkSize)
+            return
+        cursor = self.rawCursor()
+        try:
+            cursor.execute(f"SELECT {SQUIRREL_JSON} FROM squirrels ORDER BY id")
+            while True:
+                rows = cursor.fetchmany(chunkSize)
+                if not rows:
+                    break
+                yield [row[0] for row in rows]
+        finally:
+            cursor.close()
+
+    # CHANGE LOG
+    # Triggers log every write to squirrels, whoever makes it (see SCHEMA).
+
+    # At most `limit` changes after seq `since`, oldest first, as dicts of seq,
+    # op ("insert", "update" or "delete"), id, and name and size unless deleted.
+    def getChanges(self, since=0, limit=None):
+        data = [since, -1 if limit is None else limit]
+        self.cursor.execute("SELECT seq, op, id, name, size FROM squirrels_log WHERE seq > ? ORDER BY seq LIMIT ?", data)
+        return self.cursor.fetchall()
+
+    # (horizon, latest): changes up to seq horizon may have been pruned, and
+    # latest is the highest seq ever handed out. Read it after getChanges, so a
+    # prune in between shows up here rather than as a silently missing tombstone.
+    def getChangeBounds(self):
+        self.cursor.execute("SELECT seq FROM squirrels_log_horizon")
+        horizon = self.cursor.fetchone()["seq"]
+        self.cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'squirrels_log'")
+        latest = self.cursor.fetchone()
+        return horizon, latest["seq"] if latest else 0
+
+    # Each write is a single statement that hands back the row it touched, so
+    # callers never need a SELECT before or after it. Update and delete return
+    # None when there was no such squirrel.
+
     def createSquirrel(self, name, size):
         data = [name, size]
-        self.cursor.execute("INSERT INTO squirrels (name, size) VALUES (?, ?)", data)
-        self.connection.commit()
-        return None
+        return self.write("INSERT INTO squirrels (name, size) VALUES (?, ?) RETURNING *", data)[0]
 
     def updateSquirrel(self, squirrelId, name, size):
         data = [name, size, squirrelId]
-        self.cursor.execute("UPDATE squirrels SET name = ?, size = ? WHERE id = ?", data)
-        self.connection.commit()
-        return None
+        rows = self.write("UPDATE squirrels SET name = ?, size = ? WHERE id = ? RETURNING *", data)
+        return rows[0] if rows else None
 
     def deleteSquirrel(self, squirrelId):
         data = [squirrelId]
-        self.cursor.execute("DELETE FROM squirrels WHERE id = ?", data)
+        rows = self.write("DELETE FROM squirrels WHERE id = ? RETURNING *", data)
+        return rows[0] if rows else None
+
+    # one committed write statement: part of a group commit when a committer is
+    # configured, otherwise its own transaction on the borrowed connection
+    def write(self, sql, data):
+        if replica is not None:
+            replica.beginWrite()
+        try:
+            if committer is not None:
+                rows = committer.submit(sql, data)
+            else:
+                self.cursor.execute(sql, data)
+                rows = self.cursor.fetchall()
+                self.connection.commit()
+        except BaseException:
+            if replica is not None:
+                replica.abortWrite()
+            raise
+        if rows:
+            changeSignal.notify()
+        if replica is not None:
+            changed = [(row["id"], row["name"], row["size"]) for row in rows]
+            if statementVerb(sql) == "DELETE":
+                replica.endWrite(deletes=[row[0] for row in changed], changes=len(changed))
+            else:
+                replica.endWrite(upserts=changed, changes=len(changed))
+        return rows
+
+    # BULK WRITES
+    # Each method runs as one transaction, with executemany wherever no row
+    # needs to come back. Pass commit=False to fold several of them into a
+    # bigger transaction and finish it yourself with commit() or rollback(),
+    # which keep the replica in step.
+
+    def begin(self):
+        # before taking sqlite's write lock, so a replica check never waits on it
+        if replica is not None and self.replicaWrite is None:
+            replica.beginWrite()
+            # [upserts, deletes, rows written]
+            self.replicaWrite = [[], [], 0]
+        # IMMEDIATE takes the write lock now, so no other writer can change which
+        # ids exist between the bulk methods' lookups and their writes
+        if not self.connection.in_transaction:
+            self.cursor.execute("BEGIN IMMEDIATE")
+
+    # what a bulk method changed, for the replica to take once it commits
+    def noteReplicaWrite(self, upserts=(), deletes=(), changes=0):
+        if self.replicaWrite is not None:
+            self.replicaWrite[0].extend(upserts)
+            self.replicaWrite[1].extend(deletes)
+            self.replicaWrite[2] += changes
+
+    def commit(self):
         self.connection.commit()
-        return None
+        changeSignal.notify()
+        if self.replicaWrite is not None:
+            upserts, deletes, changes = self.replicaWrite
+            self.replicaWrite = None
+            replica.endWrite(upserts, deletes, changes)
+
+    def rollback(self):
+        self.connection.rollback()
+        self.abortReplicaWrite()
+
+    def abortReplicaWrite(self):
+        if self.replicaWrite is not None:
+            self.replicaWrite = None
+            replica.abortWrite()
+
+    # takes (name, size) pairs and returns the new ids in the same order
+    def createSquirrels(self, rows, commit=True):
+        rows = list(rows)
+        self.begin()
+        # one statement per row, since executemany can't say which id each insert got
+        stored = []
+        for row in rows:
+            self.cursor.execute("INSERT INTO squirrels (name, size) VALUES (?, ?) RETURNING id, name, size", row)
+            stored.append(self.cursor.fetchone())
+        # the replica takes the rows as stored: the TEXT columns turn 7 into "7"
+        self.noteReplicaWrite(upserts=[(row["id"], row["name"], row["size"]) for row in stored], changes=len(rows))
+        ids = [row["id"] for row in stored]
+        if commit:
+            self.commit()
+        return ids
+
+    # takes (id, name, size) triples and returns whether each id existed
+    def updateSquirrels(self, rows, commit=True):
+        rows = list(rows)
+        self.begin()
+        found = self.existingIds([row[0] for row in rows])
+        data = [(name, size, squirrelId) for squirrelId, name, size in rows if squirrelId in found]
+        self.cursor.executemany("UPDATE squirrels SET name = ?, size = ? WHERE id = ?", data)
+        if self.replicaWrite is not None:
+            # read back as stored, as createSquirrels does
+            self.noteReplicaWrite(upserts=self.storedRows(found), changes=len(data))
+        if commit:
+            self.commit()
+        return [row[0] in found for row in rows]
+
+    # takes ids and returns whether each one was deleted; a repeated id only counts once
+    def deleteSquirrels(self, squirrelIds, commit=True):
+        squirrelIds = list(squirrelIds)
+        self.begin()
+        found = self.existingIds(squirrelIds)
+        self.cursor.executemany("DELETE FROM squirrels WHERE id = ?", [[squirrelId] for squirrelId in found])
+        self.noteReplicaWrite(deletes=found, changes=len(found))
+        if commit:
+            self.commit()
+        deleted = []
+        for squirrelId in squirrelIds:
+            deleted.append(squirrelId in found)
+            found.discard(squirrelId)
+        return deleted
+
+    def existingIds(self, squirrelIds):
+        return {row[0] for row in self.storedRows(squirrelIds)}
+
+    # (id, name, size) of those ids that exist, in no particular order
+    def storedRows(self, squirrelIds):
+        rows = []
+        unique = list(set(squirrelIds))
+        for start in range(0, len(unique), ID_CHUNK_SIZE):
+            chunk = unique[start:start + ID_CHUNK_SIZE]
+            marks = ", ".join("?" * len(chunk))
+            self.cursor.execute(f"SELECT id, name, size FROM squirrels WHERE id IN ({marks})", chunk)
+            rows.extend((row["id"], row["name"], row["size"]) for row in self.cursor.fetchall())
+        return rows
+
+    # Runs a mixed list of operations in one transaction, e.g.
+    #   {"op": "create", "name": "Fluffy", "size": "large"}
+    #   {"op": "update", "id": 1, "name": "Fluffy", "size": "small"}
+    #   {"op": "delete", "id": 1}
+    # Neighbouring operations of the same kind share one executemany call, and
+    # the order of the list is kept. Returns one result dict per operation.
+    def applyBulk(self, operations):
+        results = [None] * len(operations)
+        valid = []
+        for index, operation in enumerate(operations):
+            error = bulkOperationError(operation)
+            if error:
+                results[index] = {"status": 400, "error": error}
+            else:
+                valid.append((index, operation))
+        try:
+            self.begin()
+            for kind, run in groupby(valid, key=lambda item: item[1]["op"]):
+                run = list(run)
+                ops = [operation for _, operation in run]
+                if kind == "create":
+                    ids = self.createSquirrels([(op["name"], op["size"]) for op in ops], commit=False)
+                    outcomes = [{"status": 201, "id": squirrelId} for squirrelId in ids]
+                elif kind == "update":
+                    found = self.updateSquirrels([(op["id"], op["name"], op["size"]) for op in ops], commit=False)
+                    outcomes = [{"status": 200 if hit else 404, "id": op["id"]} for op, hit in zip(ops, found)]
+                else:
+                    found = self.deleteSquirrels([op["id"] for op in ops], commit=False)
+                    outcomes = [{"status": 204 if hit else 404, "id": op["id"]} for op, hit in zip(ops, found)]
+                for (index, _), outcome in zip(run, outcomes):
+                    results[index] = dict(outcome, op=kind)
+            self.commit()
+        except Exception:
+            self.rollback()
+            raise
+        return results
+
+BULK_FIELDS = {"create": ("name", "size"), "update": ("id", "name", "size"), "delete": ("id",)}
+
+# None when the operation can run, otherwise a short reason it cannot
+def bulkOperationError(operation):
+    if not isinstance(operation, dict) or operation.get("op") not in BULK_FIELDS:
+        return "op must be one of create, update, delete"
+    missing = [field for field in BULK_FIELDS[operation["op"]] if field not in operation]
+    if missing:
+        return "missing " + ", ".join(missing)
+    if "id" in operation and (not isinstance(operation["id"], int) or isinstance(operation["id"], bool)):
+        return "id must be an integer"
+    for field in ("name", "size"):
+        if field in operation and not isFieldValue(operation[field]):
+            return f"{field} must be a string or a number"
+    return None
+
+# What a name or size may be: sqlite can't bind a list or a map, and would
+# store true as 1. JSON's null stays NULL.
+def isFieldValue(value):
+    return value is None or (isinstance(value, (str, int, float)) and not isinstance(value, bool))
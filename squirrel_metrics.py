@@ -0,0 +1,120 @@
+import threading
+from bisect import bisect_left
+
+# Latency buckets in seconds, from a fast point lookup to a very slow listing
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+HELP = {
+    "squirrel_http_requests_total": ("counter", "HTTP requests served, by route, method and status."),
+    "squirrel_http_request_duration_seconds": ("histogram", "Time from parsing a request to finishing its response."),
+    "squirrel_http_requests_in_flight": ("gauge", "Requests currently being handled."),
+    "squirrel_http_response_bytes_total": ("counter", "Response body bytes written."),
+    "squirrel_http_requests_queued": ("gauge", "Requests waiting for a worker thread."),
+    "squirrel_http_requests_shed_total": ("counter", "Requests refused with a 503 by admission control, by route and reason."),
+    "squirrel_sql_duration_seconds": ("histogram", "Time spent executing SQL statements, by statement verb."),
+}
+
+# One thread's private counters. Only its own thread writes to it, so updates
+# need no lock; the scrape copies each shard and adds them up.
+class Shard:
+
+    __slots__ = ("counters", "histograms")
+
+    def __init__(self):
+        self.counters = {}
+        # key -> [count per bucket..., count above the last bucket, sum]
+        self.histograms = {}
+
+class Metrics:
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.local = threading.local()
+        self.shards = []
+        # taken when a thread makes its first shard and while scraping, never per request
+        self.lock = threading.Lock()
+
+    def shard(self):
+        shard = getattr(self.local, "shard", None)
+        if shard is None:
+            shard = Shard()
+            self.local.shard = shard
+            with self.lock:
+                self.shards.append(shard)
+        return shard
+
+    # labels is a tuple of (name, value) pairs, always in the same order for a metric
+    def inc(self, name, labels=(), amount=1):
+        counters = self.shard().counters
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + amount
+
+    # a gauge is a counter that also goes down
+    def dec(self, name, labels=(), amount=1):
+        self.inc(name, labels, -amount)
+
+    def observe(self, name, labels, seconds):
+        histograms = self.shard().histograms
+        key = (name, labels)
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = [0] * (len(self.buckets) + 2)
+        histogram[bisect_left(self.buckets, seconds)] += 1
+        histogram[-1] += seconds
+
+    # all shards added together: ({key: value}, {key: [bucket counts..., sum]})
+    def collect(self):
+        with self.lock:
+            shards = list(self.shards)
+        counters = {}
+        histograms = {}
+        for shard in shards:
+            # dict() copies in one step under the GIL, so a busy shard can't change mid-copy
+            for key, value in dict(shard.counters).items():
+                counters[key] = counters.get(key, 0) + value
+            for key, histogram in dict(shard.histograms).items():
+                total = histograms.setdefault(key, [0] * len(histogram))
+                for i, value in enumerate(list(histogram)):
+                    total[i] += value
+        return counters, histograms
+
+    # everything in the Prometheus text exposition format
+    def render(self):
+        counters, histograms = self.collect()
+        # request counts come straight from the duration histogram's counts
+        for (name, labels), histogram in histograms.items():
+            if name == "squirrel_http_request_duration_seconds":
+                key = ("squirrel_http_requests_total", labels)
+                counters[key] = sum(histogram[:-1])
+        lines = []
+        for name in sorted({key[0] for key in counters} | {key[0] for key in histograms}):
+            kind, text = HELP.get(name, ("untyped", name))
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (_, labels), value in sorted(item for item in counters.items() if item[0][0] == name):
+                lines.append(f"{name}{formatLabels(labels)} {formatValue(value)}")
+            for (_, labels), histogram in sorted(item for item in histograms.items() if item[0][0] == name):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), histogram[:-1]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{formatLabels(labels + (('le', str(bound)),))} {cumulative}")
+                lines.append(f"{name}_sum{formatLabels(labels)} {formatValue(histogram[-1])}")
+                lines.append(f"{name}_count{formatLabels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self.lock:
+            for shard in self.shards:
+                shard.counters.clear()
+                shard.histograms.clear()
+
+def formatLabels(labels):
+    if not labels:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+def formatValue(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+metrics = Metrics()
@@ -0,0 +1,366 @@
+import argparse
+import http.client
+import io
+import json
+import os
+import platform
+import sqlite3
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+import squirrel_cache
+import squirrel_db
+import squirrel_server
+from mydb import MyDB, MyLogDB
+from squirrel_bench import seedDatabase
+from squirrel_server import SquirrelServerHandler
+
+# Micro-benchmarks for the request handler and MyDB, with no sockets at all.
+# Requests go through SquirrelServerHandler in-process, the way
+# test_squirrel_server_unit.py drives it with FakeRequest, so the numbers are
+# dispatch, parsing, rendering and the database without any network noise.
+# Every route runs twice: against StubDB, which answers from memory and so
+# leaves only the handler's own cost, and against a real temporary SQLite
+# database. The response cache is off throughout, so each call does the work.
+#
+#   python squirrel_microbench.py --output baseline.json
+#   python squirrel_microbench.py --baseline baseline.json --threshold 1.25
+#
+# The report is JSON on stdout (or --output) and doubles as a baseline. With
+# --baseline, a table of old and new times goes to stderr, and the exit status
+# is 1 when any benchmark got more than --threshold times slower.
+
+SIZES = ("small", "medium", "large")
+MYDB_CLASSES = (MyDB, MyLogDB)
+
+# what a socket would give the handler: the raw request to read, and somewhere for the response
+class FakeRequest:
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.response = io.BytesIO()
+
+    def makefile(self, mode, *args, **kwargs):
+        return io.BytesIO(self.raw)
+
+    # the handler's wfile writes straight here (StreamRequestHandler.wbufsize is 0)
+    def sendall(self, data):
+        self.response.write(data)
+
+# the real handler, minus the access log line it writes to stderr for every request
+class QuietHandler(SquirrelServerHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+def rawRequest(method, path, body=None, headers=None):
+    body = body or b""
+    lines = [f"{method} {path} HTTP/1.1"] + [f"{name}: {value}" for name, value in (headers or {}).items()]
+    if body:
+        lines.append(f"Content-Length: {len(body)}")
+    return bytes("\r\n".join(lines) + "\r\n\r\n", "utf-8") + body
+
+# one request through the handler; returns the response status
+def serve(raw):
+    request = FakeRequest(raw)
+    QuietHandler(request, ("127.0.0.1", 0), None)
+    return int(request.response.getvalue()[9:12])
+
+# Stands in for SquirrelDB with `rows` squirrels in memory, answering every
+# call the handler makes without doing any real work.
+class StubDB:
+
+    def __init__(self, rows):
+        self.rows = [{"id": i, "name": f"squirrel-{i}", "size": SIZES[i % 3]} for i in range(1, rows + 1)]
+        self.json = [json.dumps(row, separators=(",", ":")) for row in self.rows]
+        self.listJson = "[" + ",".join(self.json) + "]"
+        self.changes = [dict(row, seq=row["id"], op="insert") for row in self.rows]
+
+    # the handler opens a SquirrelDB per request: this one hands out itself
+    def __call__(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def getSquirrels(self):
+        return self.rows
+
+    def getSquirrelsPage(self, limit, afterId=0):
+        return self.rows[afterId:afterId + limit]
+
+    def getSquirrelsJson(self):
+        return self.listJson
+
+    def getSquirrel(self, squirrelId):
+        return self.rows[(int(squirrelId) - 1) % len(self.rows)]
+
+    def getSquirrelJson(self, squirrelId):
+        return self.json[(int(squirrelId) - 1) % len(self.json)]
+
+    def iterSquirrels(self, chunkSize=500, **filters):
+        for start in range(0, len(self.rows), chunkSize):
+            yield self.rows[start:start + chunkSize]
+
+    def iterSquirrelsJson(self, chunkSize=500, **filters):
+        for start in range(0, len(self.json), chunkSize):
+            yield self.json[start:start + chunkSize]
+
+    def createSquirrel(self, name, size):
+        return {"id": len(self.rows) + 1, "name": name, "size": size}
+
+    def updateSquirrel(self, squirrelId, name, size):
+        return {"id": int(squirrelId), "name": name, "size": size}
+
+    def deleteSquirrel(self, squirrelId):
+        return self.getSquirrel(squirrelId)
+
+    def applyBulk(self, operations):
+        return [{"op": operation["op"], "status": 201, "id": len(self.rows) + i} for i, operation in enumerate(operations)]
+
+    def getChanges(self, since=0, limit=None):
+        return self.changes[since:since + limit]
+
+    def getChangeBounds(self):
+        return 0, len(self.changes)
+
+@contextmanager
+def database(factory):
+    saved = squirrel_server.SquirrelDB, squirrel_cache.cache
+    squirrel_server.SquirrelDB = factory
+    squirrel_cache.cache = None
+    try:
+        yield
+    finally:
+        squirrel_server.SquirrelDB, squirrel_cache.cache = saved
+
+# A seeded database behind the pool and the group committer, as the server
+# runs it, but with durability off so the write numbers aren't fsync numbers.
+# Whatever pool, committer or replica was configured before is put back after,
+# the way database() puts back the handler's SquirrelDB.
+@contextmanager
+def sqliteDatabase(rows):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "microbench.db")
+        seedDatabase(path, rows)
+        squirrel_db.ensureSchema(path)
+        saved = squirrel_db.pool, squirrel_db.committer, squirrel_db.replica
+        squirrel_db.pool = squirrel_db.ConnectionPool(path, 1)
+        squirrel_db.committer = squirrel_db.GroupCommitter(path, durability="off")
+        squirrel_db.replica = None
+        try:
+            with database(squirrel_db.SquirrelDB):
+                yield
+        finally:
+            squirrel_db.committer.close()
+            squirrel_db.pool.close()
+            squirrel_db.pool, squirrel_db.committer, squirrel_db.replica = saved
+
+# Seconds per call of run(): the count is doubled until a batch takes minTime,
+# then the fastest of `repeat` batches wins, as timeit advises, since anything
+# slower than that was something else getting in the way. prepare(number), if
+# given, runs untimed before each batch.
+def timeIt(run, prepare=None, minTime=0.2, repeat=5):
+    def batch(number):
+        if prepare is not None:
+            prepare(number)
+        began = time.perf_counter()
+        for _ in range(number):
+            run()
+        return time.perf_counter() - began
+
+    number = 1
+    while (elapsed := batch(number)) < minTime:
+        number *= 2
+    best = min([elapsed] + [batch(number) for _ in range(repeat - 1)])
+    return best / number, number
+
+# {name: (run, prepare)} for the handler's helpers on their own
+def helperBenchmarks():
+    handler = QuietHandler.__new__(QuietHandler)
+    handler.path = "/squirrels/42?fields=name&size=large"
+    form = b"name=Fluffy+Tail&size=large"
+    body = json.dumps({"name": "Fluffy Tail", "size": "large"}).encode("utf-8")
+    forms = QuietHandler.__new__(QuietHandler)
+    forms.headers = http.client.parse_headers(io.BytesIO(
+        b"Content-Type: application/x-www-form-urlencoded\r\nContent-Length: %d\r\n\r\n" % len(form)))
+    jsons = QuietHandler.__new__(QuietHandler)
+    jsons.headers = http.client.parse_headers(io.BytesIO(
+        b"Content-Type: application/json\r\nContent-Length: %d\r\n\r\n" % len(body)))
+
+    def getRequestData(handler, data):
+        handler.rfile = io.BytesIO(data)
+        return handler.getRequestData()
+
+    return {
+        "handler/parsePath": (handler.parsePath, None),
+        "handler/getRequestData/form": (lambda: getRequestData(forms, form), None),
+        "handler/getRequestData/json": (lambda: getRequestData(jsons, body), None),
+        # parsing, dispatch and a plain text response, with no database behind it
+        "handler/route/404": (lambda raw=rawRequest("GET", "/nope"): serve(raw), None),
+    }
+
+# [(name, status, request, prepare)] for every handleSquirrels* action
+def routes(rows, ids):
+    form = {"Content-Type": "application/x-www-form-urlencoded"}
+    bulk = json.dumps([{"op": "create", "name": f"bulk-{i}", "size": "small"} for i in range(10)]).encode("utf-8")
+    middle = max(rows // 2, 1)
+    deletable = []
+
+    def prepareDeletes(number):
+        deletable[:] = ids(number)
+
+    def nextDelete():
+        return rawRequest("DELETE", f"/squirrels/{deletable.pop()}")
+
+    return [
+        ("list", 200, lambda raw=rawRequest("GET", "/squirrels"): raw, None),
+        ("page", 200, lambda raw=rawRequest("GET", f"/squirrels?limit=100&after_id={middle}"): raw, None),
+        ("stream", 200, lambda raw=rawRequest("GET", "/squirrels?stream=1"): raw, None),
+        ("retrieve", 200, lambda raw=rawRequest("GET", f"/squirrels/{middle}"): raw, None),
+        ("create", 201, lambda raw=rawRequest("POST", "/squirrels", b"name=Nova&size=small", form): raw, None),
+        ("update", 200, lambda raw=rawRequest("PUT", f"/squirrels/{middle}", b"name=Nova&size=large", form): raw, None),
+        ("delete", 204, nextDelete, prepareDeletes),
+        ("bulk", 200, lambda raw=rawRequest("POST", "/squirrels/_bulk", bulk, {"Content-Type": "application/json"}): raw, None),
+        ("changes", 200, lambda raw=rawRequest("GET", "/squirrels/changes?since=0&limit=100"): raw, None),
+    ]
+
+# the first response of each benchmark must be the one it means to measure
+def checkedServe(name, status, request):
+    def run():
+        got = serve(request())
+        if got != status:
+            raise RuntimeError(f"{name} answered {got}, expected {status}")
+    return run
+
+def runRoutes(prefix, rows, ids, minTime, repeat, selected):
+    results = {}
+    for route, status, request, prepare in routes(rows, ids):
+        name = f"{prefix}/{route}"
+        if selected(name):
+            results[name] = timeIt(checkedServe(name, status, request), prepare, minTime, repeat)
+    return results
+
+# fresh rows for DELETE to take away, so every timed delete finds its squirrel
+def sqliteIds(number):
+    with squirrel_db.SquirrelDB() as db:
+        return db.createSquirrels([("doomed", "small")] * number)
+
+def mydbBenchmarks(directory, sizes):
+    benchmarks = {}
+    for dbClass in MYDB_CLASSES:
+        for size in sizes:
+            strings = [f"string number {i}" for i in range(size)]
+            db = dbClass(os.path.join(directory, f"{dbClass.__name__}-{size}.db"))
+            db.saveStrings(strings)
+            prefix = f"mydb/{dbClass.__name__}"
+            benchmarks[f"{prefix}/load/{size}"] = (db.loadStrings, None)
+            benchmarks[f"{prefix}/save/{size}"] = (lambda db=db, strings=strings: db.saveStrings(strings), None)
+            # back to `size` strings before each batch, or the appends would grow the list they are timed on
+            benchmarks[f"{prefix}/append/{size}"] = (lambda db=db: db.saveString("appended"),
+                                                     lambda number, db=db, strings=strings: db.saveStrings(strings))
+    return benchmarks
+
+# {name: (seconds per call, calls per batch)} for every benchmark `only` lets through
+def runSuite(rows=1000, sizes=(100, 1000, 10000), minTime=0.2, repeat=5, only=None):
+    def selected(name):
+        return not only or any(pattern in name for pattern in only)
+
+    results = {}
+    for name, (run, prepare) in helperBenchmarks().items():
+        if selected(name):
+            results[name] = timeIt(run, prepare, minTime, repeat)
+    stub = StubDB(rows)
+    with database(stub):
+        results.update(runRoutes("stub", rows, lambda number: [1] * number, minTime, repeat, selected))
+    if any(selected(f"sqlite/{route[0]}") for route in routes(rows, None)):
+        with sqliteDatabase(rows):
+            results.update(runRoutes("sqlite", rows, sqliteIds, minTime, repeat, selected))
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, (run, prepare) in mydbBenchmarks(tmp, sizes).items():
+            if selected(name):
+                results[name] = timeIt(run, prepare, minTime, repeat)
+    return results
+
+def report(results, config):
+    return {
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "machine": platform.machine(),
+        "config": config,
+        "results": {name: {"us": round(seconds * 1e6, 3), "number": number}
+                    for name, (seconds, number) in sorted(results.items())},
+    }
+
+# [(name, baseline us, current us, current / baseline)] for the benchmarks in both, slowest first
+def compare(baseline, current):
+    rows = []
+    for name, result in current["results"].items():
+        before = baseline["results"].get(name)
+        if before:
+            rows.append((name, before["us"], result["us"], result["us"] / before["us"] if before["us"] else float("inf")))
+    return sorted(rows, key=lambda row: row[3], reverse=True)
+
+def regressions(comparison, threshold):
+    return [row for row in comparison if row[3] > threshold]
+
+def formatComparison(comparison, threshold):
+    lines = [f"{'benchmark':<36} {'baseline us':>12} {'now us':>12} {'ratio':>7}"]
+    for name, before, now, ratio in comparison:
+        flag = "  SLOWER" if ratio > threshold else ""
+        lines.append(f"{name:<36} {before:>12.3f} {now:>12.3f} {ratio:>7.2f}{flag}")
+    return "\n".join(lines)
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description="Time squirrel_server's handler and MyDB without sockets.")
+    parser.add_argument("--rows", type=int, default=1000, help="squirrels in the stub and the SQLite database")
+    parser.add_argument("--sizes", default="100,1000,10000", help="comma separated MyDB list sizes")
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds each timed batch runs for at least")
+    parser.add_argument("--repeat", type=int, default=5, help="batches per benchmark; the fastest counts")
+    parser.add_argument("--only", default=None, help="comma separated substrings; run just the benchmarks matching one")
+    parser.add_argument("--baseline", default=None, help="a saved report to compare this run with")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="fail when a benchmark takes more than this many times its baseline")
+    parser.add_argument("--output", default=None, help="write the JSON report (a baseline) here instead of stdout")
+    args = parser.parse_args(argv)
+    if args.rows < 1:
+        parser.error("--rows must be at least 1")
+    if args.repeat < 1:
+        parser.error("--repeat must be at least 1")
+    if args.threshold <= 0:
+        parser.error("--threshold must be above 0")
+    return args
+
+def main(argv=None):
+    args = parseArgs(argv)
+    sizes = [int(n) for n in args.sizes.split(",")]
+    only = args.only.split(",") if args.only else None
+    results = runSuite(args.rows, sizes, args.min_time, args.repeat, only)
+    current = report(results, {"rows": args.rows, "sizes": sizes, "min_time_s": args.min_time, "repeat": args.repeat})
+    text = json.dumps(current, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if (baseline.get("python"), baseline.get("machine")) != (current["python"], current["machine"]):
+            print(f"note: the baseline is from Python {baseline.get('python')} on {baseline.get('machine')}",
+                  file=sys.stderr)
+        comparison = compare(baseline, current)
+        print(formatComparison(comparison, args.threshold), file=sys.stderr)
+        slower = regressions(comparison, args.threshold)
+        if slower:
+            print(f"{len(slower)} benchmark(s) more than {args.threshold}x slower than the baseline", file=sys.stderr)
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,185 @@
+import struct
+
+# MessagePack (https://msgpack.org), written here so the server needs nothing
+# outside the standard library. It covers the types JSON has plus bytes:
+# nil, booleans, integers up to 64 bits, floats, str, bin, arrays and maps.
+# Extension types are refused. Anything a msgpack library produces from those
+# types decodes here, and everything encoded here decodes there.
+
+UINT8, UINT16, UINT32, UINT64 = struct.Struct(">B"), struct.Struct(">H"), struct.Struct(">I"), struct.Struct(">Q")
+INT8, INT16, INT32, INT64 = struct.Struct(">b"), struct.Struct(">h"), struct.Struct(">i"), struct.Struct(">q")
+FLOAT32, FLOAT64 = struct.Struct(">f"), struct.Struct(">d")
+
+def packb(obj):
+    parts = []
+    pack(obj, parts.append)
+    return b"".join(parts)
+
+def pack(obj, write):
+    if obj is None:
+        write(b"\xc0")
+    elif obj is True:
+        write(b"\xc3")
+    elif obj is False:
+        write(b"\xc2")
+    elif isinstance(obj, int):
+        packInt(obj, write)
+    elif isinstance(obj, str):
+        data = obj.encode("utf-8")
+        packLength(len(data), write, 0xa0, 31, b"\xd9", b"\xda", b"\xdb")
+        write(data)
+    elif isinstance(obj, float):
+        write(b"\xcb" + FLOAT64.pack(obj))
+    elif isinstance(obj, (list, tuple)):
+        packLength(len(obj), write, 0x90, 15, None, b"\xdc", b"\xdd")
+        for item in obj:
+            pack(item, write)
+    elif isinstance(obj, dict):
+        packLength(len(obj), write, 0x80, 15, None, b"\xde", b"\xdf")
+        for key, value in obj.items():
+            pack(key, write)
+            pack(value, write)
+    elif isinstance(obj, (bytes, bytearray, memoryview)):
+        data = bytes(obj)
+        packLength(len(data), write, None, 0, b"\xc4", b"\xc5", b"\xc6")
+        write(data)
+    else:
+        raise TypeError(f"cannot pack {type(obj).__name__}")
+
+def packInt(value, write):
+    if 0 <= value <= 0x7f:
+        write(UINT8.pack(value))
+    elif -32 <= value < 0:
+        write(INT8.pack(value))
+    elif value > 0:
+        if value <= 0xff:
+            write(b"\xcc" + UINT8.pack(value))
+        elif value <= 0xffff:
+            write(b"\xcd" + UINT16.pack(value))
+        elif value <= 0xffffffff:
+            write(b"\xce" + UINT32.pack(value))
+        elif value <= 0xffffffffffffffff:
+            write(b"\xcf" + UINT64.pack(value))
+        else:
+            raise OverflowError("integer too large for msgpack")
+    elif value >= -0x80:
+        write(b"\xd0" + INT8.pack(value))
+    elif value >= -0x8000:
+        write(b"\xd1" + INT16.pack(value))
+    elif value >= -0x80000000:
+        write(b"\xd2" + INT32.pack(value))
+    elif value >= -0x8000000000000000:
+        write(b"\xd3" + INT64.pack(value))
+    else:
+        raise OverflowError("integer too large for msgpack")
+
+# the short "fix" form when the length fits in `fixMax`, else the 8, 16 or 32 bit form
+def packLength(length, write, fixBase, fixMax, marker8, marker16, marker32):
+    if fixBase is not None and length <= fixMax:
+        write(UINT8.pack(fixBase | length))
+    elif marker8 is not None and length <= 0xff:
+        write(marker8 + UINT8.pack(length))
+    elif length <= 0xffff:
+        write(marker16 + UINT16.pack(length))
+    elif length <= 0xffffffff:
+        write(marker32 + UINT32.pack(length))
+    else:
+        raise OverflowError("too long for msgpack")
+
+# exactly one object; anything after it is an error
+def unpackb(data):
+    obj, pos = unpackFrom(data, 0)
+    if pos != len(data):
+        raise ValueError(f"{len(data) - pos} bytes left over after the msgpack object")
+    return obj
+
+# every object in a stream of concatenated msgpack objects
+def unpackStream(data):
+    pos = 0
+    while pos < len(data):
+        obj, pos = unpackFrom(data, pos)
+        yield obj
+
+# (object, position after it); ValueError for anything malformed or cut short
+def unpackFrom(data, pos):
+    try:
+        return unpackAt(memoryview(data), pos)
+    except (IndexError, RecursionError, struct.error) as e:
+        raise ValueError(f"malformed msgpack data: {e}") from None
+
+def unpackAt(data, pos):
+    marker = data[pos]
+    pos += 1
+    if marker <= 0x7f:
+        return marker, pos
+    if marker >= 0xe0:
+        return marker - 0x100, pos
+    if 0xa0 <= marker <= 0xbf:
+        return readStr(data, pos, marker & 0x1f)
+    if 0x90 <= marker <= 0x9f:
+        return readArray(data, pos, marker & 0x0f)
+    if 0x80 <= marker <= 0x8f:
+        return readMap(data, pos, marker & 0x0f)
+    if marker == 0xc0:
+        return None, pos
+    if marker == 0xc2:
+        return False, pos
+    if marker == 0xc3:
+        return True, pos
+    fixed = FIXED.get(marker)
+    if fixed is not None:
+        return fixed.unpack_from(data, pos)[0], pos + fixed.size
+    sized = SIZED.get(marker)
+    if sized is not None:
+        lengthFormat, read = sized
+        length = lengthFormat.unpack_from(data, pos)[0]
+        return read(data, pos + lengthFormat.size, length)
+    raise ValueError(f"unsupported msgpack type 0x{marker:02x}")
+
+def readStr(data, pos, length):
+    end = checkLength(data, pos, length)
+    try:
+        return str(data[pos:end], "utf-8"), end
+    except UnicodeDecodeError as e:
+        raise ValueError(f"invalid UTF-8 in msgpack string: {e}") from None
+
+def readBin(data, pos, length):
+    end = checkLength(data, pos, length)
+    return bytes(data[pos:end]), end
+
+def readArray(data, pos, length):
+    items = []
+    for _ in range(length):
+        item, pos = unpackAt(data, pos)
+        items.append(item)
+    return items, pos
+
+def readMap(data, pos, length):
+    items = {}
+    for _ in range(length):
+        key, pos = unpackAt(data, pos)
+        value, pos = unpackAt(data, pos)
+        try:
+            items[key] = value
+        except TypeError:
+            raise ValueError(f"unusable msgpack map key {key!r}") from None
+    return items, pos
+
+def checkLength(data, pos, length):
+    end = pos + length
+    if end > len(data):
+        raise ValueError("truncated msgpack data")
+    return end
+
+FIXED = {
+    0xca: FLOAT32, 0xcb: FLOAT64,
+    0xcc: UINT8, 0xcd: UINT16, 0xce: UINT32, 0xcf: UINT64,
+    0xd0: INT8, 0xd1: INT16, 0xd2: INT32, 0xd3: INT64,
+}
+
+SIZED = {
+    0xc4: (UINT8, readBin), 0xc5: (UINT16, readBin), 0xc6: (UINT32, readBin),
+    0xd9: (UINT8, readStr), 0xda: (UINT16, readStr), 0xdb: (UINT32, readStr),
+    0xdc: (UINT16, readArray), 0xdd: (UINT32, readArray),
+    0xde: (UINT16, readMap), 0xdf: (UINT32, readMap),
+}
@@ -0,0 +1,261 @@
+import multiprocessing
+import os
+import select
+import signal
+import socket
+import struct
+import sys
+import time
+import traceback
+import squirrel_db
+import squirrel_server
+
+# Pre-forked serving: one GIL per core instead of one for the whole server.
+#
+# The master binds the listening socket, forks --processes workers and then only
+# supervises them. Each worker opens its own SQLite connections after the fork
+# and runs an ordinary ThreadPoolHTTPServer on the inherited socket, so the
+# kernel hands each new connection to whichever worker accepts first. With
+# --reuse-port every worker binds its own SO_REUSEPORT socket instead and the
+# kernel spreads connections across them evenly.
+#
+#   SIGTERM, SIGINT  workers finish what they're serving and exit, then the master
+#   SIGHUP           replace every worker (see below)
+#
+# Replacing a worker, whether for SIGHUP or because it has served --max-requests,
+# is a handover: the master forks the new one, and only once that one says it is
+# accepting does the old one get SIGTERM. So there is always someone listening,
+# which matters with --reuse-port where each worker's socket goes away with it.
+# A worker that dies is replaced straight away, or after a pause if it died young.
+
+# a worker that fails sooner than this after starting is respawned after RESPAWN_DELAY
+MIN_LIFETIME = 1.0
+RESPAWN_DELAY = 1.0
+POLL_INTERVAL = 0.1
+
+# what workers tell the master over its pipe: a kind byte and their pid
+MESSAGE = struct.Struct("<cI")
+READY = b"U"
+RETIRING = b"R"
+
+MASTER_SIGNALS = {signal.SIGTERM, signal.SIGINT, signal.SIGHUP}
+
+class PreforkMaster:
+
+    def __init__(self, args):
+        self.args = args
+        # pid -> time.monotonic() it was forked
+        self.workers = {}
+        # workers told to stop, which must not be replaced when they exit
+        self.retired = set()
+        # new worker pid -> the worker it takes over from once it is ready
+        self.handovers = {}
+        # (when, pid to take over from or None), soonest first
+        self.pendingSpawns = []
+        self.stopping = False
+        self.reloading = False
+        self.sock = None
+        self.sharedVersion = None
+        self.pipe = None
+        self.unread = b""
+        self.pruner = None
+
+    def bind(self, listen=True):
+        sock = socket.socket(squirrel_server.ThreadPoolHTTPServer.address_family, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.args.reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(self.address)
+        if listen:
+            sock.listen(self.args.backlog)
+        return sock
+
+    def run(self):
+        self.address = (self.args.host, self.args.port)
+        # with --reuse-port this socket only holds the port (and resolves port 0)
+        # for the workers; it never listens, so the kernel never queues a connection on it
+        self.sock = self.bind(listen=not self.args.reuse_port)
+        self.address = self.sock.getsockname()
+        # once here, and workers skip it, rather than each queueing for the write lock to find it done
+        squirrel_db.ensureSchema(self.args.db)
+        # One pruner for all the workers, which run none. It has no thread, so
+        # nothing is halfway through sqlite when the master forks.
+        if self.args.change_retention:
+            self.pruner = squirrel_db.ChangeLogPruner(self.args.db, background=False,
+                                                      **squirrel_server.changeLogOptions(self.args))
+        # counts writes in every worker, see squirrel_cache.ResponseCache
+        self.sharedVersion = multiprocessing.Value("Q", 0)
+        self.pipe = os.pipe()
+        os.set_blocking(self.pipe[0], False)
+        signal.signal(signal.SIGTERM, self.handleStop)
+        signal.signal(signal.SIGINT, self.handleStop)
+        signal.signal(signal.SIGHUP, self.handleReload)
+        print(f"squirrel_server running at {self.address[0]}:{self.address[1]} "
+              f"({self.args.processes} processes x {self.args.workers} workers, {self.args.engine})", flush=True)
+        try:
+            for _ in range(self.args.processes):
+                self.spawn()
+            self.supervise()
+        finally:
+            self.stopWorkers()
+            if self.pruner is not None:
+                self.pruner.close()
+            self.sock.close()
+            os.close(self.pipe[0])
+            os.close(self.pipe[1])
+
+    def handleStop(self, signum, frame):
+        self.stopping = True
+
+    def handleReload(self, signum, frame):
+        self.reloading = True
+
+    def supervise(self):
+        while not self.stopping:
+            # a worker's message or a signal wakes this early
+            select.select([self.pipe[0]], [], [], POLL_INTERVAL)
+            for kind, pid in self.readMessages():
+                self.handleMessage(kind, pid)
+            for pid, status in self.reap():
+                self.replace(pid, status)
+            if self.reloading:
+                self.reloading = False
+                for pid in list(self.workers):
+                    self.handOver(pid)
+            if self.pruner is not None:
+                self.pruner.pruneIfDue()
+            now = time.monotonic()
+            while self.pendingSpawns and self.pendingSpawns[0][0] <= now and not self.stopping:
+                _, replacing = self.pendingSpawns.pop(0)
+                self.spawn(replacing)
+
+    def readMessages(self):
+        try:
+            self.unread += os.read(self.pipe[0], 4096)
+        except BlockingIOError:
+            pass
+        whole = len(self.unread) - len(self.unread) % MESSAGE.size
+        messages = list(MESSAGE.iter_unpack(self.unread[:whole]))
+        self.unread = self.unread[whole:]
+        return messages
+
+    def handleMessage(self, kind, pid):
+        if kind == RETIRING:
+            self.handOver(pid)
+        elif kind == READY:
+            old = self.handovers.pop(pid, None)
+            if old in self.workers:
+                self.retired.add(old)
+                self.signal(old, signal.SIGTERM)
+
+    def handOver(self, pid):
+        if pid in self.workers and pid not in self.retired and pid not in self.handovers.values():
+            self.spawn(replacing=pid)
+
+    # exited workers as (pid, wait status), without blocking
+    def reap(self):
+        exited = []
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            exited.append((pid, status))
+        return exited
+
+    def replace(self, pid, status):
+        started = self.workers.pop(pid, None)
+        # a replacement that died before it was ready still owes its predecessor one
+        replacing = self.handovers.pop(pid, None)
+        if pid in self.retired:
+            self.retired.discard(pid)
+            return
+        if started is None or self.stopping:
+            return
+        # it died while its replacement was starting, so that one takes over from nobody
+        for newPid, old in list(self.handovers.items()):
+            if old == pid:
+                del self.handovers[newPid]
+                return
+        delay = 0.0
+        code = os.waitstatus_to_exitcode(status)
+        if code != 0:
+            print(f"squirrel_server worker {pid} exited with status {code}", file=sys.stderr, flush=True)
+            if time.monotonic() - started < MIN_LIFETIME:
+                delay = RESPAWN_DELAY
+        self.pendingSpawns.append((time.monotonic() + delay, replacing))
+        self.pendingSpawns.sort(key=lambda spawn: spawn[0])
+
+    def spawn(self, replacing=None):
+        # anything still buffered would otherwise be written once by each process
+        sys.stdout.flush()
+        sys.stderr.flush()
+        # a signal in the moment after the fork would run the master's handlers in
+        # the child, so they wait until the child has its own
+        signal.pthread_sigmask(signal.SIG_BLOCK, MASTER_SIGNALS)
+        pid = os.fork()
+        if pid != 0:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, MASTER_SIGNALS)
+        else:
+            code = 1
+            try:
+                code = self.workerMain()
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+        self.workers[pid] = time.monotonic()
+        if replacing is not None:
+            self.handovers[pid] = replacing
+        return pid
+
+    def workerMain(self):
+        # Ctrl-C reaches the whole process group; the master turns it into SIGTERM
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        # until the server exists there is nothing to finish, so just die
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, MASTER_SIGNALS)
+        os.close(self.pipe[0])
+        sock = self.bind() if self.args.reuse_port else self.sock
+        server = squirrel_server.makeServer(self.args, sock=sock, maxRequests=self.args.max_requests,
+                                            sharedVersion=self.sharedVersion, worker=True)
+        server.onMaxRequests = lambda: self.tellMaster(RETIRING)
+        # its replacement is already listening by then, so new connections are
+        # unlikely to land on this socket while it drains
+        server.drainOnStop = self.args.reuse_port
+        signal.signal(signal.SIGTERM, lambda signum, frame: server.requestRetire())
+        self.tellMaster(READY)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            squirrel_server.closeServices()
+        return 0
+
+    # one write under PIPE_BUF bytes, so messages from different workers never interleave
+    def tellMaster(self, kind):
+        os.write(self.pipe[1], MESSAGE.pack(kind, os.getpid()))
+
+    def stopWorkers(self):
+        for pid in self.workers:
+            self.signal(pid, signal.SIGTERM)
+        deadline = time.monotonic() + self.args.graceful_timeout
+        while self.workers and time.monotonic() < deadline:
+            for pid, _ in self.reap():
+                self.workers.pop(pid, None)
+            time.sleep(POLL_INTERVAL / 2)
+        for pid in list(self.workers):
+            self.signal(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+            del self.workers[pid]
+
+    def signal(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
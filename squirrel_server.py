@@ -1,26 +1,86 @@
+import argparse
+import gzip
 import json
+import os
+import select
+import socket
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from http.server import BaseHTTPRequestHandler, HTTPServer
-from urllib.parse import parse_qs
+from urllib.parse import parse_qs, quote, urlsplit
+import squirrel_admission
+import squirrel_cache
+import squirrel_db
+import squirrel_msgpack
+from squirrel_admission import admission
+from squirrel_cache import CacheEntry, etagMatches
 from squirrel_db import SquirrelDB
+from squirrel_metrics import metrics
+
+# Response encodings, by media type. JSON is what everyone gets unless they ask.
+JSON = "application/json"
+NDJSON = "application/x-ndjson"
+MSGPACK = "application/msgpack"
+# when a client likes several equally, the first one here wins
+ENCODINGS = (JSON, NDJSON, MSGPACK)
+# other names clients use for the same formats
+MEDIA_ALIASES = {
+    "application/ndjson": NDJSON,
+    "application/jsonl": NDJSON,
+    "application/x-msgpack": MSGPACK,
+    "application/vnd.msgpack": MSGPACK,
+}
+
+# how often a kept-alive connection waiting for its next request looks for
+# another connection that needs its worker
+IDLE_CHECK_INTERVAL = 0.05
+
+# GET /squirrels filters: query parameter -> SquirrelDB.findSquirrels keyword
+FILTERS = {"size": "size", "name_prefix": "namePrefix", "q": "text"}
 
 class SquirrelServerHandler(BaseHTTPRequestHandler):
 
+    # keep connections open between requests when the client speaks HTTP/1.1
+    protocol_version = "HTTP/1.1"
+
+    # largest ?limit= a client may ask for, and rows fetched per chunk when streaming
+    maxPageSize = 1000
+    streamChunkSize = 500
+
+    # longest ?wait= on GET /squirrels/changes, and how often a waiting request
+    # looks for writes from other processes, which don't wake it
+    maxChangesWait = 30
+    changesPollInterval = 0.25
+
+    # bodies smaller than this go out uncompressed even to gzip clients; level 0 never compresses
+    gzipMinBytes = 1024
+    gzipLevel = 6
+
     # HTTP METHODS
 
     def do_GET(self):
         resourceName, resourceId = self.parsePath()
         if resourceName == "squirrels":
-            if resourceId:
+            # before the id route, which would take "changes" for an id
+            if resourceId == "changes":
+                self.handleSquirrelsChanges()
+            elif resourceId:
                 self.handleSquirrelsRetrieve(resourceId)
             else:
                 self.handleSquirrelsIndex()
+        elif resourceName == "metrics" and not resourceId:
+            self.handleMetrics()
         else:
             self.handle404()
 
     def do_POST(self):
         resourceName, resourceId = self.parsePath()
         if resourceName == "squirrels":
-            if resourceId:
+            if resourceId == "_bulk":
+                self.handleSquirrelsBulk()
+            elif resourceId:
                 self.handle404()
             else:
                 self.handleSquirrelsCreate()
@@ -49,84 +109,962 @@ class SquirrelServerHandler(BaseHTTPRequestHandler):
 
     # HELPERS
 
-    def getRequestData(self):
+    # every request on a kept-alive connection starts with an unread body, and
+    # its clock starts here rather than while the connection sat idle
+    def parse_request(self):
+        self.requestDataRead = False
+        self.requestStarted = time.perf_counter()
+        self.route = "other"
+        self.responseStatus = None
+        metrics.inc("squirrel_http_requests_in_flight")
+        return super().parse_request() and self.admit()
+
+    # Takes the request's place under its route limits (see squirrel_admission),
+    # or answers 503 so the do_ method is never called.
+    def admit(self):
+        if admission.routeLimits:
+            self.parsePath()
+        keys = admission.admit(self.command, self.route)
+        if keys is None:
+            self.handle503()
+            return False
+        self.admitted = keys
+        return True
+
+    # BaseHTTPRequestHandler.handle, except that between requests on a kept-alive
+    # connection it waits in awaitRequest instead of blocking in readline
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection and self.awaitRequest():
+            self.handle_one_request()
+
+    # Waits for the client's next request. A server with othersWaiting (the
+    # threads engine) gets the worker back as soon as another connection needs
+    # it, rather than once idleTimeout is up. False when the connection should close.
+    def awaitRequest(self):
+        othersWaiting = getattr(self.server, "othersWaiting", None)
+        if othersWaiting is None:
+            return True
+        deadline = time.monotonic() + self.server.idleTimeout
+        while not self.requestPending():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or othersWaiting():
+                return False
+            readable, _, _ = select.select([self.connection], [], [], min(remaining, IDLE_CHECK_INTERVAL))
+            # readable with nothing to read is the client hanging up
+            if readable and not self.requestPending():
+                return False
+        return True
+
+    # whether more of the client's bytes are buffered or waiting on the socket, without blocking
+    def requestPending(self):
+        timeout = self.connection.gettimeout()
+        self.connection.setblocking(False)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(timeout)
+
+    def handle_one_request(self):
+        self.requestStarted = None
+        self.admitted = ()
+        try:
+            super().handle_one_request()
+        finally:
+            admission.release(self.admitted)
+            if self.requestStarted is not None:
+                self.recordRequest()
+                countRequest = getattr(self.server, "countRequest", None)
+                # a worker on its way out finishes this request, then hangs up
+                if countRequest is not None and not countRequest():
+                    self.close_connection = True
+
+    # a handler that raised before it answered is counted as the 500 it amounts to
+    def recordRequest(self):
+        status = 500 if self.responseStatus is None else self.responseStatus
+        labels = (("route", self.route), ("method", self.command or "-"), ("status", str(status)))
+        metrics.observe("squirrel_http_request_duration_seconds", labels, time.perf_counter() - self.requestStarted)
+        metrics.dec("squirrel_http_requests_in_flight")
+
+    def send_response(self, code, message=None):
+        self.responseStatus = code
+        super().send_response(code, message)
+
+    def getRequestBody(self):
         length = int(self.headers["Content-Length"])
-        body = self.rfile.read(length).decode("utf-8")
+        body = self.rfile.read(length)
+        self.requestDataRead = True
+        return body
+
+    # a form, JSON, NDJSON or msgpack body (by Content-Type) as a dict, or ValueError
+    def getRequestData(self):
+        contentType = mediaType(self.headers.get("Content-Type"))
+        if contentType in ENCODINGS:
+            data = decodeOne(self.getRequestBody(), contentType)
+            if not isinstance(data, dict):
+                raise ValueError("expected an object")
+            return data
+        body = self.getRequestBody().decode("utf-8")
         data = parse_qs(body)
         for key in data:
             data[key] = data[key][0]
         return data
 
+    # what the Accept header asks the squirrels to be sent back as
+    def responseEncoding(self):
+        return negotiate(self.headers.get("Accept"))
+
+    # whether a body of `size` bytes is big enough to gzip for some client
+    def compressible(self, size):
+        return self.gzipLevel > 0 and size >= self.gzipMinBytes
+
+    # whether to gzip a body of `size` bytes for this client
+    def wantsGzip(self, size=None):
+        if self.gzipLevel <= 0 or (size is not None and size < self.gzipMinBytes):
+            return False
+        return acceptsGzip(self.headers.get("Accept-Encoding"))
+
+    # splits "/squirrels/1?x=y" into ("squirrels", "1") and keeps {"x": "y"} in self.query
     def parsePath(self):
         if self.path.startswith("/"):
-            parts = self.path[1:].split("/")
+            url = urlsplit(self.path)
+            self.query = {key: values[0] for key, values in parse_qs(url.query).items()}
+            parts = url.path[1:].split("/")
             resourceName = parts[0]
             resourceId = None
             if len(parts) > 1:
                 resourceId = parts[1]
+            self.route = routeLabel(resourceName, resourceId)
             return (resourceName, resourceId)
         return False
 
-    # ACTIONS
+    # reads an integer query parameter, raising ValueError when it is out of range
+    def getQueryInt(self, name, default=None, minimum=0, maximum=None):
+        value = getattr(self, "query", {}).get(name)
+        if value is None:
+            return default
+        number = int(value)
+        if maximum is None and number < minimum:
+            raise ValueError(f"{name} must be at least {minimum}")
+        if maximum is not None and not minimum <= number <= maximum:
+            raise ValueError(f"{name} must be between {minimum} and {maximum}")
+        return number
 
-    def handleSquirrelsIndex(self):
-        db = SquirrelDB()
-        squirrelsList = db.getSquirrels()
-        self.send_response(200)
-        self.send_header("Content-Type", "application/json")
+    # the FILTERS in the query string as findSquirrels keywords; a q without any words is no filter
+    def getFilters(self):
+        query = getattr(self, "query", {})
+        filters = {keyword: query[name] for name, keyword in FILTERS.items() if name in query}
+        if "text" in filters and not filters["text"].split():
+            del filters["text"]
+        return filters
+
+    # skip a body we are not going to use so the next request on the connection parses cleanly
+    def discardRequestData(self):
+        length = self.headers.get("Content-Length") if self.headers else None
+        if length and not getattr(self, "requestDataRead", True):
+            self.rfile.read(int(length))
+            self.requestDataRead = True
+
+    # gzips the body when the client takes it and it is big enough; pass
+    # compress=False for a body that is already encoded
+    def sendBody(self, status, contentType, body, headers=None, compress=True):
+        if compress and self.compressible(len(body)):
+            headers = dict(headers or {})
+            headers["Vary"] = ", ".join(filter(None, (headers.get("Vary"), "Accept-Encoding")))
+            if self.wantsGzip():
+                body = gzipBody(body, self.gzipLevel)
+                headers["Content-Encoding"] = "gzip"
+        self.send_response(status)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
         self.end_headers()
-        self.wfile.write(bytes(json.dumps(squirrelsList), "utf-8"))
+        self.wfile.write(body)
+        metrics.inc("squirrel_http_response_bytes_total", (("route", self.route),), len(body))
 
-    def handleSquirrelsRetrieve(self, squirrelId):
-        db = SquirrelDB()
-        squirrel = db.getSquirrel(squirrelId)
-        if squirrel:
-            self.send_response(200)
-            self.send_header("Content-Type", "application/json")
+    # Answer a GET from the response cache when we can. Otherwise `render` is
+    # called with the negotiated encoding to read the database; it returns
+    # (body, extra headers), or None for a 404. Either way the client gets an
+    # ETag, and a matching If-None-Match gets a 304 without a body.
+    #
+    # A gzip client gets the body compressed once and cached next to it, under
+    # its own key and ETag, so polling an unchanged resource costs no deflate.
+    def sendCached(self, key, render):
+        encoding = self.responseEncoding()
+        key = cacheKey(key, encoding)
+        cache = squirrel_cache.cache
+        # read before anything is rendered or compressed, see ResponseCache.put
+        generation = cache.generation if cache else None
+        entry = cache.get(key) if cache else None
+        if entry is None:
+            rendered = render(encoding)
+            if rendered is None:
+                self.handle404()
+                return
+            entry = CacheEntry(*rendered)
+            if cache:
+                cache.put(key, entry, generation)
+        vary = "Accept"
+        if self.compressible(len(entry.body)):
+            vary = "Accept, Accept-Encoding"
+            if self.wantsGzip():
+                entry = self.gzipEntry(key + ("gzip",), entry, generation)
+        if etagMatches(self.headers.get("If-None-Match"), entry.etag):
+            self.send_response(304)
+            self.send_header("ETag", entry.etag)
+            self.send_header("Vary", vary)
             self.end_headers()
-            self.wfile.write(bytes(json.dumps(squirrel), "utf-8"))
         else:
-            self.handle404()
+            self.sendBody(200, encoding, entry.body, dict(entry.headers, ETag=entry.etag, Vary=vary), compress=False)
 
-    def handleSquirrelsCreate(self):
-        db = SquirrelDB()
-        body = self.getRequestData()
-        db.createSquirrel(body["name"], body["size"])
-        self.send_response(201)
+    # the gzipped twin of a cache entry, compressed only when it isn't cached
+    def gzipEntry(self, key, entry, generation):
+        cache = squirrel_cache.cache
+        gzipped = cache.get(key) if cache else None
+        if gzipped is None:
+            headers = dict(entry.headers, **{"Content-Encoding": "gzip"})
+            gzipped = CacheEntry(gzipBody(entry.body, self.gzipLevel), headers, gzipEtag(entry.etag))
+            if cache:
+                cache.put(key, gzipped, generation)
+        return gzipped
+
+    # HTTP/1.1 clients get chunked transfer encoding; HTTP/1.0 clients read until we close.
+    # A gzip client gets the stream deflated as it goes, so it is never held whole.
+    def startStream(self, status, contentType):
+        self.chunked = self.request_version >= "HTTP/1.1"
+        self.compressor = None
+        self.send_response(status)
+        self.send_header("Content-Type", contentType)
+        if self.gzipLevel > 0:
+            self.send_header("Vary", "Accept, Accept-Encoding")
+            if self.wantsGzip():
+                self.compressor = zlib.compressobj(self.gzipLevel, zlib.DEFLATED, GZIP_WBITS)
+                self.send_header("Content-Encoding", "gzip")
+        if self.chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        else:
+            self.close_connection = True
         self.end_headers()
 
+    def writeStream(self, data):
+        if self.compressor:
+            data = self.compressor.compress(data)
+        self.writeChunk(data)
+
+    def writeChunk(self, data):
+        if not data:
+            return
+        if self.chunked:
+            self.wfile.write(b"%X\r\n%s\r\n" % (len(data), data))
+        else:
+            self.wfile.write(data)
+        metrics.inc("squirrel_http_response_bytes_total", (("route", self.route),), len(data))
+
+    def endStream(self):
+        if self.compressor:
+            self.writeChunk(self.compressor.flush())
+        if self.chunked:
+            self.wfile.write(b"0\r\n\r\n")
+
+    # 204 and 304 responses must not carry a Content-Length of 0, everything else gets one
+    def sendEmpty(self, status):
+        self.send_response(status)
+        if status not in (204, 304):
+            self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    # ACTIONS
+
+    # GET /squirrels                      whole list in one body
+    # GET /squirrels?limit=N&after_id=X    one page, with a Link header to the next page
+    # GET /squirrels?stream=1              whole list, streamed in chunks off the cursor
+    # Any of them narrowed by ?size=, ?name_prefix= and ?q= (see FILTERS)
+    def handleSquirrelsIndex(self):
+        query = getattr(self, "query", {})
+        filters = self.getFilters()
+        if "limit" in query or "after_id" in query:
+            self.handleSquirrelsPage(filters)
+        elif query.get("stream") in ("1", "true"):
+            self.handleSquirrelsStream(filters)
+        else:
+            self.sendCached(("list",) + filterKey(filters), lambda encoding: self.renderSquirrelsList(encoding, filters))
+
+    # sqlite renders the JSON (and each NDJSON line), so those bytes never pass through a Python dict
+    def renderSquirrelsList(self, encoding=JSON, filters=None):
+        with SquirrelDB() as db:
+            if encoding == MSGPACK:
+                return squirrel_msgpack.packb(db.findSquirrels(**filters) if filters else db.getSquirrels()), {}
+            if encoding == NDJSON:
+                return b"".join(ndjsonLines(rows) for rows in db.iterSquirrelsJson(self.streamChunkSize, **(filters or {}))), {}
+            if filters:
+                return bytes("[" + ",".join(db.findSquirrelsJson(**filters)) + "]", "utf-8"), {}
+            squirrelsJson = db.getSquirrelsJson()
+        return bytes(squirrelsJson, "utf-8"), {}
+
+    def handleSquirrelsPage(self, filters=None):
+        filters = filters or {}
+        try:
+            limit = self.getQueryInt("limit", self.maxPageSize, 1, self.maxPageSize)
+            afterId = self.getQueryInt("after_id", 0)
+        except ValueError as e:
+            self.handle400(str(e))
+            return
+        self.sendCached(("page", limit, afterId) + filterKey(filters),
+                        lambda encoding: self.renderSquirrelsPage(limit, afterId, encoding, filters))
+
+    def renderSquirrelsPage(self, limit, afterId, encoding=JSON, filters=None):
+        # one extra row tells us whether there is a next page without a COUNT(*)
+        with SquirrelDB() as db:
+            if filters:
+                squirrelsList = db.findSquirrels(limit=limit + 1, afterId=afterId, **filters)
+            else:
+                squirrelsList = db.getSquirrelsPage(limit + 1, afterId)
+        headers = {}
+        if len(squirrelsList) > limit:
+            squirrelsList = squirrelsList[:limit]
+            nextAfterId = squirrelsList[-1]["id"]
+            # the next page keeps the same filters
+            filterQuery = "".join(f"&{name}={quote(self.query[name])}" for name, keyword in FILTERS.items()
+                                  if keyword in filters)
+            headers["Link"] = f'</squirrels?limit={limit}&after_id={nextAfterId}{filterQuery}>; rel="next"'
+        return encodeMany(squirrelsList, encoding), headers
+
+    # JSON is one array; NDJSON is a line per squirrel; msgpack is one map per
+    # squirrel back to back, since an array would need the count up front.
+    # The rows come off one cursor, so the stream keeps its pooled connection
+    # until the client has read the last chunk.
+    def handleSquirrelsStream(self, filters=None):
+        filters = filters or {}
+        encoding = self.responseEncoding()
+        with SquirrelDB() as db:
+            self.startStream(200, encoding)
+            if encoding == MSGPACK:
+                for rows in db.iterSquirrels(self.streamChunkSize, **filters):
+                    self.writeStream(b"".join(squirrel_msgpack.packb(row) for row in rows))
+            elif encoding == NDJSON:
+                for rows in db.iterSquirrelsJson(self.streamChunkSize, **filters):
+                    self.writeStream(ndjsonLines(rows))
+            else:
+                self.writeStream(b"[")
+                separator = b""
+                for rows in db.iterSquirrelsJson(self.streamChunkSize, **filters):
+                    self.writeStream(separator + bytes(",".join(rows), "utf-8"))
+                    separator = b","
+                self.writeStream(b"]")
+            self.endStream()
+
+    # GET /squirrels/changes?since=SEQ[&limit=N][&wait=SECONDS]
+    # The changes after seq SEQ, oldest first. With wait, an empty answer is
+    # held back until a change arrives or the seconds run out (a long poll).
+    # A client whose SEQ is older than the pruned tombstones, or newer than
+    # anything this database has logged, gets 410 and starts over from 0.
+    def handleSquirrelsChanges(self):
+        try:
+            since = self.getQueryInt("since", 0)
+            limit = self.getQueryInt("limit", self.maxPageSize, 1, self.maxPageSize)
+            wait = self.getQueryInt("wait", 0, 0, self.maxChangesWait)
+        except ValueError as e:
+            self.handle400(str(e))
+            return
+        deadline = time.monotonic() + wait
+        while True:
+            generation = squirrel_db.changeSignal.generation
+            # one extra row says whether there are more
+            with SquirrelDB() as db:
+                changes = db.getChanges(since, limit + 1)
+                horizon, latest = db.getChangeBounds()
+            if 0 < since < horizon or since > latest:
+                self.handle410(f"changes after {since} are gone, start again from since=0")
+                return
+            remaining = deadline - time.monotonic()
+            if changes or remaining <= 0:
+                break
+            squirrel_db.changeSignal.wait(generation, min(remaining, self.changesPollInterval))
+        more = len(changes) > limit
+        changes = [changeRecord(change) for change in changes[:limit]]
+        body = {"changes": changes, "last_seq": changes[-1]["seq"] if changes else since, "more": more}
+        encoding = self.responseEncoding()
+        self.sendBody(200, encoding, encodeOne(body, encoding), {"Cache-Control": "no-store", "Vary": "Accept"})
+
+    def handleSquirrelsRetrieve(self, squirrelId):
+        self.sendCached(("item", squirrel_cache.itemKey(squirrelId)), lambda encoding: self.renderSquirrel(squirrelId, encoding))
+
+    def renderSquirrel(self, squirrelId, encoding=JSON):
+        with SquirrelDB() as db:
+            if encoding == MSGPACK:
+                squirrel = db.getSquirrel(squirrelId)
+                return (squirrel_msgpack.packb(squirrel), {}) if squirrel else None
+            squirrelJson = db.getSquirrelJson(squirrelId)
+        if squirrelJson:
+            return bytes(squirrelJson + "\n" if encoding == NDJSON else squirrelJson, "utf-8"), {}
+        return None
+
+    def handleSquirrelsCreate(self):
+        fields = self.getSquirrelFields()
+        if fields is None:
+            return
+        with SquirrelDB() as db:
+            squirrel = db.createSquirrel(*fields)
+        invalidateCache()
+        encoding = self.responseEncoding()
+        self.sendBody(201, encoding, encodeOne(squirrel, encoding), {"Location": f"/squirrels/{squirrel['id']}"})
+
+    # (name, size) from a POST or PUT body, or None after answering 400
+    def getSquirrelFields(self):
+        try:
+            body = self.getRequestData()
+            fields = body["name"], body["size"]
+        except ValueError as e:
+            self.handle400(f"unreadable body: {e}")
+            return None
+        except KeyError as e:
+            self.handle400(f"missing field {e}")
+            return None
+        # a JSON or msgpack body can carry lists and maps, which sqlite can't store
+        for field, value in zip(("name", "size"), fields):
+            if not squirrel_db.isFieldValue(value):
+                self.handle400(f"{field} must be a string or a number")
+                return None
+        return fields
+
+    # POST /squirrels/_bulk with a JSON array or NDJSON (one operation per line);
+    # see SquirrelDB.applyBulk for the operation format
+    def handleSquirrelsBulk(self):
+        if not self.headers.get("Content-Length"):
+            self.handle400("missing body")
+            return
+        contentType = mediaType(self.headers.get("Content-Type"))
+        try:
+            if contentType == MSGPACK:
+                operations = parseBulkMsgpack(self.getRequestBody())
+            else:
+                operations = parseBulkBody(self.getRequestBody().decode("utf-8"))
+        except ValueError as e:
+            self.handle400(f"invalid {'msgpack' if contentType == MSGPACK else 'JSON'}: {e}")
+            return
+        with SquirrelDB() as db:
+            results = db.applyBulk(operations)
+        invalidateCache([result["id"] for result in results if result.get("op") in ("update", "delete")])
+        errors = any(result["status"] >= 400 for result in results)
+        encoding = self.responseEncoding()
+        self.sendBody(200, encoding, encodeOne({"errors": errors, "results": results}, encoding))
+
     def handleSquirrelsUpdate(self, squirrelId):
-        db = SquirrelDB()
-        squirrel = db.getSquirrel(squirrelId)
+        fields = self.getSquirrelFields()
+        if fields is None:
+            return
+        with SquirrelDB() as db:
+            squirrel = db.updateSquirrel(squirrelId, *fields)
         if squirrel:
-            body = self.getRequestData()
-            db.updateSquirrel(squirrelId, body["name"], body["size"])
-            self.send_response(204)
-            self.end_headers()
+            # the id sqlite matched, however the path spelled it
+            invalidateCache([squirrel["id"]])
+            encoding = self.responseEncoding()
+            self.sendBody(200, encoding, encodeOne(squirrel, encoding))
         else:
             self.handle404()
 
     def handleSquirrelsDelete(self, squirrelId):
-        db = SquirrelDB()
-        squirrel = db.getSquirrel(squirrelId)
+        with SquirrelDB() as db:
+            squirrel = db.deleteSquirrel(squirrelId)
         if squirrel:
-            db.deleteSquirrel(squirrelId)
-            self.send_response(204)
-            self.end_headers()
+            invalidateCache([squirrel["id"]])
+            self.sendEmpty(204)
         else:
             self.handle404()
 
+    # GET /metrics in the Prometheus text format
+    def handleMetrics(self):
+        self.sendBody(200, "text/plain; version=0.0.4; charset=utf-8", bytes(metrics.render(), "utf-8"))
+
+    def handle400(self, message="Bad Request"):
+        self.discardRequestData()
+        self.sendBody(400, "text/plain", bytes(f"400 Bad Request: {message}", "utf-8"))
+
     def handle404(self):
-        self.send_response(404)
-        self.send_header("Content-Type", "text/plain")
-        self.end_headers()
-        self.wfile.write(bytes("404 Not Found", "utf-8"))
+        self.discardRequestData()
+        self.sendBody(404, "text/plain", bytes("404 Not Found", "utf-8"))
+
+    def handle410(self, message="Gone"):
+        self.discardRequestData()
+        self.sendBody(410, "text/plain", bytes(f"410 Gone: {message}", "utf-8"))
+
+    def handle503(self):
+        self.discardRequestData()
+        self.sendBody(503, "text/plain", bytes("503 Service Unavailable", "utf-8"),
+                      {"Retry-After": str(admission.retryAfter)})
+
+# a fixed set of route names for metric labels, so ids don't blow up the label count
+def routeLabel(resourceName, resourceId):
+    if resourceName == "squirrels":
+        if not resourceId:
+            return "/squirrels"
+        if resourceId == "_bulk":
+            return "/squirrels/_bulk"
+        if resourceId == "changes":
+            return "/squirrels/changes"
+        return "/squirrels/{id}"
+    if resourceName == "metrics":
+        return "/metrics"
+    return "other"
+
+# a change log row as clients see it: a tombstone has no name or size
+def changeRecord(change):
+    if change["op"] == "delete":
+        return {"seq": change["seq"], "op": "delete", "id": change["id"]}
+    return change
+
+# gzip or x-gzip with a q above 0, or * when gzip isn't named
+def acceptsGzip(acceptEncoding):
+    if not acceptEncoding:
+        return False
+    codings = {}
+    for part in acceptEncoding.split(","):
+        coding, _, params = part.partition(";")
+        codings[coding.strip().lower()] = qValue(params)
+    for coding in ("gzip", "x-gzip"):
+        if coding in codings:
+            return codings[coding] > 0
+    return codings.get("*", 0.0) > 0
+
+# mtime=0 keeps the output the same for the same body, and so its ETag
+def gzipBody(body, level):
+    return gzip.compress(body, level, mtime=0)
+
+# a different representation needs a different strong ETag; "abc" -> "abc-gzip"
+def gzipEtag(etag):
+    return etag[:-1] + '-gzip"'
+
+# the q of ";q=0.5" style media range or coding parameters, 1 when missing
+def qValue(params):
+    for param in params.split(";"):
+        name, _, value = param.partition("=")
+        if name.strip().lower() == "q":
+            try:
+                return float(value)
+            except ValueError:
+                return 0.0
+    return 1.0
+
+# compact, like the JSON sqlite renders for reads
+def renderJson(data):
+    return bytes(json.dumps(data, separators=(",", ":")), "utf-8")
+
+# "application/json; charset=utf-8" -> "application/json"
+def mediaType(header):
+    if not header:
+        return None
+    name = header.split(";", 1)[0].strip().lower()
+    return MEDIA_ALIASES.get(name, name)
+
+# The encoding the Accept header prefers. Each encoding takes the q of the most
+# specific range that matches it (exact, then application/*, then */*); the
+# highest q wins, then the more specific match. JSON when nothing we have is acceptable.
+def negotiate(accept):
+    if not accept:
+        return JSON
+    matches = {}
+    for part in accept.split(","):
+        mediaRange, _, params = part.partition(";")
+        mediaRange = mediaType(mediaRange)
+        q = qValue(params)
+        for encoding in ENCODINGS:
+            specificity = {encoding: 2, "application/*": 1, "*/*": 0}.get(mediaRange)
+            if specificity is not None and specificity > matches.get(encoding, (-1, 0.0))[0]:
+                matches[encoding] = (specificity, q)
+    ranked = [(q, specificity, -order, encoding) for order, encoding in enumerate(ENCODINGS)
+              for specificity, q in [matches.get(encoding, (-1, 0.0))] if q > 0]
+    return max(ranked)[3] if ranked else JSON
+
+# a gzip header and trailer around raw deflate, for zlib.compressobj
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+# filters as part of a cache key; no filters adds nothing, so plain listings keep their keys
+def filterKey(filters):
+    return tuple(sorted(filters.items()))
+
+# JSON keeps the short keys; the other encodings get their own entries
+def cacheKey(key, encoding):
+    return key if encoding == JSON else key + (encoding,)
+
+# one value in an encoding
+def encodeOne(data, encoding):
+    if encoding == MSGPACK:
+        return squirrel_msgpack.packb(data)
+    if encoding == NDJSON:
+        return renderJson(data) + b"\n"
+    return renderJson(data)
+
+# a list of rows: an array, or a line per row for NDJSON
+def encodeMany(rows, encoding):
+    if encoding == NDJSON:
+        return b"".join(renderJson(row) + b"\n" for row in rows)
+    return encodeOne(rows, encoding)
+
+# JSON object strings from sqlite as NDJSON lines
+def ndjsonLines(rows):
+    return bytes("\n".join(rows) + "\n", "utf-8")
+
+# a single value from a body in one of ENCODINGS; NDJSON must hold exactly one line
+def decodeOne(body, encoding):
+    if encoding == MSGPACK:
+        return squirrel_msgpack.unpackb(body)
+    text = body.decode("utf-8")
+    if encoding == NDJSON:
+        lines = [line for line in text.splitlines() if line.strip()]
+        if len(lines) != 1:
+            raise ValueError(f"expected one line, got {len(lines)}")
+        text = lines[0]
+    return json.loads(text)
+
+# called after every write; with no ids only the listings are dropped
+def invalidateCache(squirrelIds=()):
+    if squirrel_cache.cache:
+        squirrel_cache.cache.invalidateItems(squirrelIds)
+
+def clearCache():
+    if squirrel_cache.cache:
+        squirrel_cache.cache.clear()
+
+# a JSON array of operations, or newline-delimited JSON objects
+def parseBulkBody(text):
+    if text.lstrip().startswith("["):
+        operations = json.loads(text)
+        if not isinstance(operations, list):
+            raise ValueError("expected an array")
+        return operations
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+# one msgpack array of operations, or operation maps back to back
+def parseBulkMsgpack(body):
+    operations = list(squirrel_msgpack.unpackStream(body))
+    if len(operations) == 1 and isinstance(operations[0], list):
+        return operations[0]
+    return operations
+
+# Request counting and retiring, shared by both serving engines. The server
+# retires once maxRequests requests are done (0 for never): it stops accepting,
+# finishes what it has and lets serve_forever() return.
+class RecyclingServer:
+
+    def initRecycling(self, maxRequests):
+        self.maxRequests = maxRequests
+        self.requestsServed = 0
+        self.countLock = threading.Lock()
+        self.retiring = False
+        self.retireRequested = False
+        # Connections the kernel already queued on the socket are reset when it
+        # closes, so with this set a stopping server serves those first. Only for
+        # a socket of its own, like a pre-forked worker's with --reuse-port: a
+        # shared one keeps taking new connections while it drains.
+        self.drainOnStop = False
+
+    # called after every request; False once the server is retiring
+    def countRequest(self):
+        with self.countLock:
+            self.requestsServed += 1
+            if self.requestsServed == self.maxRequests:
+                self.onMaxRequests()
+            return not self.retiring
+
+    # the pre-forked master swaps this for asking it to start a replacement first
+    def onMaxRequests(self):
+        self.retire()
+
+    # serve_forever() returns once the loop notices; shutdown() blocks until then,
+    # so it can't run on the thread doing the serving
+    def retire(self):
+        if self.retiring:
+            return
+        self.retiring = True
+        threading.Thread(target=self.shutdown, daemon=True).start()
+
+    # For signal handlers, which must not start a thread: the handler may have
+    # interrupted this very thread inside Thread.start(), holding a lock it
+    # would wait on forever. The serve loop calls retireIfRequested() instead.
+    def requestRetire(self):
+        self.retireRequested = True
+
+    def retireIfRequested(self):
+        if self.retireRequested:
+            self.retire()
+
+# HTTPServer that hands each connection to a capped pool of worker threads
+# sock: an already listening socket to accept on instead of binding a new one,
+# as the pre-forked workers share the one their master bound.
+class ThreadPoolHTTPServer(RecyclingServer, HTTPServer):
+
+    def __init__(self, address, handlerClass, workers=8, backlog=64, idleTimeout=15, sock=None, maxRequests=0):
+        # listen() reads request_queue_size while the base class binds
+        self.request_queue_size = backlog
+        self.idleTimeout = idleTimeout
+        self.workers = workers
+        # connections handed to the pool and not finished yet, and whether the
+        # accept loop is waiting for one of them to finish
+        self.busy = 0
+        self.waiting = False
+        self.workerFree = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="squirrel-worker")
+        self.initRecycling(maxRequests)
+        super().__init__(address, handlerClass, bind_and_activate=sock is None)
+        if sock is not None:
+            self.socket.close()
+            self.socket = sock
+            self.server_address = sock.getsockname()
+            self.server_name = socket.getfqdn(self.server_address[0])
+            self.server_port = self.server_address[1]
+
+    def serve_forever(self, poll_interval=0.5):
+        super().serve_forever(poll_interval)
+        if self.drainOnStop:
+            self.drain()
+
+    # serve_forever() calls this every time round its loop
+    def service_actions(self):
+        self.retireIfRequested()
+        admission.reloadIfChanged()
+
+    # by then serve_forever() has returned, so nothing else is accepting
+    def drain(self):
+        while select.select([self.socket], [], [], 0)[0]:
+            try:
+                request, clientAddress = self.socket.accept()
+            except BlockingIOError:
+                break
+            self.process_request(request, clientAddress)
+
+    def process_request(self, request, client_address):
+        # idle keep-alive connections give their worker back after this many seconds
+        request.settimeout(self.idleTimeout)
+        # headers and body go out in separate writes; without this, Nagle holds the
+        # body back until the client's delayed ACK arrives (~40ms per response)
+        request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if not admission.enqueue():
+            self.refuse(request)
+            return
+        self.waitForWorker()
+        self.executor.submit(self.processRequestWorker, request, client_address)
+
+    # Without --max-queue the accept loop only takes a connection once a worker
+    # is free for it, so the rest wait in the kernel's --backlog rather than in
+    # an unbounded queue here. With it, admission bounds the queue and sheds.
+    def waitForWorker(self):
+        with self.workerFree:
+            while self.busy >= self.workers and not admission.maxQueue:
+                self.waiting = True
+                self.workerFree.wait()
+            self.waiting = False
+            self.busy += 1
+
+    # whether a connection is waiting for a worker, so idle keep-alive ones should give theirs up
+    def othersWaiting(self):
+        return self.waiting or self.busy > self.workers
+
+    # Answers 503 on the accepting thread and hangs up. Whatever the client has
+    # already sent is read first: closing on unread data resets the connection,
+    # which can throw away the 503 before the client reads it.
+    def refuse(self, request):
+        try:
+            request.sendall(squirrel_admission.refusal(admission.retryAfter))
+            request.shutdown(socket.SHUT_WR)
+            request.setblocking(False)
+            while request.recv(65536):
+                pass
+        except OSError:
+            pass
+        finally:
+            self.shutdown_request(request)
+
+    def processRequestWorker(self, request, client_address):
+        admission.dequeue()
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            with self.workerFree:
+                self.busy -= 1
+                self.workerFree.notify()
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=True)
+
+ENGINES = ("threads", "asyncio")
+
+# most seconds between looks for tombstones past --change-retention
+CHANGE_PRUNE_INTERVAL = 60
+
+# command line flags win over SQUIRREL_* environment variables, which win over the defaults
+def parseArgs(argv=None, environ=None):
+    environ = os.environ if environ is None else environ
+    parser = argparse.ArgumentParser(description="Run the squirrel server.")
+    parser.add_argument("--host", default=environ.get("SQUIRREL_HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(environ.get("SQUIRREL_PORT", 8080)))
+    parser.add_argument("--engine", choices=ENGINES, default=environ.get("SQUIRREL_ENGINE", "threads"),
+                        help="threads: a worker thread per connection; asyncio: connections on an event "
+                             "loop, with only the request handlers on worker threads")
+    parser.add_argument("--workers", type=int, default=int(environ.get("SQUIRREL_WORKERS", 8)),
+                        help="threads running requests; with the threads engine, also the most "
+                             "connections served at once")
+    parser.add_argument("--backlog", type=int, default=int(environ.get("SQUIRREL_BACKLOG", 64)),
+                        help="pending connections the OS queues before refusing")
+    parser.add_argument("--idle-timeout", type=float, default=float(environ.get("SQUIRREL_IDLE_TIMEOUT", 15)),
+                        help="seconds an idle keep-alive connection is held open")
+    parser.add_argument("--db", default=environ.get("SQUIRREL_DB", squirrel_db.DEFAULT_DB_PATH),
+                        help="path to the sqlite database file")
+    parser.add_argument("--pool-size", type=int,
+                        default=int(environ.get("SQUIRREL_POOL_SIZE", squirrel_db.DEFAULT_POOL_SIZE)),
+                        help="sqlite connections shared by the workers")
+    parser.add_argument("--cache-entries", type=int,
+                        default=int(environ.get("SQUIRREL_CACHE_ENTRIES", squirrel_cache.DEFAULT_MAX_ENTRIES)),
+                        help="responses kept in the read cache, 0 turns it off")
+    parser.add_argument("--cache-bytes", type=int,
+                        default=int(environ.get("SQUIRREL_CACHE_BYTES", squirrel_cache.DEFAULT_MAX_BYTES)),
+                        help="total body bytes kept in the read cache")
+    parser.add_argument("--group-commit", action=argparse.BooleanOptionalAction,
+                        default=environ.get("SQUIRREL_GROUP_COMMIT", "1") != "0",
+                        help="switch the database to WAL and commit concurrent writes together")
+    parser.add_argument("--commit-delay", type=float, default=float(environ.get("SQUIRREL_COMMIT_DELAY", 0)),
+                        help="milliseconds a group commit waits for more writes to join it")
+    parser.add_argument("--commit-batch", type=int, default=int(environ.get("SQUIRREL_COMMIT_BATCH", 64)),
+                        help="most writes in one group commit")
+    parser.add_argument("--durability", choices=sorted(squirrel_db.DURABILITY_LEVELS),
+                        default=environ.get("SQUIRREL_DURABILITY"),
+                        help="full (the default): every acknowledged write survives power loss; normal: "
+                             "the last few may not, but commits are cheaper; off: leave syncing to the OS. "
+                             "Needs group commit")
+    parser.add_argument("--replica", action=argparse.BooleanOptionalAction,
+                        default=environ.get("SQUIRREL_REPLICA", "0") != "0",
+                        help="keep the squirrels table in memory and answer plain reads from there. "
+                             "Needs --processes 1")
+    parser.add_argument("--replica-check", type=float, default=float(environ.get("SQUIRREL_REPLICA_CHECK", 1)),
+                        help="seconds between checks that the in-memory table still matches the file")
+    parser.add_argument("--change-retention", type=float,
+                        default=float(environ.get("SQUIRREL_CHANGE_RETENTION", 7 * 24 * 3600)),
+                        help="seconds deleted squirrels stay in the change log, 0 keeps them for good")
+    parser.add_argument("--processes", type=int, default=int(environ.get("SQUIRREL_PROCESSES", 1)),
+                        help="fork this many worker processes to serve on every core, 1 serves in this process")
+    parser.add_argument("--max-requests", type=int, default=int(environ.get("SQUIRREL_MAX_REQUESTS", 0)),
+                        help="replace a worker process after it has served this many requests, 0 for never")
+    parser.add_argument("--reuse-port", action=argparse.BooleanOptionalAction,
+                        default=environ.get("SQUIRREL_REUSE_PORT", "0") != "0",
+                        help="give every worker process its own SO_REUSEPORT socket instead of sharing one")
+    parser.add_argument("--graceful-timeout", type=float,
+                        default=float(environ.get("SQUIRREL_GRACEFUL_TIMEOUT", 30)),
+                        help="seconds a stopping worker process gets to finish its requests")
+    parser.add_argument("--gzip-min-bytes", type=int,
+                        default=int(environ.get("SQUIRREL_GZIP_MIN_BYTES", SquirrelServerHandler.gzipMinBytes)),
+                        help="smallest response body gzipped for clients that accept it")
+    parser.add_argument("--gzip-level", type=int,
+                        default=int(environ.get("SQUIRREL_GZIP_LEVEL", SquirrelServerHandler.gzipLevel)),
+                        help="gzip compression level from 1 (fastest) to 9 (smallest), 0 turns gzip off")
+    parser.add_argument("--max-queue", type=int, default=int(environ.get("SQUIRREL_MAX_QUEUE", 0)),
+                        help="requests that may wait for a worker thread before more get a 503, 0 for no limit")
+    parser.add_argument("--route-limit", action="append", dest="route_limits",
+                        default=[item for item in environ.get("SQUIRREL_ROUTE_LIMITS", "").split(",") if item],
+                        help="most requests running at once for a route, e.g. 'GET /squirrels=2' "
+                             "(repeatable); more get a 503")
+    parser.add_argument("--retry-after", type=int, default=int(environ.get("SQUIRREL_RETRY_AFTER", 1)),
+                        help="seconds a 503 tells the client to wait before trying again")
+    parser.add_argument("--admission-config", default=environ.get("SQUIRREL_ADMISSION_CONFIG"),
+                        help="JSON file of max_queue, route_limits and retry_after, re-read whenever it changes")
+    args = parser.parse_args(argv)
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.pool_size < 1:
+        parser.error("--pool-size must be at least 1")
+    # the pool's connections keep sqlite's own journal, where these levels don't mean the same
+    if args.durability is not None and not args.group_commit:
+        parser.error("--durability only applies with group commit, so not with --no-group-commit")
+    args.durability = args.durability or "full"
+    if args.replica_check < 0:
+        parser.error("--replica-check must not be negative")
+    if args.change_retention < 0:
+        parser.error("--change-retention must not be negative")
+    if args.processes < 1:
+        parser.error("--processes must be at least 1")
+    # each worker would miss the others' writes until its next check, so a client
+    # could fail to read back what it just wrote through another worker
+    if args.replica and args.processes > 1:
+        parser.error("--replica serves one process's writes, so not with --processes above 1")
+    if not 0 <= args.gzip_level <= 9:
+        parser.error("--gzip-level must be between 0 and 9")
+    if args.reuse_port and not hasattr(socket, "SO_REUSEPORT"):
+        parser.error("--reuse-port needs SO_REUSEPORT, which this platform lacks")
+    if args.max_queue < 0:
+        parser.error("--max-queue must not be negative")
+    if args.retry_after < 0:
+        parser.error("--retry-after must not be negative")
+    try:
+        args.route_limits = squirrel_admission.parseRouteLimits(args.route_limits)
+    except ValueError as e:
+        parser.error(f"--route-limit: {e}")
+    return args
+
+# the connection pool, group committer, replica, change log pruning, cache and
+# admission limits a serving process needs; sharedVersion is passed on to the
+# cache (see squirrel_cache.ResponseCache)
+# A prefork worker (see squirrel_prefork) skips what its master does once for
+# all of them: the schema before forking, and pruning the change log.
+def configureServices(args, sharedVersion=None, worker=False):
+    if not worker:
+        squirrel_db.ensureSchema(args.db)
+    squirrel_db.configurePool(args.db, args.pool_size)
+    if args.group_commit:
+        squirrel_db.configureGroupCommit(args.db, maxDelay=args.commit_delay / 1000,
+                                         maxBatch=args.commit_batch, durability=args.durability)
+    if args.replica:
+        replica = squirrel_db.configureReplica(args.db, checkInterval=args.replica_check)
+        # a reload means someone else wrote, so cached responses may be out of date too
+        replica.onReload = clearCache
+    if args.change_retention and not worker:
+        squirrel_db.configureChangeLog(args.db, **changeLogOptions(args))
+    squirrel_cache.configureCache(args.cache_entries, args.cache_bytes, sharedVersion)
+    admission.configure(args.max_queue, args.route_limits, args.retry_after, args.admission_config)
+
+def changeLogOptions(args):
+    return {"retention": args.change_retention, "interval": min(args.change_retention, CHANGE_PRUNE_INTERVAL)}
+
+def closeServices():
+    squirrel_db.closeChangeLog()
+    squirrel_db.closeReplica()
+    squirrel_db.closeGroupCommit()
+    squirrel_db.closePool()
+
+def makeServer(args, sock=None, maxRequests=0, sharedVersion=None, worker=False):
+    configureServices(args, sharedVersion, worker)
+    # a handler subclass of its own, so one server's gzip settings never reach another's
+    handlerClass = type("SquirrelServerHandler", (SquirrelServerHandler,),
+                        {"gzipMinBytes": args.gzip_min_bytes, "gzipLevel": args.gzip_level})
+    serverClass = ThreadPoolHTTPServer
+    if args.engine == "asyncio":
+        # imported here because squirrel_async builds on this module
+        from squirrel_async import AsyncHTTPServer as serverClass
+    listen = (args.host, args.port)
+    return serverClass(listen, handlerClass, args.workers, args.backlog, args.idle_timeout,
+                       sock=sock, maxRequests=maxRequests)
 
-def run():
-    print("squirrel_server running at 127.0.0.1:8080")
-    listen = ("127.0.0.1", 8080)
-    server = HTTPServer(listen, SquirrelServerHandler)
-    server.serve_forever()
+def run(argv=None):
+    args = parseArgs(argv)
+    if args.processes > 1:
+        # imported here because squirrel_prefork builds on this module
+        import squirrel_prefork
+        squirrel_prefork.PreforkMaster(args).run()
+        return
+    server = makeServer(args)
+    print(f"squirrel_server running at {args.host}:{args.port} ({args.workers} workers, {args.engine})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        closeServices()
 
 if __name__ == '__main__':
     run()
@@ -1,6 +1,9 @@
+import multiprocessing
 import os
+import pickle
+import threading
 import pytest
-from mydb import MyDB
+from mydb import MyDB, MyLogDB, LOG_MAGIC
 
 
 todo = pytest.mark.skip(reason='still need to do')
@@ -14,6 +17,13 @@ def describe_MyDB():
     def verify_filesystem_is_not_touched():
         yield
         assert not os.path.isfile("mydatabase.db")
+        assert not os.path.isfile("mydatabase.db.lock")
+
+    # the writer lock is a real file next to the DB and these tests really take it,
+    # so run them somewhere it can be created
+    @pytest.fixture(autouse=True)
+    def lock_file_in_tmp_path(tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
     
     # from example to work throuhg
     def describe_init():
@@ -31,6 +41,8 @@ def describe_MyDB():
             # Fake file hand (so nothing is written)
             mock_open = mocker.patch("builtins.open", mocker.mock_open())
             mock_dump = mocker.patch("pickle.dump")
+            mocker.patch("os.fsync")
+            mock_replace = mocker.patch("os.replace")
 
             # the action
             MyDB("mydatabase.db")
@@ -39,8 +51,9 @@ def describe_MyDB():
             # These are built in function for mocker
             # see if mydatabase.db was called examply once
             mock_isfile.assert_called_once_with("mydatabase.db")
-            # sees that the open file is called once in bytes
-            mock_open.assert_called_once_with("mydatabase.db", "wb")
+            # sees that the temp file is opened once in bytes and then moved over the db
+            mock_open.assert_called_once_with("mydatabase.db.tmp", "wb")
+            mock_replace.assert_called_once_with("mydatabase.db.tmp", "mydatabase.db")
             # This see that mock_dump was called exaactly once and creates []
             mock_dump.assert_called_once_with([], mock_open.return_value)
 
@@ -87,8 +100,10 @@ def describe_MyDB():
             # Fake the opening
             mock_open = mocker.patch("builtins.open", mocker.mock_open())
 
-            # fake the dump
+            # fake the dump and the rename after it
             mock_dump = mocker.patch("pickle.dump")
+            mocker.patch("os.fsync")
+            mock_replace = mocker.patch("os.replace")
 
             # show that arr exsits or the file
             mocker.patch("os.path.isfile", return_value=True)
@@ -98,8 +113,21 @@ def describe_MyDB():
             db.saveStrings(["Mike","Going","Places"])
 
             # check to see if it worked
-            mock_open.assert_called_once_with("mydatabase.db", "wb")
+            mock_open.assert_called_once_with("mydatabase.db.tmp", "wb")
             mock_dump.assert_called_once_with(["Mike","Going","Places"], mock_open.return_value)
+            mock_replace.assert_called_once_with("mydatabase.db.tmp", "mydatabase.db")
+
+        def it_leaves_the_old_file_alone_when_the_write_fails(mocker):
+            mocker.patch("builtins.open", mocker.mock_open())
+            mocker.patch("pickle.dump", side_effect=OSError("disk full"))
+            mock_replace = mocker.patch("os.replace")
+            mocker.patch("os.path.isfile", return_value=True)
+
+            db = MyDB("mydatabase.db")
+            with pytest.raises(OSError):
+                db.saveStrings(["Mike"])
+
+            mock_replace.assert_not_called()
 
     def describe_saveString():
 
@@ -122,6 +150,272 @@ def describe_MyDB():
             # that saveStrings is called only once and with the added HIM
             mock_saveStrings.assert_called_once_with(["Mike", "Is", "HIM"])
 
+    def describe_random_access():
 
+        def it_reads_through_loadStrings(mocker):
+            mocker.patch("os.path.isfile", return_value=True)
+            mocker.patch.object(MyDB, "loadStrings", return_value=["Mike", "Is", "HIM"])
+
+            db = MyDB("mydatabase.db")
 
-            
+            assert len(db) == 3
+            assert db.get(1) == "Is"
+            assert db[-1] == "HIM"
+            assert db[0:2] == ["Mike", "Is"]
+            assert list(db.iterStrings()) == ["Mike", "Is", "HIM"]
+
+
+# these use real files under tmp_path since the format itself is what is being tested
+def describe_MyLogDB():
+
+    @pytest.fixture
+    def path(tmp_path):
+        return str(tmp_path / "log.db")
+
+    def it_starts_empty(path):
+        db = MyLogDB(path)
+        assert db.loadStrings() == []
+        with open(path, 'rb') as f:
+            assert f.read() == LOG_MAGIC
+
+    def it_appends_without_rewriting_the_file(path):
+        db = MyLogDB(path)
+        db.saveString("Mike")
+        size = os.path.getsize(path)
+        db.saveString("Goat")
+        # one 9 byte header plus the 4 byte string
+        assert os.path.getsize(path) == size + 13
+        assert db.loadStrings() == ["Mike", "Goat"]
+        assert MyLogDB(path).loadStrings() == ["Mike", "Goat"]
+
+    def it_overwrites_with_saveStrings(path):
+        db = MyLogDB(path)
+        db.saveString("old")
+        db.saveStrings(["Mike", "Going", "Places"])
+        db.saveString("Fast")
+        assert MyLogDB(path).loadStrings() == ["Mike", "Going", "Places", "Fast"]
+
+    def it_compacts_away_old_lists(path):
+        db = MyLogDB(path)
+        db.saveStrings(["x" * 100] * 10)
+        db.saveStrings(["Mike"])
+        before = os.path.getsize(path)
+        db.compact()
+        assert os.path.getsize(path) < before
+        assert db.deadBytes() == 0
+        db.saveString("Goat")
+        assert MyLogDB(path).loadStrings() == ["Mike", "Goat"]
+
+    def it_compacts_on_its_own_past_the_threshold(path):
+        db = MyLogDB(path, compactRatio=1.0, compactMinBytes=100)
+        db.saveStrings(["x" * 100] * 5)
+        assert db.deadBytes() > 0
+        db.saveStrings(["Mike"])
+        assert db.deadBytes() == 0
+        assert db.loadStrings() == ["Mike"]
+
+    def it_cuts_off_a_torn_record(path):
+        db = MyLogDB(path)
+        db.saveString("Mike")
+        size = os.path.getsize(path)
+        db.saveString("Goat")
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 2)
+        assert MyLogDB(path).loadStrings() == ["Mike"]
+        assert os.path.getsize(path) == size
+
+    def it_ignores_a_half_written_saveStrings(path):
+        db = MyLogDB(path)
+        db.saveString("Mike")
+        size = os.path.getsize(path)
+        db.saveStrings(["a", "b", "c"])
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 10)
+        assert MyLogDB(path).loadStrings() == ["Mike"]
+        assert os.path.getsize(path) == size
+
+    def it_cuts_the_file_at_a_corrupt_record_in_the_middle(path):
+        db = MyLogDB(path)
+        db.saveString("Mike")
+        size = os.path.getsize(path)
+        db.saveString("Goat")
+        db.saveString("Fast")
+        with open(path, 'r+b') as f:
+            # flip a byte of "Goat", leaving its header alone
+            f.seek(size + 9)
+            f.write(b"X")
+        assert MyLogDB(path).loadStrings() == ["Mike"]
+        assert os.path.getsize(path) == size
+
+    def it_rolls_back_a_saveStrings_with_a_corrupt_record(path):
+        db = MyLogDB(path)
+        db.saveString("Mike")
+        size = os.path.getsize(path)
+        db.saveStrings(["a", "b", "c"])
+        with open(path, 'r+b') as f:
+            # the last byte of "a", the first record after the RESET
+            f.seek(size + 9 + 8 + 9)
+            f.write(b"X")
+        assert MyLogDB(path).loadStrings() == ["Mike"]
+        assert os.path.getsize(path) == size
+
+    def it_migrates_a_pickle_file_once(path):
+        with open(path, 'wb') as f:
+            pickle.dump(["Mike", "Goat"], f)
+        db = MyLogDB(path)
+        assert db.loadStrings() == ["Mike", "Goat"]
+        with open(path, 'rb') as f:
+            assert f.read(len(LOG_MAGIC)) == LOG_MAGIC
+
+    def it_treats_an_empty_file_as_an_empty_log(path):
+        open(path, 'wb').close()
+        db = MyLogDB(path)
+        assert db.loadStrings() == []
+        db.saveString("Mike")
+        assert MyLogDB(path).loadStrings() == ["Mike"]
+
+    def it_reads_single_records_without_loading_the_list(path, mocker):
+        db = MyLogDB(path)
+        db.saveStrings(["zero", "one", "two", "three"])
+        db.saveString("four")
+        reopened = MyLogDB(path)
+        spy = mocker.spy(MyLogDB, "loadStrings")
+        assert len(reopened) == 5
+        assert reopened.get(3) == "three"
+        assert reopened[-1] == "four"
+        assert reopened[1:5:2] == ["one", "three"]
+        assert list(reopened.iterStrings()) == ["zero", "one", "two", "three", "four"]
+        spy.assert_not_called()
+        with pytest.raises(IndexError):
+            reopened.get(5)
+        reopened.close()
+
+    def it_sees_appends_and_compaction_through_the_map(path):
+        with MyLogDB(path, compactMinBytes=0) as db:
+            db.saveStrings(["a" * 50])
+            assert db.get(0) == "a" * 50
+            db.saveString("Mike")
+            assert db[1] == "Mike"
+            # the second saveStrings compacts, which replaces the mapped file
+            db.saveStrings(["Goat"])
+            assert db.get(0) == "Goat"
+            assert len(db) == 1
+
+
+# run in child processes by describe_concurrent_writes
+def appendStrings(dbClass, path, writer, count):
+    db = dbClass(path)
+    for i in range(count):
+        db.saveString(f"{writer}-{i}")
+
+def writeConcurrently(target, dbClass, path, writers=4, count=25):
+    started = [target(target=appendStrings, args=(dbClass, path, w, count)) for w in range(writers)]
+    for writer in started:
+        writer.start()
+    for writer in started:
+        writer.join()
+    return {f"{w}-{i}" for w in range(writers) for i in range(count)}
+
+# real files and real locks: every append from every writer has to survive
+def describe_concurrent_writes():
+
+    @pytest.fixture(params=[MyDB, MyLogDB])
+    def dbClass(request):
+        return request.param
+
+    @pytest.fixture
+    def path(tmp_path):
+        return str(tmp_path / "shared.db")
+
+    def it_loses_nothing_across_processes(dbClass, path):
+        expected = writeConcurrently(multiprocessing.get_context("fork").Process, dbClass, path)
+        strings = dbClass(path).loadStrings()
+        assert len(strings) == len(expected)
+        assert set(strings) == expected
+
+    def it_loses_nothing_across_threads(dbClass, path):
+        expected = writeConcurrently(threading.Thread, dbClass, path)
+        assert sorted(dbClass(path).loadStrings()) == sorted(expected)
+
+    def it_keeps_each_writers_order(dbClass, path):
+        writeConcurrently(threading.Thread, dbClass, path, writers=2, count=10)
+        strings = dbClass(path).loadStrings()
+        assert [s for s in strings if s.startswith("0-")] == [f"0-{i}" for i in range(10)]
+
+    def it_saves_many_with_one_write(dbClass, path, mocker):
+        db = dbClass(path)
+        db.saveString("Mike")
+        spy = mocker.spy(db, "saveStrings")
+        size = os.path.getsize(path)
+        db.saveMany(["Going", "Places"])
+        if dbClass is MyDB:
+            assert spy.call_count == 1
+        else:
+            # two records appended, no RESET and no rewrite
+            spy.assert_not_called()
+            assert os.path.getsize(path) == size + 9 + 5 + 9 + 6
+        assert dbClass(path).loadStrings() == ["Mike", "Going", "Places"]
+
+    def it_batches_appends_into_one_write(dbClass, path, mocker):
+        db = dbClass(path)
+        spy = mocker.spy(dbClass, "saveMany")
+        with db.batch():
+            for name in ["Mike", "Going", "Places"]:
+                db.saveString(name)
+            # nothing lands until the batch ends
+            assert db.loadStrings() == []
+        spy.assert_called_once_with(db, ["Mike", "Going", "Places"])
+        assert dbClass(path).loadStrings() == ["Mike", "Going", "Places"]
+
+    def it_drops_a_batch_that_raises(dbClass, path):
+        db = dbClass(path)
+        with pytest.raises(ValueError):
+            with db.batch():
+                db.saveString("Mike")
+                raise ValueError("nope")
+        db.saveString("Goat")
+        assert dbClass(path).loadStrings() == ["Goat"]
+
+    def it_shares_the_lock_between_two_dbs_in_one_thread(dbClass, path):
+        mine = dbClass(path)
+        other = dbClass(path)
+        def write():
+            with mine.batch():
+                mine.saveString("Mike")
+                # flock is per open file, so taking it again here would wait forever
+                other.saveString("Goat")
+        writer = threading.Thread(target=write, daemon=True)
+        writer.start()
+        writer.join(5)
+        assert not writer.is_alive()
+        assert dbClass(path).loadStrings() == ["Goat", "Mike"]
+
+    def it_catches_up_with_another_writer(path):
+        mine = MyLogDB(path)
+        other = MyLogDB(path)
+        other.saveString("Mike")
+        mine.saveString("Goat")
+        assert mine.loadStrings() == ["Mike", "Goat"]
+        other.refresh()
+        assert other.loadStrings() == ["Mike", "Goat"]
+
+    def it_keeps_reading_its_list_after_another_db_compacts(path):
+        reader = MyLogDB(path)
+        compactor = MyLogDB(path)
+        compactor.saveStrings(["Mike", "Goat", "Nutty"])
+        reader.refresh()
+        assert reader.get(1) == "Goat"
+        compactor.saveStrings(["Acorn"])
+        compactor.compact()
+        # still the list it last caught up with, from the file it indexed
+        assert len(reader) == 3
+        assert reader.loadStrings() == ["Mike", "Goat", "Nutty"]
+        assert reader.get(1) == "Goat"
+        reader.refresh()
+        assert reader.loadStrings() == ["Acorn"]
+        # once closed, the name is all it has, so it indexes whatever file is there now
+        compactor.saveStrings(["Bushy"])
+        compactor.compact()
+        reader.close()
+        assert reader.get(0) == "Bushy"
+        assert len(reader) == 1
@@ -0,0 +1,118 @@
+import os
+import pytest
+import squirrel_admission
+from squirrel_admission import Admission, parseConfig, parseRouteLimits, refusal
+from squirrel_metrics import Metrics
+
+
+@pytest.fixture
+def registry(mocker):
+    registry = Metrics()
+    mocker.patch.object(squirrel_admission, 'metrics', registry)
+    return registry
+
+def shed(registry):
+    counters, _ = registry.collect()
+    return {labels: value for (name, labels), value in counters.items() if name == 'squirrel_http_requests_shed_total'}
+
+def describe_Admission():
+
+    def it_bounds_the_queue(registry):
+        admission = Admission(maxQueue=2)
+        assert admission.enqueue()
+        assert admission.enqueue()
+        assert not admission.enqueue()
+        admission.dequeue()
+        assert admission.enqueue()
+        assert shed(registry) == {(('route', '-'), ('reason', 'queue')): 1}
+        counters, _ = registry.collect()
+        assert counters[('squirrel_http_requests_queued', ())] == 2
+
+    def it_never_refuses_without_limits(registry):
+        admission = Admission()
+        assert all(admission.enqueue() for _ in range(100))
+        assert admission.admit('GET', '/squirrels') == ()
+        assert shed(registry) == {}
+
+    def it_limits_a_route_and_frees_it_on_release(registry):
+        admission = Admission(routeLimits={'GET /squirrels': 1})
+        first = admission.admit('GET', '/squirrels')
+        assert first == ('GET /squirrels',)
+        assert admission.admit('GET', '/squirrels') is None
+        # other methods and other routes are not held back by it
+        assert admission.admit('POST', '/squirrels') == ()
+        assert admission.admit('GET', '/squirrels/{id}') == ()
+        admission.release(first)
+        assert admission.admit('GET', '/squirrels') == first
+        assert shed(registry) == {(('route', '/squirrels'), ('reason', 'route_limit')): 1}
+
+    def it_counts_against_the_route_and_its_method_together(registry):
+        admission = Admission(routeLimits={'/squirrels': 2, 'POST /squirrels': 1})
+        post = admission.admit('POST', '/squirrels')
+        assert post == ('/squirrels', 'POST /squirrels')
+        assert admission.admit('POST', '/squirrels') is None
+        assert admission.admit('GET', '/squirrels') == ('/squirrels',)
+        assert admission.admit('GET', '/squirrels') is None
+
+    def it_treats_a_zero_limit_as_none():
+        admission = Admission(routeLimits={'/squirrels': 0})
+        assert admission.routeLimits == {}
+
+    def it_rejects_unknown_routes():
+        with pytest.raises(ValueError):
+            Admission(routeLimits={'/squirels': 1})
+
+# explicit mtimes, since two writes within a second may otherwise look unchanged
+def writeConfig(path, text, mtime):
+    with open(path, 'w') as f:
+        f.write(text)
+    os.utime(path, (mtime, mtime))
+
+def describe_reloadIfChanged():
+
+    @pytest.fixture
+    def config(tmp_path):
+        return str(tmp_path / 'admission.json')
+
+    def it_follows_the_file_and_falls_back_to_the_flags(config):
+        admission = Admission()
+        admission.configure(maxQueue=8, retryAfter=1, configPath=config)
+        assert (admission.maxQueue, admission.routeLimits) == (8, {})
+        writeConfig(config, '{"max_queue": 2, "route_limits": {"GET /squirrels": 1}}', 1000)
+        admission.reloadIfChanged()
+        assert (admission.maxQueue, admission.routeLimits, admission.retryAfter) == (2, {'GET /squirrels': 1}, 1)
+        os.remove(config)
+        admission.reloadIfChanged()
+        assert (admission.maxQueue, admission.routeLimits) == (8, {})
+
+    def it_keeps_the_limits_when_the_file_is_broken(config, capsys):
+        writeConfig(config, '{"retry_after": 5}', 1000)
+        admission = Admission()
+        admission.configure(configPath=config)
+        assert admission.retryAfter == 5
+        writeConfig(config, '{"retry_after": ', 2000)
+        admission.reloadIfChanged()
+        assert admission.retryAfter == 5
+        assert 'ignoring' in capsys.readouterr().err
+
+def describe_parsing():
+
+    def it_reads_route_limits_from_flags():
+        assert parseRouteLimits(['get /squirrels=2', '/squirrels/_bulk = 1']) == {'GET /squirrels': 2, '/squirrels/_bulk': 1}
+        with pytest.raises(ValueError):
+            parseRouteLimits(['/squirrels'])
+        with pytest.raises(ValueError):
+            parseRouteLimits(['/squirrels=-1'])
+
+    def it_checks_the_config_file():
+        assert parseConfig('{"max_queue": 4}') == {'maxQueue': 4}
+        for text in ('[]', '{"max_queue": -1}', '{"route_limits": []}', '{"limits": {}}'):
+            with pytest.raises(ValueError):
+                parseConfig(text)
+
+    def it_builds_a_closing_503():
+        head, _, body = refusal(3).partition(b'\r\n\r\n')
+        assert head.split(b'\r\n')[0] == b'HTTP/1.1 503 Service Unavailable'
+        assert b'Retry-After: 3' in head
+        assert b'Connection: close' in head
+        assert b'Content-Length: %d' % len(body) in head
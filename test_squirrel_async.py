@@ -0,0 +1,383 @@
+import gzip
+import http.client
+import json
+import re
+import socket
+import sqlite3
+import threading
+import time
+import pytest
+import squirrel_cache
+from squirrel_admission import admission
+from squirrel_async import readHead
+from squirrel_bench import seedDatabase
+from squirrel_server import ENGINES, SquirrelServerHandler, closeServices, makeServer, parseArgs
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / 'squirrels.db')
+    seedDatabase(path, 3)
+    return path
+
+def startServer(db_path, engine, *flags):
+    args = parseArgs(['--db', db_path, '--engine', engine, '--port', '0', '--idle-timeout', '2'] + list(flags), environ={})
+    server = makeServer(args)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, thread
+
+def stopServer(server, thread):
+    server.shutdown()
+    thread.join(timeout=5)
+    server.server_close()
+    closeServices()
+    squirrel_cache.cache = None
+    admission.configure()
+
+@pytest.fixture(params=ENGINES)
+def live(request, db_path):
+    server, thread = startServer(db_path, request.param, '--workers', '2')
+    yield server
+    stopServer(server, thread)
+
+def connect(server):
+    return http.client.HTTPConnection('127.0.0.1', server.server_address[1], timeout=5)
+
+def call(conn, method, path, body=None, headers=None):
+    headers = dict(headers or {})
+    if body is not None:
+        headers.setdefault('Content-Type', 'application/x-www-form-urlencoded')
+    conn.request(method, path, body=body, headers=headers)
+    resp = conn.getresponse()
+    return resp, resp.read()
+
+# everything the server sends back for these raw bytes, until it closes
+def exchange(server, raw):
+    with socket.create_connection(('127.0.0.1', server.server_address[1]), timeout=5) as sock:
+        sock.sendall(raw)
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
+
+
+def describe_both_engines():
+
+    def it_creates_reads_updates_and_deletes(live):
+        conn = connect(live)
+        resp, body = call(conn, 'POST', '/squirrels', 'name=Nova&size=small')
+        assert (resp.status, resp.getheader('Location')) == (201, '/squirrels/4')
+        assert json.loads(body) == {'id': 4, 'name': 'Nova', 'size': 'small'}
+        assert call(conn, 'GET', '/squirrels/4')[1] == b'{"id":4,"name":"Nova","size":"small"}'
+        resp, body = call(conn, 'PUT', '/squirrels/4', 'name=Nova&size=large')
+        assert (resp.status, json.loads(body)['size']) == (200, 'large')
+        resp, body = call(conn, 'DELETE', '/squirrels/4')
+        assert (resp.status, body, resp.getheader('Content-Length')) == (204, b'', None)
+        assert call(conn, 'GET', '/squirrels/4')[:1][0].status == 404
+        assert [row['id'] for row in json.loads(call(conn, 'GET', '/squirrels')[1])] == [1, 2, 3]
+        conn.close()
+
+    def it_invalidates_a_cached_squirrel_however_its_id_is_spelled(live):
+        conn = connect(live)
+        assert call(conn, 'GET', '/squirrels/1')[0].status == 200
+        # the write names it differently from the cached read...
+        assert call(conn, 'PUT', '/squirrels/1.0', 'name=Fluffy&size=tiny')[0].status == 200
+        assert json.loads(call(conn, 'GET', '/squirrels/1')[1])['size'] == 'tiny'
+        # ...or the cached read does
+        assert json.loads(call(conn, 'GET', '/squirrels/1e0')[1])['size'] == 'tiny'
+        assert call(conn, 'PUT', '/squirrels/1', 'name=Fluffy&size=medium')[0].status == 200
+        assert json.loads(call(conn, 'GET', '/squirrels/1e0')[1])['size'] == 'medium'
+        assert call(conn, 'DELETE', '/squirrels/01')[0].status == 204
+        assert call(conn, 'GET', '/squirrels/1e0')[0].status == 404
+        conn.close()
+
+    def it_pages_and_revalidates(live):
+        conn = connect(live)
+        resp, body = call(conn, 'GET', '/squirrels?limit=2')
+        assert resp.getheader('Link') == '</squirrels?limit=2&after_id=2>; rel="next"'
+        assert len(json.loads(body)) == 2
+        resp, body = call(conn, 'GET', '/squirrels?limit=2', headers={'If-None-Match': resp.getheader('ETag')})
+        assert (resp.status, body) == (304, b'')
+        assert call(conn, 'GET', '/squirrels?limit=0')[0].status == 400
+        conn.close()
+
+    def it_filters_and_pages_the_list(live):
+        conn = connect(live)
+        # the seeded squirrel-0..2 are small, medium and large
+        assert [row['id'] for row in json.loads(call(conn, 'GET', '/squirrels?size=large')[1])] == [3]
+        assert [row['id'] for row in json.loads(call(conn, 'GET', '/squirrels?name_prefix=squirrel-1')[1])] == [2]
+        resp, body = call(conn, 'GET', '/squirrels?q=squirrel&limit=2')
+        assert resp.getheader('Link') == '</squirrels?limit=2&after_id=2&q=squirrel>; rel="next"'
+        call(conn, 'POST', '/squirrels', 'name=Big Squirrel&size=large')
+        assert [row['id'] for row in json.loads(call(conn, 'GET', '/squirrels?size=large&q=big')[1])] == [4]
+        resp, body = call(conn, 'GET', '/squirrels?stream=1&size=large')
+        assert [row['id'] for row in json.loads(body)] == [3, 4]
+        conn.close()
+
+    def it_reads_from_the_replica_and_notices_outside_writes(db_path):
+        server, thread = startServer(db_path, 'threads', '--replica', '--replica-check', '0.05')
+        try:
+            conn = connect(server)
+            call(conn, 'POST', '/squirrels', 'name=Nova&size=small')
+            assert call(conn, 'GET', '/squirrels/4')[1] == b'{"id":4,"name":"Nova","size":"small"}'
+            outsider = sqlite3.connect(db_path)
+            outsider.execute("UPDATE squirrels SET name = 'Changed' WHERE id = 4")
+            outsider.commit()
+            outsider.close()
+            # the reload also drops the cached response
+            deadline = time.monotonic() + 5
+            while json.loads(call(conn, 'GET', '/squirrels/4')[1])['name'] != 'Changed':
+                assert time.monotonic() < deadline
+                time.sleep(0.05)
+            conn.close()
+        finally:
+            stopServer(server, thread)
+
+    def it_streams_in_chunks(live):
+        conn = connect(live)
+        resp, body = call(conn, 'GET', '/squirrels?stream=1')
+        assert resp.getheader('Transfer-Encoding') == 'chunked'
+        assert [row['id'] for row in json.loads(body)] == [1, 2, 3]
+        conn.close()
+
+    def it_gzips_only_what_is_big_enough(live):
+        conn = connect(live)
+        resp, body = call(conn, 'GET', '/squirrels?stream=1', headers={'Accept-Encoding': 'gzip'})
+        assert resp.getheader('Content-Encoding') == 'gzip'
+        assert [row['id'] for row in json.loads(gzip.decompress(body))] == [1, 2, 3]
+        # three squirrels are under --gzip-min-bytes
+        resp, body = call(conn, 'GET', '/squirrels', headers={'Accept-Encoding': 'gzip'})
+        assert resp.getheader('Content-Encoding') is None
+        assert len(json.loads(body)) == 3
+        conn.close()
+
+    def it_answers_pipelined_requests_in_order(live):
+        raw = exchange(live, b'GET /squirrels/1 HTTP/1.1\r\n\r\n'
+                             b'GET /squirrels/9 HTTP/1.1\r\n\r\n'
+                             b'GET /squirrels/2 HTTP/1.1\r\nConnection: close\r\n\r\n')
+        assert re.findall(rb'HTTP/1\.1 (\d{3}) ', raw) == [b'200', b'404', b'200']
+
+    def it_closes_after_an_http_1_0_request(live):
+        raw = exchange(live, b'GET /squirrels/1 HTTP/1.0\r\n\r\n')
+        assert raw.startswith(b'HTTP/1.1 200 OK\r\n')
+        assert raw.endswith(b'{"id":1,"name":"squirrel-0","size":"small"}')
+
+    def it_sends_100_continue_once(live):
+        body = b'name=Late&size=small'
+        with socket.create_connection(('127.0.0.1', live.server_address[1]), timeout=5) as sock:
+            sock.sendall(b'POST /squirrels HTTP/1.1\r\nExpect: 100-continue\r\nConnection: close\r\n'
+                         b'Content-Length: %d\r\n\r\n' % len(body))
+            assert sock.recv(1024) == b'HTTP/1.1 100 Continue\r\n\r\n'
+            sock.sendall(body)
+            raw = b''
+            while chunk := sock.recv(65536):
+                raw += chunk
+        assert raw.startswith(b'HTTP/1.1 201 Created\r\n')
+        assert b'100 Continue' not in raw
+
+    def it_rejects_what_it_does_not_serve(live):
+        conn = connect(live)
+        assert call(conn, 'PATCH', '/squirrels/1')[0].status == 501
+        conn = connect(live)
+        resp, body = call(conn, 'POST', '/squirrels/_bulk', '[{"op":', headers={'Content-Type': 'application/json'})
+        assert resp.status == 400
+        assert body.startswith(b'400 Bad Request: invalid JSON')
+        conn.close()
+
+    def it_follows_changes_and_long_polls_for_the_next(live):
+        conn = connect(live)
+        changes = json.loads(call(conn, 'GET', '/squirrels/changes?since=0')[1])
+        assert ([change['id'] for change in changes['changes']], changes['last_seq'], changes['more']) == ([1, 2, 3], 3, False)
+        answers = []
+        poller = threading.Thread(target=lambda: answers.append(call(connect(live), 'GET', '/squirrels/changes?since=3&wait=10')[1]))
+        began = time.monotonic()
+        poller.start()
+        time.sleep(0.2)
+        call(conn, 'DELETE', '/squirrels/2')
+        poller.join()
+        # woken by the delete, not by running out of time
+        assert time.monotonic() - began < 5
+        assert json.loads(answers[0]) == {'changes': [{'seq': 4, 'op': 'delete', 'id': 2}], 'last_seq': 4, 'more': False}
+        conn.close()
+
+    def it_sheds_a_route_over_its_limit(db_path):
+        for engine in ENGINES:
+            server, thread = startServer(db_path, engine, '--route-limit', 'GET /squirrels=1', '--retry-after', '3')
+            held = admission.admit('GET', '/squirrels')
+            conn = connect(server)
+            resp, body = call(conn, 'GET', '/squirrels')
+            assert (resp.status, resp.getheader('Retry-After'), body) == (503, '3', b'503 Service Unavailable')
+            # point lookups go on, on the same connection
+            assert call(conn, 'GET', '/squirrels/1')[0].status == 200
+            admission.release(held)
+            assert call(conn, 'GET', '/squirrels')[0].status == 200
+            conn.close()
+            stopServer(server, thread)
+
+    def it_sheds_once_the_queue_is_full(db_path):
+        for engine in ENGINES:
+            server, thread = startServer(db_path, engine, '--max-queue', '1', '--retry-after', '2')
+            # someone is already waiting for a worker
+            admission.enqueue()
+            raw = exchange(server, b'GET /squirrels/1 HTTP/1.1\r\n\r\n')
+            assert raw.startswith(b'HTTP/1.1 503 Service Unavailable\r\n')
+            assert b'Retry-After: 2\r\n' in raw
+            admission.dequeue()
+            raw = exchange(server, b'GET /squirrels/1 HTTP/1.1\r\nConnection: close\r\n\r\n')
+            assert raw.startswith(b'HTTP/1.1 200 OK\r\n')
+            stopServer(server, thread)
+
+    def it_retires_after_max_requests(db_path):
+        for engine in ENGINES:
+            server, thread = startServer(db_path, engine, '--workers', '2')
+            server.maxRequests = 2
+            conn = connect(server)
+            call(conn, 'GET', '/squirrels/1')
+            call(conn, 'GET', '/squirrels/1')
+            thread.join(timeout=5)
+            assert not thread.is_alive()
+            conn.close()
+            stopServer(server, thread)
+
+def describe_ThreadPoolHTTPServer():
+
+    def it_hands_an_idle_keep_alive_worker_to_a_waiting_client(db_path):
+        server, thread = startServer(db_path, 'threads', '--workers', '1')
+        idle = socket.create_connection(('127.0.0.1', server.server_address[1]), timeout=5)
+        idle.sendall(b'GET /squirrels/1 HTTP/1.1\r\n\r\n')
+        raw = b''
+        while not raw.endswith(b'}'):
+            raw += idle.recv(65536)
+        assert raw.startswith(b'HTTP/1.1 200 OK')
+        began = time.monotonic()
+        conn = connect(server)
+        assert call(conn, 'GET', '/squirrels/2')[0].status == 200
+        # rather than the 2 second idle timeout
+        assert time.monotonic() - began < 1
+        conn.close()
+        # the idle one was hung up on
+        assert idle.recv(1) == b''
+        idle.close()
+        stopServer(server, thread)
+
+    def it_leaves_connections_in_the_backlog_while_every_worker_is_busy(db_path):
+        server, thread = startServer(db_path, 'threads', '--workers', '1')
+        polling = connect(server)
+        latest = json.loads(call(polling, 'GET', '/squirrels/changes')[1])['last_seq']
+        polling.request('GET', f'/squirrels/changes?since={latest}&wait=1')
+        time.sleep(0.2)
+        waiting = [socket.create_connection(('127.0.0.1', server.server_address[1])) for _ in range(4)]
+        for sock in waiting:
+            sock.sendall(b'GET /squirrels/1 HTTP/1.1\r\nConnection: close\r\n\r\n')
+        time.sleep(0.2)
+        # one accepted and waiting for the worker, the rest still the kernel's
+        assert (server.busy, admission.queued) == (1, 1)
+        assert polling.getresponse().status == 200
+        for sock in waiting:
+            sock.settimeout(5)
+            assert sock.recv(65536).startswith(b'HTTP/1.1 200 OK')
+            sock.close()
+        polling.close()
+        stopServer(server, thread)
+
+def describe_AsyncHTTPServer():
+
+    def it_gives_identical_responses_to_the_threaded_engine(db_path):
+        requests = [b'GET /squirrels HTTP/1.1\r\n\r\n', b'GET /squirrels/2 HTTP/1.1\r\n\r\n',
+                    b'GET /squirrels/7 HTTP/1.1\r\n\r\n', b'GET /squirrels?limit=1&after_id=1 HTTP/1.1\r\n\r\n',
+                    b'GET /squirrels?stream=1 HTTP/1.1\r\n\r\n', b'GET /nope HTTP/1.1\r\n\r\n',
+                    b'DELETE /squirrels HTTP/1.1\r\n\r\n', b'BREW /squirrels HTTP/1.1\r\n\r\n']
+        answers = {}
+        for engine in ENGINES:
+            server, thread = startServer(db_path, engine)
+            raw = exchange(server, b''.join(requests) + b'GET /squirrels/1 HTTP/1.1\r\nConnection: close\r\n\r\n')
+            answers[engine] = [line for line in raw.split(b'\r\n')
+                               if not line.startswith((b'Date:', b'Server:'))]
+            stopServer(server, thread)
+        assert answers['asyncio'] == answers['threads']
+
+    def it_answers_an_oversized_head_like_the_threaded_engine(db_path):
+        longPath = b'GET /' + b'a' * 70000 + b' HTTP/1.1\r\n\r\n'
+        longHeader = b'GET /squirrels HTTP/1.1\r\nX-Padding: ' + b'a' * 70000 + b'\r\n\r\n'
+        answers = {}
+        for engine in ENGINES:
+            server, thread = startServer(db_path, engine)
+            answers[engine] = [exchange(server, longPath).split(b' ', 2)[1], exchange(server, longHeader).split(b' ', 2)[1]]
+            stopServer(server, thread)
+        assert answers['asyncio'] == answers['threads'] == [b'414', b'431']
+
+    def it_serves_while_idle_connections_hold_no_threads(db_path):
+        server, thread = startServer(db_path, 'asyncio', '--workers', '1')
+        idle = [socket.create_connection(('127.0.0.1', server.server_address[1])) for _ in range(20)]
+        began = time.monotonic()
+        conn = connect(server)
+        assert call(conn, 'GET', '/squirrels/1')[0].status == 200
+        # the threaded engine with one worker would wait out the idle timeout here
+        assert time.monotonic() - began < 1
+        conn.close()
+        stopServer(server, thread)
+        for sock in idle:
+            assert sock.recv(1) == b''
+            sock.close()
+
+    def it_answers_the_connections_queued_when_it_stops_if_asked_to_drain(db_path):
+        args = parseArgs(['--db', db_path, '--engine', 'asyncio', '--port', '0'], environ={})
+        server = makeServer(args)
+        server.drainOnStop = True
+        queued = [socket.create_connection(('127.0.0.1', server.server_address[1]), timeout=5) for _ in range(3)]
+        try:
+            for sock in queued:
+                sock.sendall(b'GET /squirrels/1 HTTP/1.1\r\n\r\n')
+            # as if shutdown() came first, so the loop stops before accepting any itself
+            server.shutdownRequested = True
+            server.serve_forever()
+            for sock in queued:
+                assert sock.recv(65536).startswith(b'HTTP/1.1 200 OK')
+        finally:
+            for sock in queued:
+                sock.close()
+            server.server_close()
+            closeServices()
+            squirrel_cache.cache = None
+            admission.configure()
+
+def describe_makeServer():
+
+    def it_keeps_each_servers_gzip_settings_to_itself(db_path):
+        plain, plainThread = startServer(db_path, 'threads', '--gzip-level', '0')
+        small, smallThread = startServer(db_path, 'threads', '--gzip-min-bytes', '1')
+        try:
+            assert (plain.RequestHandlerClass.gzipMinBytes, plain.RequestHandlerClass.gzipLevel) == (1024, 0)
+            assert (small.RequestHandlerClass.gzipMinBytes, small.RequestHandlerClass.gzipLevel) == (1, 6)
+            assert (SquirrelServerHandler.gzipMinBytes, SquirrelServerHandler.gzipLevel) == (1024, 6)
+            resp, _ = call(connect(plain), 'GET', '/squirrels', headers={'Accept-Encoding': 'gzip'})
+            assert resp.getheader('Content-Encoding') is None
+        finally:
+            stopServer(small, smallThread)
+            stopServer(plain, plainThread)
+
+    def it_leaves_the_schema_and_pruning_to_the_prefork_master(db_path, mocker):
+        ensureSchema = mocker.patch('squirrel_db.ensureSchema')
+        configureChangeLog = mocker.patch('squirrel_db.configureChangeLog')
+        args = parseArgs(['--db', db_path, '--port', '0'], environ={})
+        try:
+            makeServer(args, worker=True).server_close()
+            ensureSchema.assert_not_called()
+            configureChangeLog.assert_not_called()
+            makeServer(args).server_close()
+            ensureSchema.assert_called_once_with(db_path)
+            configureChangeLog.assert_called_once_with(db_path, retention=7 * 24 * 3600, interval=60)
+        finally:
+            closeServices()
+            squirrel_cache.cache = None
+            admission.configure()
+
+def describe_readHead():
+
+    def it_finds_the_length_and_drops_expect():
+        head, length, expectsContinue = readHead(b'POST / HTTP/1.1\r\ncontent-length: 12\r\nExpect: 100-continue\r\n\r\n')
+        assert (head, length, expectsContinue) == (b'POST / HTTP/1.1\r\ncontent-length: 12\r\n\r\n', 12, True)
+        assert readHead(b'GET / HTTP/1.1\r\nContent-Length: x\r\n\r\n')[1:] == (0, False)
@@ -0,0 +1,72 @@
+import json
+import sqlite3
+from itertools import islice
+import pytest
+from squirrel_bench import benchmark, classify, loadTrace, parseMix, percentile, seedDatabase, summarize, syntheticRequests
+
+
+def describe_percentile():
+
+    def it_uses_the_nearest_rank():
+        values = list(range(1, 101))
+        assert percentile(values, 50) == 50
+        assert percentile(values, 99) == 99
+        assert percentile([7], 95) == 7
+        assert percentile([], 50) is None
+
+
+def describe_classify():
+
+    def it_names_the_endpoint():
+        assert classify("GET", "/squirrels?limit=5") == "list"
+        assert classify("GET", "/squirrels/3") == "retrieve"
+        assert classify("POST", "/squirrels") == "create"
+        assert classify("PUT", "/squirrels/3") == "update"
+        assert classify("DELETE", "/squirrels/3") == "delete"
+
+
+def describe_workloads():
+
+    def it_follows_the_mix():
+        requests = list(islice(syntheticRequests(100, {"retrieve": 1, "delete": 0}, seed=4), 50))
+        assert {classify(r["method"], r["path"]) for r in requests} == {"retrieve"}
+
+    def it_rejects_unknown_endpoints():
+        with pytest.raises(ValueError):
+            parseMix("list=1,explode=2")
+
+    def it_reads_a_trace(tmp_path):
+        path = tmp_path / "trace.jsonl"
+        path.write_text('{"method": "get", "path": "/squirrels/1"}\n\n{"method": "POST", "path": "/squirrels", "body": "name=a&size=b"}\n')
+        assert loadTrace(str(path)) == [
+            {"method": "GET", "path": "/squirrels/1", "body": None},
+            {"method": "POST", "path": "/squirrels", "body": "name=a&size=b"},
+        ]
+
+
+def describe_summarize():
+
+    def it_reports_rates_percentiles_and_errors():
+        summary = summarize([(0.001, 200), (0.002, 404), (0.003, 500), (0.004, 0)], elapsed=2.0)
+        assert summary["requests"] == 4
+        assert summary["errors"] == 2
+        assert summary["rps"] == 2.0
+        assert summary["p50_ms"] == 2.0
+        assert summary["statuses"] == {"200": 1, "404": 1, "500": 1, "0": 1}
+
+
+def describe_benchmark():
+
+    def it_seeds_the_requested_rows(tmp_path):
+        path = str(tmp_path / "seed.db")
+        seedDatabase(path, 25, batch=10)
+        assert sqlite3.connect(path).execute("SELECT COUNT(*) FROM squirrels").fetchone() == (25,)
+
+    def it_runs_a_small_load_against_a_real_server():
+        report = benchmark([50], [2], duration=5, maxRequests=40, seed=1)
+        run = report["runs"][0]
+        assert (run["rows"], run["concurrency"]) == (50, 2)
+        assert run["total"]["requests"] == 40
+        assert run["total"]["errors"] == 0
+        assert set(run["endpoints"]) <= {"list", "retrieve", "create", "update", "delete"}
+        json.dumps(report)
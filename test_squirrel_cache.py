@@ -0,0 +1,76 @@
+import multiprocessing
+
+from squirrel_cache import CacheEntry, ResponseCache, etagMatches, itemKey, makeEtag
+
+
+def describe_ResponseCache():
+
+    def it_evicts_the_least_recently_used_entry():
+        cache = ResponseCache(maxEntries=2)
+        cache.put(("item", 1), CacheEntry(b"1"), cache.generation)
+        cache.put(("item", 2), CacheEntry(b"2"), cache.generation)
+        cache.get(("item", 1))
+        cache.put(("item", 3), CacheEntry(b"3"), cache.generation)
+        assert list(cache.entries) == [("item", 1), ("item", 3)]
+
+    def it_stays_under_its_byte_budget():
+        cache = ResponseCache(maxBytes=10)
+        cache.put(("item", 1), CacheEntry(b"123456"), cache.generation)
+        cache.put(("item", 2), CacheEntry(b"123456"), cache.generation)
+        assert list(cache.entries) == [("item", 2)]
+        assert cache.size == 6
+        cache.put(("list",), CacheEntry(b"x" * 11), cache.generation)
+        assert ("list",) not in cache.entries
+
+    def it_refuses_a_response_read_before_a_write():
+        cache = ResponseCache()
+        generation = cache.generation
+        cache.invalidateLists()
+        cache.put(("list",), CacheEntry(b"[]"), generation)
+        assert cache.get(("list",)) is None
+
+    def it_treats_string_and_int_ids_alike():
+        cache = ResponseCache()
+        cache.put(("item", 7), CacheEntry(b"{}"), cache.generation)
+        cache.invalidateItems(["07"])
+        assert cache.entries == {}
+
+    def it_keys_every_spelling_sqlite_reads_as_the_same_id():
+        cache = ResponseCache()
+        cache.put(("item", itemKey("1e0")), CacheEntry(b"{}"), cache.generation)
+        cache.put(("item", itemKey(" 2.0 ")), CacheEntry(b"{}"), cache.generation)
+        cache.put(("item", itemKey("1.5")), CacheEntry(b"{}"), cache.generation)
+        cache.invalidateItems([1, "2"])
+        assert list(cache.entries) == [("item", "1.5")]
+
+    def it_counts_hits_and_misses():
+        cache = ResponseCache()
+        cache.get(("list",))
+        cache.put(("list",), CacheEntry(b"[]"), cache.generation)
+        cache.get(("list",))
+        assert (cache.hits, cache.misses) == (1, 1)
+
+    def it_drops_everything_after_a_write_in_another_process():
+        shared = multiprocessing.Value("Q", 0)
+        mine = ResponseCache(shared=shared)
+        theirs = ResponseCache(shared=shared)
+        mine.put(("item", 1), CacheEntry(b"{}"), mine.generation)
+        generation = mine.generation
+        theirs.invalidateItems([2])
+        assert mine.get(("item", 1)) is None
+        mine.put(("list",), CacheEntry(b"[]"), generation)
+        assert mine.entries == {}
+        # its own writes don't make it forget what it just cached
+        mine.put(("item", 1), CacheEntry(b"{}"), mine.generation)
+        mine.invalidateItems([2])
+        assert mine.get(("item", 1)) is not None
+
+
+def describe_etagMatches():
+
+    def it_matches_any_listed_tag_weak_or_strong():
+        etag = makeEtag(b"[]")
+        assert etagMatches(f'"nope", W/{etag}', etag)
+        assert etagMatches("*", etag)
+        assert not etagMatches('"nope"', etag)
+        assert not etagMatches(None, etag)
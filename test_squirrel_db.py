@@ -0,0 +1,558 @@
+import json
+import sqlite3
+import threading
+import time
+import pytest
+import squirrel_db
+from squirrel_db import ChangeLogPruner, ConnectionPool, DictRowFactory, GroupCommitter, SquirrelDB, SquirrelReplica, SquirrelRow, ensureSchema, findQuery, prefixEnd
+from squirrel_metrics import Metrics
+
+
+# a throwaway copy of the squirrels schema so the real squirrel_db.db is never touched
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / "squirrels.db")
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE squirrels (id INTEGER PRIMARY KEY, name TEXT, size TEXT)")
+    connection.commit()
+    connection.close()
+    return path
+
+@pytest.fixture
+def pool(db_path):
+    pool = ConnectionPool(db_path, size=2, timeout=0.1)
+    yield pool
+    pool.close()
+
+
+def describe_ConnectionPool():
+
+    def it_hands_back_the_same_connection_after_release(pool):
+        first = pool.acquire()
+        pool.release(first)
+        assert pool.acquire() is first
+        assert pool.created == 1
+
+    def it_never_opens_more_than_size_connections(pool):
+        pool.acquire()
+        pool.acquire()
+        with pytest.raises(TimeoutError):
+            pool.acquire()
+        assert pool.created == 2
+
+    def it_rolls_back_an_open_transaction_on_release(pool):
+        connection = pool.acquire()
+        connection.execute("INSERT INTO squirrels (name, size) VALUES ('Leak', 'small')")
+        pool.release(connection)
+        assert pool.acquire().execute("SELECT COUNT(*) AS n FROM squirrels").fetchone() == {'n': 0}
+
+    def it_replaces_a_broken_connection(pool):
+        pool.checkAfter = 0
+        broken = pool.acquire()
+        pool.release(broken)
+        broken.close()
+        fresh = pool.acquire()
+        assert fresh is not broken
+        assert pool.isHealthy(fresh)
+        assert pool.created == 1
+
+    def it_drops_dead_connections_during_a_health_check(pool):
+        good, bad = pool.acquire(), pool.acquire()
+        pool.release(good)
+        pool.release(bad)
+        bad.close()
+        assert pool.healthCheck() == 1
+        assert pool.created == 1
+
+    def it_refuses_new_borrowers_once_closed(pool):
+        borrowed = pool.acquire()
+        pool.close()
+        with pytest.raises(sqlite3.ProgrammingError):
+            pool.acquire()
+        # returning after close shuts the connection instead of pooling it
+        pool.release(borrowed)
+        assert not pool.isHealthy(borrowed)
+
+
+def describe_SquirrelDB():
+
+    def it_returns_its_connection_to_the_pool_on_exit(pool):
+        with SquirrelDB(pool) as db:
+            borrowed = db.connection
+            assert pool.idle.qsize() == 0
+        assert db.connection is None
+        assert pool.acquire() is borrowed
+
+    def it_creates_reads_updates_and_deletes(pool):
+        with SquirrelDB(pool) as db:
+            squirrel = db.createSquirrel("Fluffy", "large")
+            assert squirrel == db.getSquirrels()[0] == {"id": 1, "name": "Fluffy", "size": "large"}
+            assert db.updateSquirrel(1, "Fluffy", "small") == {"id": 1, "name": "Fluffy", "size": "small"}
+            assert db.getSquirrel(1)["size"] == "small"
+            assert db.deleteSquirrel(1) == {"id": 1, "name": "Fluffy", "size": "small"}
+            assert db.getSquirrel(1) is None
+
+    def it_returns_None_for_writes_to_missing_squirrels(pool):
+        with SquirrelDB(pool) as db:
+            assert db.updateSquirrel(9, "Ghost", "small") is None
+            assert db.deleteSquirrel(9) is None
+
+    def it_pages_by_id_after_the_cursor(pool):
+        with SquirrelDB(pool) as db:
+            for name in ("a", "b", "c", "d"):
+                db.createSquirrel(name, "small")
+            assert [s["name"] for s in db.getSquirrelsPage(2)] == ["a", "b"]
+            assert [s["name"] for s in db.getSquirrelsPage(2, afterId=2)] == ["c", "d"]
+            assert db.getSquirrelsPage(2, afterId=4) == []
+
+    def it_iterates_in_chunks(pool):
+        with SquirrelDB(pool) as db:
+            for name in ("a", "b", "c"):
+                db.createSquirrel(name, "small")
+            chunks = list(db.iterSquirrels(chunkSize=2))
+        assert [[s["name"] for s in chunk] for chunk in chunks] == [["a", "b"], ["c"]]
+
+
+def describe_bulk_writes():
+
+    def it_creates_many_and_returns_their_ids(pool):
+        with SquirrelDB(pool) as db:
+            db.createSquirrel("First", "small")
+            assert db.createSquirrels([("a", "small"), ("b", "large")]) == [2, 3]
+            assert [s["name"] for s in db.getSquirrels()] == ["First", "a", "b"]
+
+    def it_returns_the_ids_sqlite_actually_gave_out(pool):
+        with SquirrelDB(pool) as db:
+            # past the largest rowid sqlite picks unused ids at random, not MAX(id) + 1
+            db.cursor.execute("INSERT INTO squirrels (id, name, size) VALUES (?, 'Last', 'small')", [2 ** 63 - 1])
+            db.connection.commit()
+            ids = db.createSquirrels([("a", "small"), ("b", "large")])
+            assert [db.getSquirrel(squirrelId)["name"] for squirrelId in ids] == ["a", "b"]
+
+    def it_reports_which_updates_and_deletes_found_their_row(pool):
+        with SquirrelDB(pool) as db:
+            db.createSquirrels([("a", "small"), ("b", "small")])
+            assert db.updateSquirrels([(1, "A", "large"), (9, "Z", "large")]) == [True, False]
+            assert db.getSquirrel(1)["name"] == "A"
+            assert db.deleteSquirrels([2, 2, 9]) == [True, False, False]
+            assert db.getSquirrel(2) is None
+
+    def it_applies_mixed_operations_in_order(pool):
+        with SquirrelDB(pool) as db:
+            results = db.applyBulk([
+                {"op": "create", "name": "a", "size": "small"},
+                {"op": "create", "name": "b", "size": "small"},
+                {"op": "update", "id": 1, "name": "a", "size": "large"},
+                {"op": "delete", "id": 2},
+                {"op": "delete", "id": 2},
+                {"op": "explode"},
+                {"op": "update", "id": "1", "name": "x", "size": "x"},
+            ])
+            assert [r["status"] for r in results] == [201, 201, 200, 204, 404, 400, 400]
+            assert db.getSquirrels() == [{"id": 1, "name": "a", "size": "large"}]
+
+    def it_rejects_a_name_or_size_sqlite_cannot_store(pool):
+        with SquirrelDB(pool) as db:
+            results = db.applyBulk([
+                {"op": "create", "name": {"a": 1}, "size": "x"},
+                {"op": "create", "name": "a", "size": ["small"]},
+                {"op": "create", "name": True, "size": "small"},
+                {"op": "create", "name": "b", "size": None},
+            ])
+            assert [r.get("error") for r in results[:3]] == [
+                "name must be a string or a number", "size must be a string or a number", "name must be a string or a number"]
+            assert [r["status"] for r in results] == [400, 400, 400, 201]
+            assert db.getSquirrels() == [{"id": 1, "name": "b", "size": None}]
+
+    def it_rolls_everything_back_on_failure(pool, mocker):
+        with SquirrelDB(pool) as db:
+            mocker.patch.object(SquirrelDB, "deleteSquirrels", side_effect=sqlite3.OperationalError("disk I/O error"))
+            with pytest.raises(sqlite3.OperationalError):
+                db.applyBulk([{"op": "create", "name": "a", "size": "small"}, {"op": "delete", "id": 1}])
+            assert db.getSquirrels() == []
+
+
+def describe_GroupCommitter():
+
+    @pytest.fixture
+    def committer(db_path):
+        committer = GroupCommitter(db_path, maxDelay=0.05, maxBatch=64, durability="normal")
+        yield committer
+        committer.close()
+
+    def it_switches_the_database_to_wal(committer, db_path):
+        connection = sqlite3.connect(db_path)
+        assert connection.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+        assert committer.connection.execute("PRAGMA synchronous").fetchone() == {"synchronous": 1}
+
+    def it_commits_concurrent_writes_together(committer, pool):
+        threads = [threading.Thread(target=committer.submit, args=("INSERT INTO squirrels (name, size) VALUES (?, ?)", [str(i), "small"]))
+                   for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert committer.commits < 10
+        with SquirrelDB(pool) as db:
+            assert len(db.getSquirrels()) == 10
+
+    def it_fails_only_the_bad_statement(committer, pool):
+        results = {}
+
+        def write(key, sql):
+            try:
+                results[key] = committer.submit(sql, [])
+            except sqlite3.Error as e:
+                results[key] = e
+
+        threads = [threading.Thread(target=write, args=("good", "INSERT INTO squirrels (name, size) VALUES ('a', 'b')")),
+                   threading.Thread(target=write, args=("bad", "INSERT INTO nowhere VALUES (1)"))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results["good"] == []
+        assert isinstance(results["bad"], sqlite3.OperationalError)
+        with SquirrelDB(pool) as db:
+            assert len(db.getSquirrels()) == 1
+
+    def it_refuses_writes_after_close(committer):
+        committer.close()
+        with pytest.raises(sqlite3.ProgrammingError):
+            committer.submit("DELETE FROM squirrels", [])
+
+    def it_finishes_a_write_that_races_close(committer):
+        put = committer.jobs.put
+        closer = threading.Thread(target=committer.close)
+
+        # close() starts just as the write is being queued, and gets as far as it can
+        def racingPut(job):
+            if job is not None:
+                closer.start()
+                closer.join(0.2)
+            put(job)
+
+        committer.jobs.put = racingPut
+        writer = threading.Thread(target=committer.submit, args=("INSERT INTO squirrels (name, size) VALUES ('a', 'b')", []))
+        writer.start()
+        writer.join(5)
+        assert not writer.is_alive()
+        closer.join(5)
+        assert committer.commits == 1
+
+    def it_carries_SquirrelDB_writes_when_configured(db_path, pool, mocker):
+        committer = GroupCommitter(db_path)
+        mocker.patch.object(squirrel_db, "committer", committer)
+        spy = mocker.spy(committer, "submit")
+        with SquirrelDB(pool) as db:
+            db.createSquirrel("Fluffy", "large")
+            assert db.getSquirrels()[0]["name"] == "Fluffy"
+        committer.close()
+        spy.assert_called_once_with("INSERT INTO squirrels (name, size) VALUES (?, ?) RETURNING *", ["Fluffy", "large"])
+
+
+def describe_row_pipeline():
+
+    @pytest.fixture
+    def db(pool):
+        with SquirrelDB(pool) as db:
+            db.createSquirrels([("Fluffy", "large"), ('Say "hi"', None)])
+            yield db
+
+    def it_names_columns_once_per_statement(db):
+        factory = db.connection.row_factory
+        assert isinstance(factory, DictRowFactory)
+        db.getSquirrels()
+        names = factory.names
+        assert names == ("id", "name", "size")
+        db.getSquirrel(1)
+        # a new statement brings a new description, but equal names
+        assert factory.names == names
+
+    def it_returns_slotted_rows(db):
+        rows = db.getSquirrelRows()
+        assert rows == [SquirrelRow(1, "Fluffy", "large"), SquirrelRow(2, 'Say "hi"', None)]
+        assert rows[0].asDict() == {"id": 1, "name": "Fluffy", "size": "large"}
+
+    def it_renders_json_inside_sqlite(db):
+        assert json.loads(db.getSquirrelsJson()) == db.getSquirrels()
+        assert json.loads(db.getSquirrelJson(2)) == db.getSquirrel(2)
+        assert db.getSquirrelJson(99) is None
+        chunks = list(db.iterSquirrelsJson(chunkSize=1))
+        assert [json.loads(chunk[0]) for chunk in chunks] == db.getSquirrels()
+
+    def it_times_each_statement(pool, mocker):
+        registry = Metrics()
+        mocker.patch.object(squirrel_db, "metrics", registry)
+        with SquirrelDB(pool) as db:
+            db.getSquirrels()
+            db.getSquirrelsJson()
+        _, histograms = registry.collect()
+        assert sum(histograms[("squirrel_sql_duration_seconds", (("statement", "SELECT"),))][:-1]) == 2
+
+    def it_times_the_rows_as_they_are_fetched(db_path, mocker):
+        registry = Metrics()
+        mocker.patch.object(squirrel_db, "metrics", registry)
+        connection = sqlite3.connect(db_path, factory=squirrel_db.TimedConnection)
+        # every row sleeps while sqlite steps to it, long after execute returned
+        connection.create_function("nap", 1, lambda x: time.sleep(0.05) or x)
+        connection.executemany("INSERT INTO squirrels (name) VALUES (?)", [("a",), ("b",)])
+        rows = [row for row in connection.execute("SELECT nap(name) FROM squirrels")]
+        connection.close()
+        assert rows == [("a",), ("b",)]
+        _, histograms = registry.collect()
+        select = histograms[("squirrel_sql_duration_seconds", (("statement", "SELECT"),))]
+        assert sum(select[:-1]) == 1
+        assert select[-1] >= 0.1
+        assert sum(histograms[("squirrel_sql_duration_seconds", (("statement", "INSERT"),))][:-1]) == 1
+
+    def it_renders_an_empty_table_as_an_empty_array(pool):
+        with SquirrelDB(pool) as db:
+            assert db.getSquirrelsJson() == "[]"
+
+
+def names(rows):
+    return [row["name"] for row in rows]
+
+def describe_search():
+
+    @pytest.fixture
+    def db(db_path, pool):
+        with SquirrelDB(pool) as db:
+            # rows from before the search table existed get indexed too
+            db.createSquirrels([("Fluffy Tail", "large"), ("Flubber", "small"), ("Nutty", "large"), ("fluff", "large")])
+            ensureSchema(db_path)
+            yield db
+
+    def it_filters_by_size_prefix_and_words(db):
+        assert names(db.findSquirrels(size="large")) == ["Fluffy Tail", "Nutty", "fluff"]
+        assert names(db.findSquirrels(namePrefix="Flu")) == ["Fluffy Tail", "Flubber"]
+        assert names(db.findSquirrels(text="tail FLUFFY")) == ["Fluffy Tail"]
+        assert names(db.findSquirrels(size="large", namePrefix="Flu", text="tail")) == ["Fluffy Tail"]
+        assert db.findSquirrels(text='"unbalanced') == []
+
+    def it_pages_and_iterates_filtered_rows(db):
+        assert names(db.findSquirrels(size="large", limit=1, afterId=1)) == ["Nutty"]
+        assert [names(chunk) for chunk in db.iterSquirrels(chunkSize=2, size="large")] == [["Fluffy Tail", "Nutty"], ["fluff"]]
+        chunks = list(db.iterSquirrelsJson(chunkSize=1, namePrefix="Flu"))
+        assert [json.loads(chunk[0])["name"] for chunk in chunks] == ["Fluffy Tail", "Flubber"]
+
+    def it_keeps_the_search_table_in_step_with_writes(db):
+        db.createSquirrel("Acorn Tail", "small")
+        db.updateSquirrel(1, "Bushy", "large")
+        db.deleteSquirrels([2])
+        assert names(db.findSquirrels(text="tail")) == ["Acorn Tail"]
+        assert names(db.findSquirrels(text="bushy")) == ["Bushy"]
+        assert db.findSquirrels(text="flubber") == []
+
+    def it_can_run_again(db, db_path):
+        ensureSchema(db_path)
+        assert names(db.findSquirrels(text="nutty")) == ["Nutty"]
+
+    def it_never_scans_the_whole_table(db):
+        for filters in ({"size": "large"}, {"namePrefix": "Flu", "size": "large"}, {"text": "tail", "size": "large"}):
+            sql, data = findQuery("squirrels.*", limit=10, **filters)
+            plan = [row["detail"] for row in db.connection.execute("EXPLAIN QUERY PLAN " + sql, data)]
+            assert not any(step.startswith("SCAN squirrels") and "VIRTUAL" not in step for step in plan), plan
+            assert "squirrels_size" not in " ".join(plan) or list(filters) == ["size"]
+
+    def it_ends_a_prefix_range_after_the_last_match():
+        assert prefixEnd("Flu") == "Flv"
+        assert prefixEnd("a" + chr(0x10FFFF)) == "b"
+        assert prefixEnd("") is None
+        assert prefixEnd("a" + chr(0xD7FF)) == "a" + chr(0xE000)
+
+    def it_searches_a_prefix_that_ends_just_below_the_surrogates(db):
+        db.createSquirrel("Nut" + chr(0xD7FF) + "y", "small")
+        assert names(db.findSquirrels(namePrefix="Nut" + chr(0xD7FF))) == ["Nut" + chr(0xD7FF) + "y"]
+
+
+# every plain read SquirrelDB offers
+def reads(db):
+    return (db.getSquirrels(), db.getSquirrelsPage(1, afterId=1), db.getSquirrel(2), db.getSquirrel("03"),
+            db.getSquirrel("x"), db.getSquirrelsJson(), db.getSquirrelJson(3), db.getSquirrelRows(),
+            list(db.iterSquirrels(chunkSize=2)), list(db.iterSquirrelsJson(chunkSize=2)))
+
+def describe_SquirrelReplica():
+
+    @pytest.fixture
+    def replica(db_path, pool, mocker):
+        with SquirrelDB(pool) as db:
+            db.createSquirrels([("Fluffy", "large"), ('Say "hi"\n', None), ("Écureuil", "small")])
+        ensureSchema(db_path)
+        # no checker thread; the tests call check() themselves
+        replica = SquirrelReplica(db_path, checkInterval=0)
+        mocker.patch.object(squirrel_db, "replica", replica)
+        yield replica
+        replica.close()
+
+    def it_reads_the_same_as_sqlite_without_touching_it(replica, pool, mocker):
+        registry = Metrics()
+        mocker.patch.object(squirrel_db, "metrics", registry)
+        with SquirrelDB(pool) as db:
+            fromReplica = reads(db)
+            assert registry.collect() == ({}, {})
+            mocker.patch.object(squirrel_db, "replica", None)
+            assert fromReplica == reads(db)
+
+    def it_reads_ids_the_way_sqlite_does(replica, pool, mocker):
+        ids = ["1.0", "1e0", " 2 ", ".3e1", "1.5", "1_0", "\u0661", "1e400", "0x1"]
+        with SquirrelDB(pool) as db:
+            fromReplica = [db.getSquirrel(squirrelId) for squirrelId in ids]
+            mocker.patch.object(squirrel_db, "replica", None)
+            assert fromReplica == [db.getSquirrel(squirrelId) for squirrelId in ids]
+        assert [row and row["id"] for row in fromReplica] == [1, 1, 2, 3, None, None, None, None, None]
+
+    def it_applies_its_own_writes_in_order(replica, pool):
+        with SquirrelDB(pool) as db:
+            db.createSquirrel("Nova", "small")
+            db.updateSquirrel(1, "Fluffy", "medium")
+            db.deleteSquirrel("2")
+            db.applyBulk([{"op": "create", "name": "Bulk", "size": "large"}, {"op": "delete", "id": 3},
+                          {"op": "update", "id": 4, "name": "Nova", "size": "large"}])
+            assert [row["name"] for row in db.getSquirrels()] == ["Fluffy", "Nova", "Bulk"]
+            assert db.getSquirrel(4) == {"id": 4, "name": "Nova", "size": "large"}
+        assert replica.check() is True
+        assert replica.reloads == 0
+
+    def it_keeps_what_sqlite_stored_not_what_it_was_given(replica, pool, mocker):
+        with SquirrelDB(pool) as db:
+            db.applyBulk([{"op": "create", "name": 7, "size": 5}, {"op": "update", "id": 1, "name": 8.5, "size": None}])
+            db.createSquirrel(9, "small")
+            fromReplica = reads(db)
+            mocker.patch.object(squirrel_db, "replica", None)
+            assert fromReplica == reads(db)
+        assert replica.getSquirrel(4) == {"id": 4, "name": "7", "size": "5"}
+        assert replica.getSquirrelJson(1) == '{"id":1,"name":"8.5","size":null}'
+
+    def it_applies_writes_that_go_through_the_group_committer(replica, db_path, pool, mocker):
+        committer = GroupCommitter(db_path)
+        mocker.patch.object(squirrel_db, "committer", committer)
+        with SquirrelDB(pool) as db:
+            db.createSquirrel("Nova", "small")
+            db.updateSquirrel(9, "Ghost", "small")
+        committer.close()
+        assert replica.getSquirrel(4)["name"] == "Nova"
+        assert replica.check() is True
+
+    def it_forgets_a_bulk_write_that_is_rolled_back(replica, pool):
+        with SquirrelDB(pool) as db:
+            db.createSquirrels([("Nova", "small")], commit=False)
+            db.rollback()
+            db.deleteSquirrels([1], commit=False)
+        assert len(replica.getSquirrels()) == 3
+        assert (replica.pending, replica.check()) == (0, True)
+
+    def it_reloads_when_someone_else_writes(replica, db_path, mocker):
+        replica.onReload = mocker.Mock()
+        outsider = sqlite3.connect(db_path)
+        outsider.execute("UPDATE squirrels SET name = 'Changed' WHERE id = 1")
+        outsider.commit()
+        outsider.close()
+        assert replica.check() is False
+        replica.onReload.assert_called_once_with()
+        assert replica.getSquirrel(1)["name"] == "Changed"
+        assert replica.check() is True
+
+    def it_keeps_reading_and_writing_while_it_reloads(replica, db_path, pool, mocker):
+        # so the write can commit while the reload's read transaction is open
+        connection = sqlite3.connect(db_path)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.close()
+        seen = []
+        def writeAndRead():
+            with SquirrelDB(pool) as db:
+                db.createSquirrel("Nova", "small")
+                seen.append(names(db.getSquirrels()))
+        render = squirrel_db.squirrelJson
+        # the first row the reload reads waits for a write and a read on another thread
+        def renderAfterWriting(*row):
+            if not seen:
+                seen.append(None)
+                thread = threading.Thread(target=writeAndRead)
+                thread.start()
+                thread.join(timeout=5)
+            return render(*row)
+        mocker.patch.object(squirrel_db, "squirrelJson", side_effect=renderAfterWriting)
+        replica.reload()
+        everyone = ["Fluffy", 'Say "hi"\n', "Écureuil", "Nova"]
+        assert seen == [None, everyone]
+        assert names(replica.getSquirrels()) == everyone
+        assert replica.check() is True
+
+
+# (op, id, name) of each change, oldest first
+def ops(changes):
+    return [(change["op"], change["id"], change["name"]) for change in changes]
+
+def describe_change_log():
+
+    @pytest.fixture
+    def db(db_path, pool):
+        with SquirrelDB(pool) as db:
+            db.createSquirrels([("Fluffy", "large"), ("Nutty", "small")])
+            # the rows already there are logged as inserts
+            ensureSchema(db_path)
+            yield db
+
+    def it_logs_the_rows_already_there(db):
+        assert ops(db.getChanges()) == [("insert", 1, "Fluffy"), ("insert", 2, "Nutty")]
+        assert db.getChangeBounds() == (0, 2)
+
+    def it_keeps_only_the_latest_change_per_squirrel(db):
+        db.updateSquirrel(1, "Bushy", "large")
+        db.createSquirrel("Acorn", "small")
+        db.deleteSquirrel(2)
+        db.updateSquirrel(1, "Bushier", "large")
+        changes = db.getChanges()
+        assert ops(changes) == [("insert", 3, "Acorn"), ("delete", 2, None), ("update", 1, "Bushier")]
+        assert [change["seq"] for change in changes] == [4, 5, 6]
+        assert ops(db.getChanges(since=4, limit=1)) == [("delete", 2, None)]
+        assert db.getChangeBounds() == (0, 6)
+
+    def it_logs_bulk_and_outside_writes(db, db_path):
+        db.applyBulk([{"op": "create", "name": "Acorn", "size": "small"}, {"op": "delete", "id": 1}])
+        outsider = sqlite3.connect(db_path)
+        outsider.execute("UPDATE squirrels SET size = 'large' WHERE id = 2")
+        outsider.commit()
+        outsider.close()
+        assert ops(db.getChanges(since=2)) == [("insert", 3, "Acorn"), ("delete", 1, None), ("update", 2, "Nutty")]
+
+    def it_wakes_waiters_when_a_write_commits(db):
+        generation = squirrel_db.changeSignal.generation
+        woken = []
+        waiter = threading.Thread(target=lambda: woken.append(squirrel_db.changeSignal.wait(generation, 5)))
+        waiter.start()
+        db.createSquirrel("Acorn", "small")
+        waiter.join()
+        assert woken[0] != generation
+
+    def it_prunes_old_tombstones_and_moves_the_horizon(db, db_path):
+        db.createSquirrel("Acorn", "small")
+        db.deleteSquirrels([1, 2])
+        db.connection.execute("UPDATE squirrels_log SET at = at - 100 WHERE id = 1")
+        db.connection.commit()
+        # a long interval, so only the prune() below runs
+        pruner = ChangeLogPruner(db_path, retention=50, interval=3600)
+        try:
+            assert pruner.prune() == 1
+            assert pruner.prune() == 0
+        finally:
+            pruner.close()
+        assert ops(db.getChanges()) == [("insert", 3, "Acorn"), ("delete", 2, None)]
+        # seq 4 was the pruned tombstone for squirrel 1
+        assert db.getChangeBounds() == (4, 5)
+
+    def it_prunes_from_the_callers_loop_without_a_thread(db, db_path, mocker):
+        pruner = ChangeLogPruner(db_path, retention=50, interval=0.05, background=False)
+        prune = mocker.spy(pruner, "prune")
+        try:
+            assert pruner.thread is None
+            pruner.pruneIfDue()
+            assert prune.call_count == 0
+            time.sleep(0.06)
+            pruner.pruneIfDue()
+            pruner.pruneIfDue()
+            assert prune.call_count == 1
+        finally:
+            pruner.close()
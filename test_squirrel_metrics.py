@@ -0,0 +1,45 @@
+import threading
+from squirrel_metrics import Metrics, formatLabels
+
+
+def describe_Metrics():
+
+    def it_adds_up_counters_from_every_thread():
+        metrics = Metrics()
+
+        def work():
+            for _ in range(1000):
+                metrics.inc("hits", (("route", "/squirrels"),))
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        counters, _ = metrics.collect()
+        assert counters[("hits", (("route", "/squirrels"),))] == 4000
+        assert len(metrics.shards) == 4
+
+    def it_buckets_observations():
+        metrics = Metrics(buckets=(0.1, 1.0))
+        for seconds in (0.05, 0.1, 0.5, 3.0):
+            metrics.observe("latency", (), seconds)
+        _, histograms = metrics.collect()
+        assert histograms[("latency", ())] == [2, 1, 1, 3.65]
+
+    def it_renders_prometheus_text():
+        metrics = Metrics(buckets=(0.1, 1.0))
+        labels = (("route", "/squirrels"), ("method", "GET"), ("status", "200"))
+        metrics.observe("squirrel_http_request_duration_seconds", labels, 0.05)
+        metrics.observe("squirrel_http_request_duration_seconds", labels, 0.5)
+        metrics.inc("squirrel_http_requests_in_flight")
+        text = metrics.render()
+        assert '# TYPE squirrel_http_request_duration_seconds histogram' in text
+        assert 'squirrel_http_request_duration_seconds_bucket{route="/squirrels",method="GET",status="200",le="0.1"} 1' in text
+        assert 'squirrel_http_request_duration_seconds_bucket{route="/squirrels",method="GET",status="200",le="+Inf"} 2' in text
+        assert 'squirrel_http_request_duration_seconds_count{route="/squirrels",method="GET",status="200"} 2' in text
+        assert 'squirrel_http_requests_total{route="/squirrels",method="GET",status="200"} 2' in text
+        assert 'squirrel_http_requests_in_flight 1' in text
+
+    def it_escapes_label_values():
+        assert formatLabels((("q", 'say "hi"\\\n'),)) == r'{q="say \"hi\"\\\n"}'
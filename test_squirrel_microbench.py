@@ -0,0 +1,92 @@
+import json
+import pytest
+import squirrel_server
+import squirrel_db
+from squirrel_bench import seedDatabase
+from squirrel_microbench import StubDB, compare, database, main, rawRequest, regressions, runSuite, serve, sqliteDatabase, timeIt
+
+
+def result(us):
+    return {"us": us, "number": 100}
+
+def describe_harness():
+
+    def it_serves_a_request_without_a_socket():
+        with database(StubDB(3)):
+            assert serve(rawRequest("GET", "/squirrels")) == 200
+            assert serve(rawRequest("GET", "/squirrels/2")) == 200
+            assert serve(rawRequest("GET", "/nope")) == 404
+
+    def it_puts_the_real_database_back():
+        real = squirrel_server.SquirrelDB
+        with pytest.raises(RuntimeError):
+            with database(StubDB(1)):
+                assert squirrel_server.SquirrelDB is not real
+                raise RuntimeError()
+        assert squirrel_server.SquirrelDB is real
+
+    def it_puts_back_the_pool_and_committer_it_replaced(tmp_path):
+        path = str(tmp_path / "squirrel_db.db")
+        seedDatabase(path, 0)
+        squirrel_db.ensureSchema(path)
+        pool = squirrel_db.configurePool(path, 1)
+        committer = squirrel_db.configureGroupCommit(path)
+        try:
+            with sqliteDatabase(3):
+                assert squirrel_db.pool is not pool
+                assert serve(rawRequest("GET", "/squirrels/2")) == 200
+            assert squirrel_db.pool is pool
+            assert squirrel_db.committer is committer
+            with squirrel_db.SquirrelDB() as db:
+                assert db.getSquirrels() == []
+        finally:
+            squirrel_db.closeGroupCommit()
+            squirrel_db.closePool()
+
+def describe_timeIt():
+
+    def it_batches_until_min_time_and_prepares_each_batch():
+        prepared = []
+        seconds, number = timeIt(lambda: None, prepared.append, minTime=0.001, repeat=3)
+        assert seconds >= 0
+        assert number > 1
+        assert prepared[-3:] == [number] * 3
+
+def describe_runSuite():
+
+    def it_times_every_benchmark():
+        results = runSuite(rows=20, sizes=[5], minTime=0.0001, repeat=1)
+        routes = {"list", "page", "stream", "retrieve", "create", "update", "delete", "bulk", "changes"}
+        assert {f"stub/{route}" for route in routes} <= set(results)
+        assert {f"sqlite/{route}" for route in routes} <= set(results)
+        assert {f"mydb/{db}/{op}/5" for db in ("MyDB", "MyLogDB") for op in ("load", "save", "append")} <= set(results)
+        assert "handler/parsePath" in results
+        assert all(seconds > 0 and number >= 1 for seconds, number in results.values())
+
+    def it_runs_only_the_benchmarks_asked_for():
+        results = runSuite(rows=20, sizes=[5], minTime=0.0001, repeat=1, only=["stub/retrieve", "MyLogDB/load"])
+        assert set(results) == {"stub/retrieve", "mydb/MyLogDB/load/5"}
+
+def describe_compare():
+
+    def it_flags_what_got_slower():
+        baseline = {"results": {"a": result(10.0), "b": result(10.0), "gone": result(1.0)}}
+        current = {"results": {"a": result(11.0), "b": result(20.0), "new": result(5.0)}}
+        comparison = compare(baseline, current)
+        assert [row[0] for row in comparison] == ["b", "a"]
+        assert regressions(comparison, 1.25) == [("b", 10.0, 20.0, 2.0)]
+        assert regressions(comparison, 2.0) == []
+
+def describe_main():
+
+    def it_saves_a_baseline_and_fails_past_the_threshold(tmp_path, capsys):
+        path = tmp_path / "baseline.json"
+        args = ["--only", "handler/parsePath", "--min-time", "0.0001", "--repeat", "1"]
+        assert main(args + ["--output", str(path)]) == 0
+        baseline = json.loads(path.read_text())
+        assert set(baseline["results"]) == {"handler/parsePath"}
+        assert main(args + ["--baseline", str(path), "--threshold", "1000"]) == 0
+        baseline["results"]["handler/parsePath"]["us"] /= 10000
+        path.write_text(json.dumps(baseline))
+        assert main(args + ["--baseline", str(path)]) == 1
+        assert "slower than the baseline" in capsys.readouterr().err
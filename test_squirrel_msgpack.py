@@ -0,0 +1,58 @@
+import math
+import pytest
+from squirrel_msgpack import packb, unpackb, unpackStream
+
+
+def describe_packb():
+
+    def it_matches_the_msgpack_spec_byte_for_byte():
+        assert packb(None) == b'\xc0'
+        assert packb([True, False]) == b'\x92\xc3\xc2'
+        assert packb(5) == b'\x05'
+        assert packb(-1) == b'\xff'
+        assert packb(200) == b'\xcc\xc8'
+        assert packb(-33) == b'\xd0\xdf'
+        assert packb(70000) == b'\xce\x00\x01\x11\x70'
+        assert packb(1.5) == b'\xcb\x3f\xf8\x00\x00\x00\x00\x00\x00'
+        assert packb('id') == b'\xa2id'
+        assert packb(b'\x00') == b'\xc4\x01\x00'
+        assert packb({'id': 1}) == b'\x81\xa2id\x01'
+
+    def it_picks_the_wider_forms_at_their_boundaries():
+        assert packb('x' * 31)[:1] == b'\xbf'
+        assert packb('x' * 32)[:2] == b'\xd9\x20'
+        assert packb('x' * 256)[:3] == b'\xda\x01\x00'
+        assert packb(list(range(16)))[:3] == b'\xdc\x00\x10'
+        assert packb({str(i): i for i in range(16)})[:3] == b'\xde\x00\x10'
+        assert packb(2 ** 64 - 1)[:1] == b'\xcf'
+        assert packb(-2 ** 63)[:1] == b'\xd3'
+
+    def it_refuses_what_it_cannot_represent():
+        with pytest.raises(TypeError):
+            packb({1, 2})
+        with pytest.raises(OverflowError):
+            packb(2 ** 64)
+
+
+def describe_unpackb():
+
+    def it_round_trips_everything_it_packs():
+        values = [None, True, False, 0, 127, 128, -32, -33, 65535, 65536, 2 ** 40, -2 ** 40, 2 ** 64 - 1,
+                  0.25, -1e300, '', 'Flüffy', 'x' * 70000, b'', b'\xff' * 300, [], list(range(20)),
+                  {'id': 1, 'name': 'Nova', 'size': None, 'tags': ['a', {'b': [1.5]}]}]
+        for value in values:
+            assert unpackb(packb(value)) == value
+
+    def it_reads_float32():
+        assert unpackb(b'\xca\x3f\xc0\x00\x00') == 1.5
+        assert math.isinf(unpackb(b'\xca\x7f\x80\x00\x00'))
+
+    def it_raises_value_error_for_bad_input():
+        for data in [b'', b'\xa5abc', b'\x92\x01', b'\xcd\x01', b'\xc1', b'\xd4\x01\x02', b'\x01\x02',
+                     b'\xa2\xff\xfe', b'\x81\x90\x01', b'\x91' * 100000]:
+            with pytest.raises(ValueError):
+                unpackb(data)
+
+    def it_reads_objects_back_to_back():
+        data = packb({'op': 'delete', 'id': 1}) + packb({'op': 'delete', 'id': 2})
+        assert list(unpackStream(data)) == [{'op': 'delete', 'id': 1}, {'op': 'delete', 'id': 2}]
@@ -0,0 +1,65 @@
+import http.client
+import json
+import os
+import signal
+import time
+import pytest
+from squirrel_bench import ServerProcess, seedDatabase
+
+pytestmark = pytest.mark.skipif(not hasattr(os, "fork"), reason="pre-forking needs os.fork")
+
+
+def request(port, method, path, body=None):
+    # a fresh connection each time, so the kernel can pick any worker
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'} if body else {}
+    conn.request(method, path, body=body, headers=headers)
+    resp = conn.getresponse()
+    data = resp.read()
+    conn.close()
+    return resp.status, data
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / 'squirrels.db')
+    seedDatabase(path, 3)
+    return path
+
+
+def describe_PreforkMaster():
+
+    @pytest.mark.parametrize('extra', [[], ['--reuse-port'], ['--reuse-port', '--engine', 'asyncio']])
+    def it_keeps_serving_while_workers_are_recycled(db_path, tmp_path, extra):
+        with open(tmp_path / 'stderr', 'w') as errorLog:
+            with ServerProcess(db_path, ['--processes', '2', '--max-requests', '3'] + extra, errorLog=errorLog) as server:
+                statuses = [request(server.port, 'GET', '/squirrels/1')[0] for _ in range(20)]
+        assert statuses == [200] * 20
+        # a worker that crashed on its way out would still have been replaced
+        assert 'Traceback' not in (tmp_path / 'stderr').read_text()
+
+    def it_never_serves_a_listing_cached_before_another_worker_wrote(db_path):
+        with ServerProcess(db_path, ['--processes', '3']) as server:
+            for _ in range(6):
+                request(server.port, 'GET', '/squirrels')
+            status, body = request(server.port, 'POST', '/squirrels', 'name=Fresh&size=small')
+            assert status == 201
+            for _ in range(12):
+                listed = json.loads(request(server.port, 'GET', '/squirrels')[1])
+                assert listed[-1]['name'] == 'Fresh'
+
+    def it_replaces_its_workers_on_sighup_and_stops_on_sigterm(db_path):
+        with ServerProcess(db_path, ['--processes', '2']) as server:
+            assert request(server.port, 'GET', '/squirrels/2')[0] == 200
+            server.process.send_signal(signal.SIGHUP)
+            statuses = [request(server.port, 'GET', '/squirrels/2')[0] for _ in range(10)]
+            assert statuses == [200] * 10
+            server.process.send_signal(signal.SIGTERM)
+            assert server.process.wait(timeout=10) == 0
+
+    def it_prunes_the_change_log_from_the_master(db_path):
+        with ServerProcess(db_path, ['--processes', '2', '--change-retention', '0.2']) as server:
+            assert request(server.port, 'DELETE', '/squirrels/1')[0] == 204
+            assert request(server.port, 'GET', '/squirrels/changes?since=1')[0] == 200
+            time.sleep(1)
+            # the tombstone is gone, so a client that saw only seq 1 may have missed it
+            assert request(server.port, 'GET', '/squirrels/changes?since=1')[0] == 410
@@ -1,18 +1,30 @@
 
 
+import gzip
+import http.client
 import io
 import json
+import socket
+import threading
 import pytest
-from squirrel_server import SquirrelServerHandler
+import squirrel_msgpack
+import squirrel_server
+from squirrel_server import JSON, MSGPACK, NDJSON, SquirrelServerHandler, ThreadPoolHTTPServer, acceptsGzip, negotiate, parseArgs
 from squirrel_db import SquirrelDB
+import squirrel_cache
+from squirrel_cache import makeEtag
+from squirrel_admission import admission
+from squirrel_metrics import Metrics
 
 
 class FakeRequest:
-    def __init__(self, mock_wfile, method, path, body=None):
+    def __init__(self, mock_wfile, method, path, body=None, version='HTTP/1.0', headers=None):
         self._mock_wfile = mock_wfile
         self._method = method
         self._path = path
         self._body = body
+        self._version = version
+        self._headers = headers or {}
 
     def sendall(self, _):
         return
@@ -20,10 +32,14 @@ class FakeRequest:
     def makefile(self, *args, **kwargs):
         # 'rb' is what the handler reads (request line + headers + body)
         if args[0] == 'rb':
-            headers = f'Content-Length: {len(self._body)}\r\n' if self._body else ''
-            body = self._body or ''
-            raw = f'{self._method} {self._path} HTTP/1.0\r\n{headers}\r\n{body}'
-            return io.BytesIO(raw.encode('utf-8'))
+            # a str body is sent as UTF-8, bytes (msgpack) as they are
+            body = self._body or b''
+            if isinstance(body, str):
+                body = body.encode('utf-8')
+            headers = f'Content-Length: {len(body)}\r\n' if body else ''
+            headers += ''.join(f'{name}: {value}\r\n' for name, value in self._headers.items())
+            raw = f'{self._method} {self._path} {self._version}\r\n{headers}\r\n'
+            return io.BytesIO(raw.encode('utf-8') + body)
         # 'wb' is what the handler writes the response body to
         elif args[0] == 'wb':
             return self._mock_wfile
@@ -47,6 +63,13 @@ def patch_wbufsize(mocker):
 def mock_db_init(mocker):
     return mocker.patch.object(SquirrelDB, '__init__', return_value=None)
 
+# a fresh response cache per test, so nothing one test renders leaks into the next
+@pytest.fixture
+def response_cache(mocker):
+    cache = squirrel_cache.ResponseCache()
+    mocker.patch.object(squirrel_cache, 'cache', cache)
+    return cache
+
 # Took these from the example — these are great
 # I read the docs and still only kinda get what’s going on with these
 @pytest.fixture
@@ -63,8 +86,8 @@ def describe_SquirrelServerHandler():
     # GET /squirrels → handleSquirrelsIndex
     def describe_handleSquirrelsIndex():
         def it_returns_200_and_json_list(mocker, mock_db_init, dummy_client, dummy_server, mock_response_methods):
-            # stub DB to return a simple list
-            mock_get = mocker.patch.object(SquirrelDB, 'getSquirrels', return_value=['s1'])
+            # stub DB to return a simple list (sqlite renders it as JSON text)
+            mock_get = mocker.patch.object(SquirrelDB, 'getSquirrelsJson', return_value='["s1"]')
             req = FakeRequest(mocker.Mock(), 'GET', '/squirrels')
 
             handler = SquirrelServerHandler(req, dummy_client, dummy_server)
@@ -73,14 +96,318 @@ def describe_SquirrelServerHandler():
             mock_get.assert_called_once_with()
             send, hdr, end = mock_response_methods
             send.assert_called_once_with(200)
-            hdr.assert_called_once_with("Content-Type", "application/json")
+            body = b'["s1"]'
+            assert hdr.call_args_list == [mocker.call("Content-Type", "application/json"), mocker.call("Content-Length", str(len(body))), mocker.call("ETag", makeEtag(body)), mocker.call("Vary", "Accept")]
             end.assert_called_once()
-            handler.wfile.write.assert_called_once_with(bytes(json.dumps(['s1']), 'utf-8'))
+            handler.wfile.write.assert_called_once_with(body)
+
+        def it_gives_the_db_connection_back(mocker, mock_db_init, dummy_client, dummy_server, mock_response_methods):
+            mocker.patch.object(SquirrelDB, 'getSquirrelsJson', return_value='[]')
+            mock_close = mocker.patch.object(SquirrelDB, 'close')
+            req = FakeRequest(mocker.Mock(), 'GET', '/squirrels')
+
+            SquirrelServerHandler(req, dummy_client, dummy_server)
+
+            mock_close.assert_called_once_with()
+
+    # ETag / If-None-Match and the response cache
+    def describe_response_cache():
+        def it_answers_a_repeat_read_without_the_db(mocker, mock_db_init, dummy_client, dummy_server, mock_response_methods, response_cache):
+            mock_get = mocker.patch.object(SquirrelDB, 'getSquirrelsJson', return_value='[{"id":1}]')
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels'), dummy_client, dummy_server)
+            handler = SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels'), dummy_client, dummy_server)
+
+            mock_get.assert_called_once_with()
+            handler.wfile.write.assert_called_once_with(b'[{"id":1}]')
+
+        def it_returns_304_when_the_etag_matches(mocker, mock_db_init, dummy_client, dummy_server, mock_response_methods, response_cache):
+            body = b'{"id": 1}'
+            response_cache.put(('item', 1), squirrel_cache.CacheEntry(body), response_cache.generation)
+            mock_get = mocker.patch.object(SquirrelDB, 'getSquirrelJson')
+            req = FakeRequest(mocker.Mock(), 'GET', '/squirrels/1', headers={'If-None-Match': makeEtag(body)})
+
+            handler = SquirrelServerHandler(req, dummy_client, dummy_server)
+
+            mock_get.assert_not_called()
+            send, hdr, end = mock_response_methods
+            send.assert_called_once_with(304)
+            assert hdr.call_args_list == [mocker.call("ETag", makeEtag(body)), mocker.call("Vary", "Accept")]
+            handler.wfile.write.assert_not_called()
+
+        def it_drops_the_item_and_lists_on_update(mocker, mock_db_init, dummy_client, dummy_server, mock_response_methods, response_cache):
+            for key in [('list',), ('page', 10, 0), ('item', 1), ('item', 2)]:
+                response_cache.put(key, squirrel_cache.CacheEntry(b'[]'), response_cache.generation)
+            mocker.patch.object(SquirrelDB, 'updateSquirrel', return_value={'id': 1, 'name': 'Nova', 'size': 'medium'})
+            req = FakeRequest(mocker.Mock(), 'PUT', '/squirrels/1', body='name=Nova&size=medium')
+
+            SquirrelServerHandler(req, dummy_client, dummy_server)
+
+            assert list(response_cache.entries) == [('item', 2)]
+
+        def it_drops_only_lists_on_create(mocker, mock_db_init, dummy_client, dummy_server, mock_response_methods, response_cache):
+            for key in [('list',), ('item', 1)]:
+                response_cache.put(key, squirrel_cache.CacheEntry(b'[]'), response_cache.generation)
+            mocker.patch.object(SquirrelDB, 'createSquirrel', return_value={'id': 2, 'name': 'Chippy', 'size': 'small'})
+            req = FakeRequest(mocker.Mock(), 'POST', '/squirrels', body='name=Chippy&size=small')
+
+            SquirrelServerHandler(req, dummy_client, dummy_server)
+
+            assert list(response_cache.entries) == [('item', 1)]
+
+    # GET /squirrels?limit=&after_id= → handleSquirrelsPage
+    def describe_handleSquirrelsPage():
+        def it_asks_for_one_extra_row_and_links_the_next_page(mocker, mock_db_init, dummy_client, dummy_server, mock_response_methods):
+            rows = [{'id': 4}, {'id': 7}, {'id': 9}]
+            mock_page = mocker.patch.object(SquirrelDB, 'getSquirrelsPage', return_value=rows)
+            req = FakeRequest(mocker.Mock(), 'GET', '/squirrels?limit=2&after_id=3')
+
+            handler = SquirrelServerHandler(req, dummy_client, dummy_server)
+
+            mock_page.assert_called_once_with(3, 3)
+            send, hdr, end = mock_response_methods
+            send.assert_called_once_with(200)
+            hdr.assert_any_call("Link", '</squirrels?limit=2&after_id=7>; rel="next"')
+            # compact, like every other listing
+            handler.wfile.write.assert_called_once_with(bytes(json.dumps(rows[:2], separators=(',', ':')), 'utf-8'))
+
+        def it_leaves_out_the_link_on_the_last_page(mocker, mock_db_init, dummy_client, dummy_server, mock_response_methods):
+            mocker.patch.object(SquirrelDB, 'getSquirrelsPage', return_value=[{'id': 9}])
+            req = FakeRequest(mocker.Mock(), 'GET', '/squirrels?after_id=7')
+
+            SquirrelServerHandler(req, dummy_client, dummy_server)
+
+            send, hdr, end = mock_response_methods
+            assert "Link" not in [c.args[0] for c in hdr.call_args_list]
+
+        def it_returns_400_for_a_bad_limit(mocker, mock_db_init, dummy_client, dummy_server, mock_response_methods):
+            mock_page = mocker.patch.object(SquirrelDB, 'getSquirrelsPage')
+            req = FakeRequest(mocker.Mock(), 'GET', '/squirrels?limit=0')
+
+            SquirrelServerHandler(req, dummy_client, dummy_server)
+
+            send, hdr, end = mock_response_methods
+            send.assert_called_once_with(400)
+            mock_page.assert_not_called()
+
+        def it_words_a_bound_with_no_maximum(mocker, mock_db_init, dummy_client, dummy_server, mock_response_methods):
+            req = FakeRequest(mocker.Mock(), 'GET', '/squirrels?after_id=-1')
+
+            handler = SquirrelServerHandler(req, dummy_client, dummy_server)
+
+            handler.wfile.write.assert_called_once_with(b'400 Bad Request: after_id must be at least 0')
+
+    # GET /squirrels?size=&name_prefix=&q= → SquirrelDB.findSquirrels
+    def describe_filters():
+        def it_sends_the_matching_squirrels(mocker, mock_db_init, dummy_client, dummy_server, mock_response_methods, response_cache):
+            mock_find = mocker.patch.object(SquirrelDB, 'findSquirrelsJson', return_value=['{"id":3}'])
+            req = FakeRequest(mocker.Mock(), 'GET', '/squirrels?size=large&q=fluffy+tail&name_prefix=Flu')
+
+            handler = SquirrelServerHandler(req, dummy_client, dummy_server)
+
+            mock_find.assert_called_once_with(size='large', namePrefix='Flu', text='fluffy tail')
+            handler.wfile.write.assert_called_once_with(b'[{"id":3}]')
+            assert list(response_cache.entries) == [('list', ('namePrefix', 'Flu'), ('size', 'large'), ('text', 'fluffy tail'))]
+
+        def it_keeps_the_filters_in_the_next_page_link(mocker, mock_db_init, dummy_client, dummy_server, mock_response_methods):
+            mock_find = mocker.patch.object(SquirrelDB, 'findSquirrels', return_value=[{'id': 4}, {'id': 7}])
+            req = FakeRequest(mocker.Mock(), 'GET', '/squirrels?limit=1&q=nut+%26+bolt&size=small')
+
+            SquirrelServerHandler(req, dummy_client, dummy_server)
+
+            mock_find.assert_called_once_with(limit=2, afterId=0, size='small', text='nut & bolt')
+            send, hdr, end = mock_response_methods
+            hdr.assert_any_call("Link", '</squirrels?limit=1&after_id=4&size=small&q=nut%20%26%20bolt>; rel="next"')
+
+        def it_ignores_a_query_without_words(mocker, mock_db_init, dummy_client, dummy_server, mock_response_methods):
+            mock_list = mocker.patch.object(SquirrelDB, 'getSquirrelsJson', return_value='[]')
+            req = FakeRequest(mocker.Mock(), 'GET', '/squirrels?q=+++')
+
+            SquirrelServerHandler(req, dummy_client, dummy_server)
+
+            mock_list.assert_called_once_with()
+
+    # GET /squirrels?stream=1 → handleSquirrelsStream
+    def describe_handleSquirrelsStream():
+        def it_writes_chunked_json_for_http11(mocker, mock_db_init, dummy_client, dummy_server, mock_response_methods):
+            mocker.patch.object(SquirrelDB, 'iterSquirrelsJson', return_value=iter([['{"id": 1}'], ['{"id": 2}']]))
+            req = FakeRequest(mocker.Mock(), 'GET', '/squirrels?stream=1', version='HTTP/1.1')
+
+            handler = SquirrelServerHandler(req, dummy_client, dummy_server)
+
+            send, hdr, end = mock_response_methods
+            hdr.assert_any_call("Transfer-Encoding", "chunked")
+            written = b''.join(c.args[0] for c in handler.wfile.write.call_args_list)
+            assert written == b'1\r\n[\r\n9\r\n{"id": 1}\r\nA\r\n,{"id": 2}\r\n1\r\n]\r\n0\r\n\r\n'
+
+        def it_writes_plain_json_and_closes_for_http10(mocker, mock_db_init, dummy_client, dummy_server, mock_response_methods):
+            mocker.patch.object(SquirrelDB, 'iterSquirrelsJson', return_value=iter([['{"id":1}', '{"id":2}']]))
+            req = FakeRequest(mocker.Mock(), 'GET', '/squirrels?stream=true')
+
+            handler = SquirrelServerHandler(req, dummy_client, dummy_server)
+
+            written = b''.join(c.args[0] for c in handler.wfile.write.call_args_list)
+            assert json.loads(written) == [{'id': 1}, {'id': 2}]
+            assert handler.close_connection
+
+    # Accept and Content-Type pick NDJSON or msgpack instead of JSON
+    def describe_content_negotiation():
+        def it_sends_the_list_as_ndjson_lines(mocker, mock_db_init, dummy_client, dummy_server, mock_response_methods):
+            mocker.patch.object(SquirrelDB, 'iterSquirrelsJson', return_value=iter([['{"id":1}', '{"id":2}'], ['{"id":3}']]))
+            req = FakeRequest(mocker.Mock(), 'GET', '/squirrels', headers={'Accept': 'application/x-ndjson'})
+
+            handler = SquirrelServerHandler(req, dummy_client, dummy_server)
+
+            send, hdr, end = mock_response_methods
+            hdr.assert_any_call("Content-Type", "application/x-ndjson")
+            handler.wfile.write.assert_called_once_with(b'{"id":1}\n{"id":2}\n{"id":3}\n')
+
+        def it_sends_one_squirrel_as_msgpack(mocker, mock_db_init, dummy_client, dummy_server, mock_response_methods):
+            squirrel = {'id': 1, 'name': 'Fluffy', 'size': 'large'}
+            mocker.patch.object(SquirrelDB, 'getSquirrel', return_value=squirrel)
+            req = FakeRequest(mocker.Mock(), 'GET', '/squirrels/1', headers={'Accept': 'application/msgpack'})
+
+            handler = SquirrelServerHandler(req, dummy_client, dummy_server)
+
+            send, hdr, end = mock_response_methods
+            hdr.assert_any_call("Content-Type", "application/msgpack")
+            assert squirrel_msgpack.unpackb(handler.wfile.write.call_args.args[0]) == squirrel
+
+        def it_streams_msgpack_maps_back_to_back(mocker, mock_db_init, dummy_client, dummy_server, mock_response_methods):
+            rows = [{'id': 1, 'name': 'a', 'size': 's'}, {'id': 2, 'name': 'b', 'size': 'm'}]
+            mocker.patch.object(SquirrelDB, 'iterSquirrels', return_value=iter([rows]))
+            req = FakeRequest(mocker.Mock(), 'GET', '/squirrels?stream=1', headers={'Accept': 'application/x-msgpack'})
+
+            handler = SquirrelServerHandler(req, dummy_client, dummy_server)
+
+            written = b''.join(c.args[0] for c in handler.wfile.write.call_args_list)
+            assert list(squirrel_msgpack.unpackStream(written)) == rows
+
+        def it_caches_each_encoding_apart_and_drops_them_together(mocker, mock_db_init, dummy_client, dummy_server, mock_response_methods, response_cache):
+            mocker.patch.object(SquirrelDB, 'getSquirrelJson', return_value='{"id":1}')
+            mocker.patch.object(SquirrelDB, 'getSquirrel', return_value={'id': 1})
+            for accept in ('application/json', 'application/msgpack'):
+                SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels/1', headers={'Accept': accept}), dummy_client, dummy_server)
+            assert list(response_cache.entries) == [('item', 1), ('item', 1, 'application/msgpack')]
+            response_cache.invalidateItems([1])
+            assert response_cache.entries == {}
+
+        def it_reads_json_and_msgpack_bodies(mocker, mock_db_init, dummy_client, dummy_server, mock_response_methods):
+            mock_create = mocker.patch.object(SquirrelDB, 'createSquirrel', return_value={'id': 7, 'name': 'Chippy', 'size': 'small'})
+            bodies = [('application/json; charset=utf-8', '{"name": "Chippy", "size": "small"}'),
+                      ('application/x-ndjson', '{"name": "Chippy", "size": "small"}\n'),
+                      ('application/msgpack', squirrel_msgpack.packb({'name': 'Chippy', 'size': 'small'}))]
+            for contentType, body in bodies:
+                req = FakeRequest(mocker.Mock(), 'POST', '/squirrels', body=body, headers={'Content-Type': contentType})
+                SquirrelServerHandler(req, dummy_client, dummy_server)
+            assert mock_create.call_args_list == [mocker.call('Chippy', 'small')] * 3
+
+        def it_returns_400_for_a_body_it_cannot_use(mocker, mock_db_init, dummy_client, dummy_server, mock_response_methods):
+            mock_update = mocker.patch.object(SquirrelDB, 'updateSquirrel')
+            for contentType, body in [('application/json', '{"name": '), ('application/json', '["Chippy"]'),
+                                      ('application/msgpack', b'\x82\xa4name'), ('application/json', '{"name": "Chippy"}')]:
+                req = FakeRequest(mocker.Mock(), 'PUT', '/squirrels/1', body=body, headers={'Content-Type': contentType})
+                SquirrelServerHandler(req, dummy_client, dummy_server)
+            send, hdr, end = mock_response_methods
+            assert send.call_args_list == [mocker.call(400)] * 4
+            mock_update.assert_not_called()
+
+        def it_takes_bulk_operations_as_msgpack(mocker, mock_db_init, dummy_client, dummy_server, mock_response_methods):
+            results = [{'op': 'delete', 'status': 204, 'id': 1}]
+            mock_bulk = mocker.patch.object(SquirrelDB, 'applyBulk', return_value=results)
+            body = squirrel_msgpack.packb({'op': 'delete', 'id': 1}) + squirrel_msgpack.packb({'op': 'delete', 'id': 2})
+            req = FakeRequest(mocker.Mock(), 'POST', '/squirrels/_bulk', body=body,
+                              headers={'Content-Type': 'application/msgpack', 'Accept': 'application/msgpack'})
+
+            handler = SquirrelServerHandler(req, dummy_client, dummy_server)
+
+            mock_bulk.assert_called_once_with([{'op': 'delete', 'id': 1}, {'op': 'delete', 'id': 2}])
+            assert squirrel_msgpack.unpackb(handler.wfile.write.call_args.args[0]) == {'errors': False, 'results': results}
+
+    # Accept-Encoding: gzip compresses big bodies, once per cached resource
+    def describe_gzip():
+        big = json.dumps([{'id': i, 'name': f'squirrel-{i}', 'size': 'large'} for i in range(100)])
+
+        def it_compresses_a_large_listing_once_and_caches_it(mocker, mock_db_init, dummy_client, dummy_server, mock_response_methods, response_cache):
+            mocker.patch.object(SquirrelDB, 'getSquirrelsJson', return_value=big)
+            compress = mocker.spy(squirrel_server, 'gzipBody')
+            for _ in range(2):
+                req = FakeRequest(mocker.Mock(), 'GET', '/squirrels', headers={'Accept-Encoding': 'gzip, deflate'})
+                handler = SquirrelServerHandler(req, dummy_client, dummy_server)
+
+            send, hdr, end = mock_response_methods
+            assert gzip.decompress(handler.wfile.write.call_args.args[0]) == big.encode()
+            hdr.assert_any_call("Content-Encoding", "gzip")
+            hdr.assert_any_call("Vary", "Accept, Accept-Encoding")
+            hdr.assert_any_call("ETag", makeEtag(big.encode())[:-1] + '-gzip"')
+            assert compress.call_count == 1
+            assert list(response_cache.entries) == [('list',), ('list', 'gzip')]
+            response_cache.invalidateLists()
+            assert response_cache.entries == {}
+
+        def it_leaves_small_bodies_and_other_clients_alone(mocker, mock_db_init, dummy_client, dummy_server, mock_response_methods):
+            mocker.patch.object(SquirrelDB, 'getSquirrelJson', return_value='{"id":1}')
+            mocker.patch.object(SquirrelDB, 'getSquirrelsJson', return_value=big)
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels/1', headers={'Accept-Encoding': 'gzip'}), dummy_client, dummy_server)
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels', headers={'Accept-Encoding': 'gzip;q=0'}), dummy_client, dummy_server)
+
+            send, hdr, end = mock_response_methods
+            assert mocker.call("Content-Encoding", "gzip") not in hdr.call_args_list
+            assert mocker.call("Vary", "Accept") in hdr.call_args_list
+            assert mocker.call("Vary", "Accept, Accept-Encoding") in hdr.call_args_list
+
+        def it_compresses_a_stream_as_it_goes(mocker, mock_db_init, dummy_client, dummy_server, mock_response_methods):
+            mocker.patch.object(SquirrelDB, 'iterSquirrelsJson', return_value=iter([['{"id":1}'], ['{"id":2}']]))
+            req = FakeRequest(mocker.Mock(), 'GET', '/squirrels?stream=1', headers={'Accept-Encoding': 'gzip'})
+
+            handler = SquirrelServerHandler(req, dummy_client, dummy_server)
+
+            send, hdr, end = mock_response_methods
+            hdr.assert_any_call("Content-Encoding", "gzip")
+            written = b''.join(c.args[0] for c in handler.wfile.write.call_args_list)
+            assert json.loads(gzip.decompress(written)) == [{'id': 1}, {'id': 2}]
+
+    # GET /squirrels/changes → handleSquirrelsChanges
+    def describe_handleSquirrelsChanges():
+        def it_sends_the_changes_after_since(mocker, mock_db_init, dummy_client, dummy_server, mock_response_methods):
+            get_changes = mocker.patch.object(SquirrelDB, 'getChanges', return_value=[
+                {'seq': 4, 'op': 'update', 'id': 1, 'name': 'Bushy', 'size': 'large'},
+                {'seq': 6, 'op': 'delete', 'id': 2, 'name': None, 'size': None},
+                {'seq': 7, 'op': 'insert', 'id': 3, 'name': 'Acorn', 'size': 'small'}])
+            mocker.patch.object(SquirrelDB, 'getChangeBounds', return_value=(0, 7))
+
+            handler = SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels/changes?since=3&limit=2'), dummy_client, dummy_server)
+
+            # one more than the limit says whether there are more
+            get_changes.assert_called_once_with(3, 3)
+            send, hdr, _ = mock_response_methods
+            send.assert_called_once_with(200)
+            assert mocker.call('Cache-Control', 'no-store') in hdr.call_args_list
+            assert json.loads(handler.wfile.write.call_args.args[0]) == {
+                'changes': [{'seq': 4, 'op': 'update', 'id': 1, 'name': 'Bushy', 'size': 'large'},
+                            {'seq': 6, 'op': 'delete', 'id': 2}],
+                'last_seq': 6, 'more': True}
+
+        def it_answers_410_for_a_since_it_can_no_longer_follow(mocker, mock_db_init, dummy_client, dummy_server, mock_response_methods):
+            mocker.patch.object(SquirrelDB, 'getChanges', return_value=[])
+            mocker.patch.object(SquirrelDB, 'getChangeBounds', return_value=(5, 9))
+            send, _, _ = mock_response_methods
+            # older than the pruned tombstones, then newer than anything logged
+            for since in ('3', '10'):
+                SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', f'/squirrels/changes?since={since}'), dummy_client, dummy_server)
+            assert send.call_args_list == [mocker.call(410), mocker.call(410)]
+            # a new client starts from 0, whatever was pruned
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels/changes'), dummy_client, dummy_server)
+            assert send.call_args == mocker.call(200)
+
+        def it_returns_400_for_a_bad_wait(mocker, mock_db_init, dummy_client, dummy_server, mock_response_methods):
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels/changes?wait=31'), dummy_client, dummy_server)
+            send, _, _ = mock_response_methods
+            send.assert_called_once_with(400)
 
     # GET /squirrels/{id} → handleSquirrelsRetrieve
     def describe_handleSquirrelsRetrieve():
         def it_returns_200_and_the_squirrel_when_found(mocker, mock_db_init, dummy_client, dummy_server, mock_response_methods):
-            mock_get = mocker.patch.object(SquirrelDB, 'getSquirrel', return_value={'id': '1', 'name': 'Fluffy', 'size': 'large'})
+            mock_get = mocker.patch.object(SquirrelDB, 'getSquirrelJson', return_value=json.dumps({'id': '1', 'name': 'Fluffy', 'size': 'large'}))
             req = FakeRequest(mocker.Mock(), 'GET', '/squirrels/1')
 
             handler = SquirrelServerHandler(req, dummy_client, dummy_server)
@@ -89,12 +416,13 @@ def describe_SquirrelServerHandler():
             mock_get.assert_called_once_with('1')
             send, hdr, end = mock_response_methods
             send.assert_called_once_with(200)
-            hdr.assert_called_once_with("Content-Type", "application/json")
+            body = json.dumps({'id': '1', 'name': 'Fluffy', 'size': 'large'})
+            assert hdr.call_args_list == [mocker.call("Content-Type", "application/json"), mocker.call("Content-Length", str(len(body))), mocker.call("ETag", makeEtag(bytes(body, 'utf-8'))), mocker.call("Vary", "Accept")]
             end.assert_called_once()
             handler.wfile.write.assert_called_once_with(bytes(json.dumps({'id': '1', 'name': 'Fluffy', 'size': 'large'}), 'utf-8'))
 
         def it_calls_handle404_when_id_not_found(mocker, mock_db_init, dummy_client, dummy_server):
-            mocker.patch.object(SquirrelDB, 'getSquirrel', return_value=None)
+            mocker.patch.object(SquirrelDB, 'getSquirrelJson', return_value=None)
             spy_404 = mocker.patch.object(SquirrelServerHandler, 'handle404')
             req = FakeRequest(mocker.Mock(), 'GET', '/squirrels/999')
 
@@ -108,16 +436,33 @@ def describe_SquirrelServerHandler():
         def it_creates_and_returns_201(mocker, mock_db_init, dummy_client, dummy_server, mock_response_methods):
             # important: server expects form-encoded, not JSON
             req = FakeRequest(mocker.Mock(), 'POST', '/squirrels', body='name=Chippy&size=small')
-            mock_create = mocker.patch.object(SquirrelDB, 'createSquirrel', return_value=None)
+            created = {'id': 7, 'name': 'Chippy', 'size': 'small'}
+            mock_create = mocker.patch.object(SquirrelDB, 'createSquirrel', return_value=created)
+            mock_get = mocker.patch.object(SquirrelDB, 'getSquirrel')
 
             SquirrelServerHandler(req, dummy_client, dummy_server)
 
             mock_create.assert_called_once_with('Chippy', 'small')
+            mock_get.assert_not_called()
             send, hdr, end = mock_response_methods
             send.assert_called_once_with(201)
+            body = b'{"id":7,"name":"Chippy","size":"small"}'
+            assert hdr.call_args_list == [mocker.call("Content-Type", "application/json"), mocker.call("Content-Length", str(len(body))), mocker.call("Location", "/squirrels/7")]
             end.assert_called_once()
-            # create does not write a body
-            req._mock_wfile.write.assert_not_called()
+            # create hands back the new squirrel so clients don't have to look for it
+            req._mock_wfile.write.assert_called_once_with(body)
+
+        def it_returns_400_for_a_name_or_size_that_is_not_a_string_or_number(mocker, mock_db_init, dummy_client, dummy_server, mock_response_methods):
+            mock_create = mocker.patch.object(SquirrelDB, 'createSquirrel')
+            json_type = {'Content-Type': 'application/json'}
+            handlers = [SquirrelServerHandler(FakeRequest(mocker.Mock(), 'POST', '/squirrels', body=body, headers=json_type), dummy_client, dummy_server)
+                        for body in ['{"name":["a"],"size":"x"}', '{"name":"a","size":{"b":1}}']]
+
+            mock_create.assert_not_called()
+            send, hdr, end = mock_response_methods
+            assert send.call_args_list == [mocker.call(400)] * 2
+            assert [h.wfile.write.call_args.args[0] for h in handlers] == [
+                b'400 Bad Request: name must be a string or a number', b'400 Bad Request: size must be a string or a number']
 
         def it_returns_404_if_post_includes_id(mocker, dummy_client, dummy_server, mock_response_methods):
             # router treats POST /squirrels/{id} as 404
@@ -127,36 +472,70 @@ def describe_SquirrelServerHandler():
 
             send, hdr, end = mock_response_methods
             send.assert_called_once_with(404)
-            hdr.assert_called_once_with("Content-Type", "text/plain")
+            assert hdr.call_args_list == [mocker.call("Content-Type", "text/plain"), mocker.call("Content-Length", "13")]
             end.assert_called_once()
             handler.wfile.write.assert_called_once_with(b"404 Not Found")
 
+    # POST /squirrels/_bulk → handleSquirrelsBulk
+    def describe_handleSquirrelsBulk():
+        def it_accepts_a_json_array(mocker, mock_db_init, dummy_client, dummy_server, mock_response_methods):
+            results = [{'op': 'create', 'status': 201, 'id': 1}]
+            mock_bulk = mocker.patch.object(SquirrelDB, 'applyBulk', return_value=results)
+            req = FakeRequest(mocker.Mock(), 'POST', '/squirrels/_bulk', body='[{"op": "create", "name": "a", "size": "s"}]')
+
+            handler = SquirrelServerHandler(req, dummy_client, dummy_server)
+
+            mock_bulk.assert_called_once_with([{'op': 'create', 'name': 'a', 'size': 's'}])
+            send, hdr, end = mock_response_methods
+            send.assert_called_once_with(200)
+            handler.wfile.write.assert_called_once_with(bytes(json.dumps({'errors': False, 'results': results}, separators=(',', ':')), 'utf-8'))
+
+        def it_accepts_ndjson(mocker, mock_db_init, dummy_client, dummy_server, mock_response_methods):
+            mock_bulk = mocker.patch.object(SquirrelDB, 'applyBulk', return_value=[{'status': 204}, {'status': 404}])
+            req = FakeRequest(mocker.Mock(), 'POST', '/squirrels/_bulk', body='{"op": "delete", "id": 1}\n{"op": "delete", "id": 2}\n')
+
+            handler = SquirrelServerHandler(req, dummy_client, dummy_server)
+
+            mock_bulk.assert_called_once_with([{'op': 'delete', 'id': 1}, {'op': 'delete', 'id': 2}])
+            assert json.loads(handler.wfile.write.call_args.args[0])['errors'] is True
+
+        def it_returns_400_for_broken_json(mocker, mock_db_init, dummy_client, dummy_server, mock_response_methods):
+            mock_bulk = mocker.patch.object(SquirrelDB, 'applyBulk')
+            req = FakeRequest(mocker.Mock(), 'POST', '/squirrels/_bulk', body='[{"op": ')
+
+            SquirrelServerHandler(req, dummy_client, dummy_server)
+
+            send, hdr, end = mock_response_methods
+            send.assert_called_once_with(400)
+            mock_bulk.assert_not_called()
+
     # PUT /squirrels/{id} → handleSquirrelsUpdate
     def describe_handleSquirrelsUpdate():
-        def it_updates_and_returns_204_when_found(mocker, mock_db_init, dummy_client, dummy_server, mock_response_methods):
-            mocker.patch.object(SquirrelDB, 'getSquirrel', return_value={'id': '1'})
-            mock_update = mocker.patch.object(SquirrelDB, 'updateSquirrel', return_value=None)
+        def it_updates_and_returns_200_with_the_squirrel_when_found(mocker, mock_db_init, dummy_client, dummy_server, mock_response_methods):
+            mock_get = mocker.patch.object(SquirrelDB, 'getSquirrel')
+            mock_update = mocker.patch.object(SquirrelDB, 'updateSquirrel', return_value={'id': 1, 'name': 'Nova', 'size': 'medium'})
             req = FakeRequest(mocker.Mock(), 'PUT', '/squirrels/1', body='name=Nova&size=medium')
 
             SquirrelServerHandler(req, dummy_client, dummy_server)
 
+            # one statement, no read before the write
+            mock_get.assert_not_called()
             mock_update.assert_called_once_with('1', 'Nova', 'medium')
             send, hdr, end = mock_response_methods
-            send.assert_called_once_with(204)
+            send.assert_called_once_with(200)
             end.assert_called_once()
-            # 204 → no body written
-            req._mock_wfile.write.assert_not_called()
+            req._mock_wfile.write.assert_called_once_with(b'{"id":1,"name":"Nova","size":"medium"}')
 
         def it_calls_handle404_when_updating_missing(mocker, mock_db_init, dummy_client, dummy_server):
-            mocker.patch.object(SquirrelDB, 'getSquirrel', return_value=None)
             spy_update = mocker.patch.object(SquirrelDB, 'updateSquirrel', return_value=None)
             spy_404 = mocker.patch.object(SquirrelServerHandler, 'handle404')
             req = FakeRequest(mocker.Mock(), 'PUT', '/squirrels/404', body='name=X&size=S')
 
             SquirrelServerHandler(req, dummy_client, dummy_server)
 
+            # the update itself reports that nothing matched
+            spy_update.assert_called_once_with('404', 'X', 'S')
             spy_404.assert_called_once()
-            spy_update.assert_not_called()
 
         def it_returns_404_when_put_has_no_id(mocker, mock_db_init, dummy_client, dummy_server, mock_response_methods):
             # PUT /squirrels (no id) should hit handle404 via do_PUT
@@ -166,19 +545,20 @@ def describe_SquirrelServerHandler():
 
             send, hdr, end = mock_response_methods
             send.assert_called_once_with(404)
-            hdr.assert_called_once_with("Content-Type", "text/plain")
+            assert hdr.call_args_list == [mocker.call("Content-Type", "text/plain"), mocker.call("Content-Length", "13")]
             end.assert_called_once()
             handler.wfile.write.assert_called_once_with(b"404 Not Found")
 
     # DELETE /squirrels/{id} → handleSquirrelsDelete
     def describe_handleSquirrelsDelete():
         def it_deletes_and_returns_204_when_found(mocker, mock_db_init, dummy_client, dummy_server, mock_response_methods):
-            mocker.patch.object(SquirrelDB, 'getSquirrel', return_value={'id': '2'})
-            mock_delete = mocker.patch.object(SquirrelDB, 'deleteSquirrel', return_value=None)
+            mock_get = mocker.patch.object(SquirrelDB, 'getSquirrel')
+            mock_delete = mocker.patch.object(SquirrelDB, 'deleteSquirrel', return_value={'id': 2})
             req = FakeRequest(mocker.Mock(), 'DELETE', '/squirrels/2')
 
             SquirrelServerHandler(req, dummy_client, dummy_server)
 
+            mock_get.assert_not_called()
             mock_delete.assert_called_once_with('2')
             send, hdr, end = mock_response_methods
             send.assert_called_once_with(204)
@@ -187,15 +567,14 @@ def describe_SquirrelServerHandler():
             req._mock_wfile.write.assert_not_called()
 
         def it_calls_handle404_when_deleting_missing(mocker, mock_db_init, dummy_client, dummy_server):
-            mocker.patch.object(SquirrelDB, 'getSquirrel', return_value=None)
             spy_delete = mocker.patch.object(SquirrelDB, 'deleteSquirrel', return_value=None)
             spy_404 = mocker.patch.object(SquirrelServerHandler, 'handle404')
             req = FakeRequest(mocker.Mock(), 'DELETE', '/squirrels/123')
 
             SquirrelServerHandler(req, dummy_client, dummy_server)
 
+            spy_delete.assert_called_once_with('123')
             spy_404.assert_called_once()
-            spy_delete.assert_not_called()
 
         def it_returns_404_when_delete_has_no_id(mocker, mock_db_init, dummy_client, dummy_server, mock_response_methods):
             # DELETE /squirrels (no id) should hit handle404 via do_DELETE
@@ -205,7 +584,7 @@ def describe_SquirrelServerHandler():
 
             send, hdr, end = mock_response_methods
             send.assert_called_once_with(404)
-            hdr.assert_called_once_with("Content-Type", "text/plain")
+            assert hdr.call_args_list == [mocker.call("Content-Type", "text/plain"), mocker.call("Content-Length", "13")]
             end.assert_called_once()
             handler.wfile.write.assert_called_once_with(b"404 Not Found")
 
@@ -219,10 +598,77 @@ def describe_SquirrelServerHandler():
 
             send, hdr, end = mock_response_methods
             send.assert_called_with(404)
-            hdr.assert_called_with("Content-Type", "text/plain")
+            hdr.assert_any_call("Content-Type", "text/plain")
+            hdr.assert_called_with("Content-Length", "13")
             end.assert_called()
             handler.wfile.write.assert_called_with(b"404 Not Found")
 
+    def describe_parsePath():
+        def it_separates_the_query_string(mocker, mock_db_init, dummy_client, dummy_server, mock_response_methods):
+            mocker.patch.object(SquirrelDB, 'getSquirrelJson', return_value=None)
+            req = FakeRequest(mocker.Mock(), 'GET', '/squirrels/5?fields=name')
+
+            handler = SquirrelServerHandler(req, dummy_client, dummy_server)
+
+            assert handler.parsePath() == ('squirrels', '5')
+            assert handler.query == {'fields': 'name'}
+
+    # GET /metrics → handleMetrics
+    def describe_handleMetrics():
+        def it_counts_requests_by_route_and_status(mocker, mock_db_init, dummy_client, dummy_server):
+            registry = Metrics()
+            mocker.patch('squirrel_server.metrics', registry)
+            mocker.patch.object(SquirrelDB, 'getSquirrelJson', return_value=None)
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels/42'), dummy_client, dummy_server)
+
+            handler = SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/metrics'), dummy_client, dummy_server)
+
+            text = b''.join(c.args[0] for c in handler.wfile.write.call_args_list).decode('utf-8')
+            assert 'squirrel_http_requests_total{route="/squirrels/{id}",method="GET",status="404"} 1' in text
+            assert 'squirrel_http_response_bytes_total{route="/squirrels/{id}"} 13' in text
+            # the scrape itself is still in flight while it renders
+            assert 'squirrel_http_requests_in_flight 1' in text
+
+        def it_counts_a_handler_that_raised_as_a_500(mocker, mock_db_init, dummy_client, dummy_server):
+            registry = Metrics()
+            mocker.patch('squirrel_server.metrics', registry)
+            mocker.patch.object(SquirrelDB, 'getSquirrelJson', side_effect=RuntimeError('boom'))
+
+            with pytest.raises(RuntimeError):
+                SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels/42'), dummy_client, dummy_server)
+
+            _, histograms = registry.collect()
+            labels = (('route', '/squirrels/{id}'), ('method', 'GET'), ('status', '500'))
+            assert ('squirrel_http_request_duration_seconds', labels) in histograms
+
+    def describe_admission():
+        @pytest.fixture
+        def limits():
+            admission.set(routeLimits={'GET /squirrels': 1}, retryAfter=5)
+            yield admission
+            admission.configure()
+
+        def it_answers_503_when_the_route_is_full(mocker, mock_db_init, dummy_client, dummy_server, mock_response_methods, limits):
+            list_squirrels = mocker.patch.object(SquirrelDB, 'getSquirrelsJson')
+            held = limits.admit('GET', '/squirrels')
+
+            handler = SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels'), dummy_client, dummy_server)
+
+            send, hdr, _ = mock_response_methods
+            send.assert_called_once_with(503)
+            assert mocker.call('Retry-After', '5') in hdr.call_args_list
+            handler.wfile.write.assert_called_once_with(b'503 Service Unavailable')
+            list_squirrels.assert_not_called()
+            limits.release(held)
+
+        def it_gives_the_slot_back_after_the_request(mocker, mock_db_init, dummy_client, dummy_server, mock_response_methods, limits):
+            mocker.patch.object(SquirrelDB, 'getSquirrelsJson', return_value='[]')
+            for _ in range(2):
+                SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels'), dummy_client, dummy_server)
+            send, _, _ = mock_response_methods
+            assert send.call_args_list == [mocker.call(200), mocker.call(200)]
+            assert limits.running == {'GET /squirrels': 0}
+
     # Routing check for unknown resources
     def describe_routing_for_unknown_resource():
         def it_returns_404_for_unknown_collection(mocker, mock_db_init, dummy_client, dummy_server, mock_response_methods):
@@ -233,6 +679,165 @@ def describe_SquirrelServerHandler():
 
             send, hdr, end = mock_response_methods
             send.assert_called_once_with(404)
-            hdr.assert_called_once_with("Content-Type", "text/plain")
+            assert hdr.call_args_list == [mocker.call("Content-Type", "text/plain"), mocker.call("Content-Length", "13")]
             end.assert_called_once()
             handler.wfile.write.assert_called_once_with(b"404 Not Found")
+
+
+# real sockets, but only the 404 paths so no database is touched
+@pytest.fixture
+def live_server():
+    server = ThreadPoolHTTPServer(('127.0.0.1', 0), SquirrelServerHandler, workers=2, backlog=8, idleTimeout=2)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def describe_negotiate():
+    def it_defaults_to_json():
+        assert negotiate(None) == JSON
+        assert negotiate('*/*') == JSON
+        assert negotiate('text/html') == JSON
+
+    def it_prefers_the_highest_q_then_the_most_specific_match():
+        assert negotiate('application/msgpack, */*') == MSGPACK
+        assert negotiate('application/json;q=0.5, application/x-ndjson') == NDJSON
+        assert negotiate('application/*;q=0.2, application/vnd.msgpack;q=0.9') == MSGPACK
+        assert negotiate('application/msgpack;q=0, */*;q=0.1') == JSON
+
+def describe_acceptsGzip():
+    def it_needs_gzip_or_a_wildcard_with_a_q_above_zero():
+        assert acceptsGzip('gzip')
+        assert acceptsGzip('deflate, x-gzip;q=0.5')
+        assert acceptsGzip('*')
+        assert not acceptsGzip(None)
+        assert not acceptsGzip('identity')
+        assert not acceptsGzip('gzip;q=0, *')
+
+def describe_ThreadPoolHTTPServer():
+    def it_serves_several_requests_over_one_keep_alive_connection(live_server):
+        conn = http.client.HTTPConnection('127.0.0.1', live_server.server_address[1], timeout=5)
+        for path in ('/mike', '/goat'):
+            conn.request('GET', path)
+            resp = conn.getresponse()
+            assert resp.status == 404
+            assert resp.getheader('Content-Length') == '13'
+            assert resp.read() == b'404 Not Found'
+        # same socket both times → the connection was kept alive
+        assert conn.sock is not None
+        conn.close()
+
+    def it_skips_an_unused_body_before_the_next_request(live_server):
+        conn = http.client.HTTPConnection('127.0.0.1', live_server.server_address[1], timeout=5)
+        conn.request('PUT', '/squirrels', body='name=X&size=S',
+                     headers={'Content-Type': 'application/x-www-form-urlencoded'})
+        assert conn.getresponse().read() == b'404 Not Found'
+        conn.request('GET', '/mike')
+        resp = conn.getresponse()
+        assert resp.status == 404
+        assert resp.read() == b'404 Not Found'
+        conn.close()
+
+    def it_retires_after_max_requests():
+        server = ThreadPoolHTTPServer(('127.0.0.1', 0), SquirrelServerHandler, workers=2, idleTimeout=2, maxRequests=2)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        conn = http.client.HTTPConnection('127.0.0.1', server.server_address[1], timeout=5)
+        conn.request('GET', '/mike')
+        assert conn.getresponse().read() == b'404 Not Found'
+        conn.request('GET', '/mike')
+        # the last request is still answered, then the connection and the serve loop end
+        assert conn.getresponse().read() == b'404 Not Found'
+        assert conn.sock.recv(1) == b''
+        thread.join(timeout=5)
+        assert not thread.is_alive()
+        conn.close()
+        server.server_close()
+
+    def it_accepts_on_a_socket_it_is_given():
+        sock = socket.create_server(('127.0.0.1', 0))
+        server = ThreadPoolHTTPServer(('127.0.0.1', 0), SquirrelServerHandler, workers=1, sock=sock)
+        assert server.socket is sock
+        assert server.server_address == sock.getsockname()
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        conn = http.client.HTTPConnection('127.0.0.1', sock.getsockname()[1], timeout=5)
+        conn.request('GET', '/mike')
+        assert conn.getresponse().status == 404
+        conn.close()
+        server.shutdown()
+        server.server_close()
+
+def describe_parseArgs():
+    def it_uses_defaults():
+        args = parseArgs([], environ={})
+        assert (args.host, args.port, args.workers, args.backlog, args.idle_timeout) == ('127.0.0.1', 8080, 8, 64, 15)
+
+    def it_reads_the_environment():
+        args = parseArgs([], environ={'SQUIRREL_PORT': '9000', 'SQUIRREL_WORKERS': '32'})
+        assert args.port == 9000
+        assert args.workers == 32
+
+    def it_lets_flags_override_the_environment():
+        args = parseArgs(['--port', '9001', '--backlog', '256'], environ={'SQUIRREL_PORT': '9000'})
+        assert args.port == 9001
+        assert args.backlog == 256
+
+    def it_turns_group_commit_off_and_tunes_it():
+        assert parseArgs([], environ={}).group_commit
+        assert parseArgs([], environ={}).durability == 'full'
+        args = parseArgs(['--durability', 'normal', '--commit-delay', '2'], environ={})
+        assert (args.durability, args.commit_delay) == ('normal', 2)
+        assert not parseArgs(['--no-group-commit'], environ={}).group_commit
+        assert not parseArgs([], environ={'SQUIRREL_GROUP_COMMIT': '0'}).group_commit
+
+    def it_rejects_a_durability_group_commit_would_not_apply():
+        with pytest.raises(SystemExit):
+            parseArgs(['--no-group-commit', '--durability', 'normal'], environ={})
+        with pytest.raises(SystemExit):
+            parseArgs([], environ={'SQUIRREL_GROUP_COMMIT': '0', 'SQUIRREL_DURABILITY': 'off'})
+
+    def it_rejects_zero_workers():
+        with pytest.raises(SystemExit):
+            parseArgs(['--workers', '0'], environ={})
+
+    def it_configures_worker_processes():
+        args = parseArgs([], environ={})
+        assert (args.processes, args.max_requests, args.reuse_port) == (1, 0, False)
+        args = parseArgs(['--processes', '4', '--max-requests', '1000'], environ={'SQUIRREL_REUSE_PORT': '1'})
+        assert (args.processes, args.max_requests, args.reuse_port) == (4, 1000, True)
+        with pytest.raises(SystemExit):
+            parseArgs(['--processes', '0'], environ={})
+
+    def it_configures_the_replica():
+        args = parseArgs([], environ={})
+        assert (args.replica, args.replica_check) == (False, 1)
+        args = parseArgs(['--replica-check', '0.25'], environ={'SQUIRREL_REPLICA': '1'})
+        assert (args.replica, args.replica_check) == (True, 0.25)
+        with pytest.raises(SystemExit):
+            parseArgs(['--replica', '--processes', '2'], environ={})
+
+    def it_configures_admission():
+        args = parseArgs([], environ={})
+        assert (args.max_queue, args.route_limits, args.retry_after, args.admission_config) == (0, {}, 1, None)
+        args = parseArgs(['--route-limit', 'GET /squirrels=2', '--max-queue', '16'],
+                         environ={'SQUIRREL_ROUTE_LIMITS': '/squirrels/_bulk=1', 'SQUIRREL_ADMISSION_CONFIG': 'limits.json'})
+        assert args.route_limits == {'/squirrels/_bulk': 1, 'GET /squirrels': 2}
+        assert (args.max_queue, args.admission_config) == (16, 'limits.json')
+        with pytest.raises(SystemExit):
+            parseArgs(['--route-limit', '/nope=1'], environ={})
+
+    def it_configures_change_retention():
+        assert parseArgs([], environ={}).change_retention == 7 * 24 * 3600
+        assert parseArgs([], environ={'SQUIRREL_CHANGE_RETENTION': '0'}).change_retention == 0
+        with pytest.raises(SystemExit):
+            parseArgs(['--change-retention', '-1'], environ={})
+
+    def it_configures_gzip():
+        args = parseArgs([], environ={})
+        assert (args.gzip_min_bytes, args.gzip_level) == (1024, 6)
+        args = parseArgs(['--gzip-level', '0'], environ={'SQUIRREL_GZIP_MIN_BYTES': '256'})
+        assert (args.gzip_min_bytes, args.gzip_level) == (256, 0)
+        with pytest.raises(SystemExit):
+            parseArgs(['--gzip-level', '10'], environ={})